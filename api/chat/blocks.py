@@ -0,0 +1,150 @@
+"""
+Cached block lists, so delivery and push checks are set lookups instead of queries.
+
+``blocked_ids(user_id)`` is the frozenset of ids ``user_id`` has blocked. Each
+process keeps the sets it has read for CHAT_BLOCKS_LOCAL_TTL seconds, at most
+CHAT_BLOCKS_LOCAL_MAX of them, dropping the least recently used first. Behind
+that, when CHAT_BLOCKS_REDIS_URL is set, the sets are shared in Redis as
+``blocks:<user_id>`` for CHAT_BLOCKS_TTL seconds, so a lookup that misses in
+memory costs one SMEMBERS and only a cold set is read from the database.
+
+``BlockUserView`` and ``UnblockUserView`` call ``invalidate`` after changing a
+row. That drops this process's copy and the Redis set and bumps the
+``blocks:<user_id>:gen`` counter; a reader stores what it loaded from the
+database only if the counter has not moved since before its query, so a slow
+reader cannot put an outdated list back. Other processes may answer from their
+own copy until it expires, at most CHAT_BLOCKS_LOCAL_TTL seconds.
+"""
+import collections
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .models import BlockedUser
+
+logger = logging.getLogger(__name__)
+
+# Store the set ARGV[3..] unless the generation moved on from ARGV[1]. The empty member marks
+# the set as loaded, so users who block nobody are cached too.
+FILL_LUA = """
+    if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    redis.call('SADD', KEYS[1], '', unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+"""
+
+
+def blocks_ttl():
+    return getattr(settings, 'CHAT_BLOCKS_TTL', 3600)
+
+
+def local_ttl():
+    return getattr(settings, 'CHAT_BLOCKS_LOCAL_TTL', 5)
+
+
+def local_max():
+    return getattr(settings, 'CHAT_BLOCKS_LOCAL_MAX', 10000)
+
+
+def load(user_id):
+    return frozenset(BlockedUser.objects.filter(user_id=user_id).values_list('blocked_user_id', flat=True))
+
+
+class LocalBlocks:
+    """No shared copy: every process reads the database when its own copy expires."""
+
+    def get(self, user_id):
+        return load(user_id)
+
+    def invalidate(self, user_id):
+        pass
+
+
+class RedisBlocks:
+    """``blocks:<user_id>`` sets of blocked ids and ``blocks:<user_id>:gen`` invalidation counters."""
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+        self.fill_script = self.client.register_script(FILL_LUA)
+
+    def keys(self, user_id):
+        return [f'blocks:{user_id}', f'blocks:{user_id}:gen']
+
+    def get(self, user_id):
+        keys = self.keys(user_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.smembers(keys[0])
+        pipe.get(keys[1])
+        members, generation = pipe.execute()
+        if members:
+            return frozenset(int(member) for member in members if member)
+        blocked = load(user_id)
+        self.fill_script(keys=keys, args=[(generation or b'0').decode(), int(blocks_ttl()), *blocked])
+        return blocked
+
+    def invalidate(self, user_id):
+        keys = self.keys(user_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.incr(keys[1])
+        pipe.expire(keys[1], int(blocks_ttl()))
+        pipe.delete(keys[0])
+        pipe.execute()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_local = collections.OrderedDict()  # {user_id: (expires, frozenset of blocked ids)}, least recently used first
+_local_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                url = getattr(settings, 'CHAT_BLOCKS_REDIS_URL', '')
+                _backend = RedisBlocks(url) if url else LocalBlocks()
+    return _backend
+
+
+def blocked_ids(user_id):
+    """Ids of the users ``user_id`` has blocked."""
+    now = time.time()
+    with _local_lock:
+        cached = _local.get(user_id)
+        if cached is not None and cached[0] > now:
+            _local.move_to_end(user_id)
+            return cached[1]
+    try:
+        blocked = get_backend().get(user_id)
+    except Exception as e:
+        logger.error(f"Error reading cached blocks of user {user_id}: {e}")
+        return load(user_id)
+    with _local_lock:
+        _local[user_id] = (now + local_ttl(), blocked)
+        _local.move_to_end(user_id)
+        while len(_local) > local_max():
+            _local.popitem(last=False)
+    return blocked
+
+
+def is_blocked(user_id, other_id):
+    """Whether ``user_id`` has blocked ``other_id``."""
+    return other_id in blocked_ids(user_id)
+
+
+def invalidate(user_id):
+    """Forget the block list of ``user_id``, after one of their blocks was added or removed."""
+    with _local_lock:
+        _local.pop(user_id, None)
+    try:
+        get_backend().invalidate(user_id)
+    except Exception as e:
+        # The shared set is left as it was and stays wrong until CHAT_BLOCKS_TTL runs out
+        logger.error(f"Error invalidating cached blocks of user {user_id}: {e}")
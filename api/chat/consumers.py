@@ -1,38 +1,36 @@
+import asyncio
 import base64
+import functools
 import json
 import re
 import os
 import logging
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
 from django.db.models import Q, Exists, OuterRef
-from django.db.models.functions import Coalesce
 from django.utils import timezone
-from asgiref.sync import async_to_sync, sync_to_async
-from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from django.core.cache import cache
-from .models import User, Connection, Message, Group, Reaction, BlockedUser
+from .models import User, Connection, Message, Group, Reaction
 from .serializers import (
-    UserSerializer, SearchSerializer, RequestSerializer, FriendSerializer,
-    MessageSerializer, GroupSerializer
+    UserSerializer, SearchSerializer, GroupSerializer
 )
-from datetime import datetime
 from .views import send_fcm_notification
+from .executors import db_sync_to_async, cpu_sync_to_async, http_sync_to_async
+from .layers import group_send_many, chat_group_name
+from .envelopes import envelope, message_variants
+from .receipts import ReadState
+from .throttling import SocketLimiter
+from .outbound import OutboundQueue, slow_consumer_close, RELIABLE, LATEST, DROPPABLE
+from . import blocks, ephemeral, expiry, history, inbox, mailbox, presence, recent, sync
+from .fast_serializers import (
+    serialize_user, serialize_message, serialize_messages, serialize_request, serialize_requests, incognito_message_data,
+    viewer_messages_data,
+)
+from .encoding import dumps, loads, negotiate, encode_frame, decode_frame, FrameDecodeError, JSON
 import redis
 
-# Helper function to convert datetime objects to strings
-def serialize_datetime(obj):
-    if isinstance(obj, datetime.datetime):
-        return obj.isoformat()
-    elif isinstance(obj, dict):
-        return {k: serialize_datetime(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [serialize_datetime(item) for item in obj]
-    elif hasattr(obj, '__dict__'):
-        return serialize_datetime(obj.__dict__)
-    return obj
-
 # Set up logging
 logger = logging.getLogger(__name__)
 
@@ -48,7 +46,7 @@ class SignalingVoiceConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
+            data = loads(text_data)
             type_ = data.get('type')
             logger.info(f"Received message type: {type_}")
             if type_ == 'JOIN':
@@ -57,7 +55,7 @@ class SignalingVoiceConsumer(AsyncWebsocketConsumer):
                 await self.add_user_to_group(self.group_name, self.channel_name)
                 other_user = await self.get_other_user(self.group_name)
                 if other_user:
-                    await self.send(json.dumps({"type": "OTHER_USER", "payload": other_user}))
+                    await self.send(dumps({"type": "OTHER_USER", "payload": other_user}))
                     await self.channel_layer.send(other_user, {"type": "user_joined", "payload": self.channel_name})
             elif type_ == 'OFFER':
                 await self.channel_layer.send(data['target'], {"type": "offer", "sdp": data['sdp']})
@@ -71,18 +69,18 @@ class SignalingVoiceConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error in SignalingConsumer: {e}")
 
     async def user_joined(self, event):
-        await self.send(json.dumps({"type": "USER_JOINED", "payload": event['payload']}))
+        await self.send(dumps({"type": "USER_JOINED", "payload": event['payload']}))
 
     async def offer(self, event):
-        await self.send(json.dumps({"type": "OFFER", "sdp": event['sdp']}))
+        await self.send(dumps({"type": "OFFER", "sdp": event['sdp']}))
 
     async def answer(self, event):
-        await self.send(json.dumps({"type": "ANSWER", "sdp": event['sdp']}))
+        await self.send(dumps({"type": "ANSWER", "sdp": event['sdp']}))
 
     async def ice_candidate(self, event):
-        await self.send(json.dumps({"type": "ICE_CANDIDATE", "candidate": event['candidate']}))
+        await self.send(dumps({"type": "ICE_CANDIDATE", "candidate": event['candidate']}))
 
-    @database_sync_to_async
+    @db_sync_to_async
     def add_user_to_group(self, group_name, channel_name):
         group_users = cache.get(group_name, [])
         if channel_name not in group_users:
@@ -90,7 +88,7 @@ class SignalingVoiceConsumer(AsyncWebsocketConsumer):
             cache.set(group_name, group_users, timeout=86400)
         logger.info(f"Added {channel_name} to group {group_name}")
 
-    @database_sync_to_async
+    @db_sync_to_async
     def remove_user_from_group(self, group_name, channel_name):
         group_users = cache.get(group_name, [])
         if channel_name in group_users:
@@ -98,7 +96,7 @@ class SignalingVoiceConsumer(AsyncWebsocketConsumer):
             cache.set(group_name, group_users, timeout=86400)
         logger.info(f"Removed {channel_name} from group {group_name}")
 
-    @database_sync_to_async
+    @db_sync_to_async
     def get_other_user(self, group_name):
         users = cache.get(group_name, [])
         return next((user for user in users if user != self.channel_name), None)
@@ -118,12 +116,11 @@ class SignalingMusicConsumer(AsyncWebsocketConsumer):
         await self.add_user_to_group(self.group_name, self.channel_name)
         other_users = await self.get_other_users(self.group_name)
         for user in other_users:
-            await self.send(json.dumps({"type": "OTHER_USER", "payload": user}))
+            await self.send(dumps({"type": "OTHER_USER", "payload": user}))
             await self.channel_layer.send(user, {"type": "user.joined", "payload": self.channel_name})
         await self.broadcast_participants()
 
-    @sync_to_async
-    def get_username_from_channel(self, channel):
+    async def get_username_from_channel(self, channel):
         return self.user.username if self.user.is_authenticated and channel == self.channel_name else "Anonymous"
 
     async def disconnect(self, close_code):
@@ -141,7 +138,7 @@ class SignalingMusicConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
+            data = loads(text_data)
             message_type = data.get('type')
             logger.info(f"Received message type: {message_type}")
             if message_type == 'JOIN':
@@ -186,17 +183,17 @@ class SignalingMusicConsumer(AsyncWebsocketConsumer):
         )
 
     async def user_joined(self, event):
-        await self.send(json.dumps({"type": "USER_JOINED", "payload": event['payload']}))
+        await self.send(dumps({"type": "USER_JOINED", "payload": event['payload']}))
         await self.broadcast_participants()
 
     async def user_left(self, event):
-        await self.send(json.dumps({"type": "USER_LEFT", "payload": event['payload']}))
+        await self.send(dumps({"type": "USER_LEFT", "payload": event['payload']}))
         await self.broadcast_participants()
 
     async def media_control(self, event):
-        await self.send(json.dumps(event['payload']))
+        await self.send(dumps(event['payload']))
 
-    @sync_to_async
+    @db_sync_to_async
     def add_user_to_group(self, group_name, channel_name):
         cache_key = f"group_{group_name}"
         users = cache.get(cache_key, [])
@@ -205,7 +202,7 @@ class SignalingMusicConsumer(AsyncWebsocketConsumer):
             cache.set(cache_key, users, timeout=86400)
         logger.info(f"Users in group {group_name}: {users}")
 
-    @sync_to_async
+    @db_sync_to_async
     def remove_user_from_group(self, group_name, channel_name):
         cache_key = f"group_{group_name}"
         users = cache.get(cache_key, [])
@@ -214,12 +211,12 @@ class SignalingMusicConsumer(AsyncWebsocketConsumer):
             cache.set(cache_key, users, timeout=86400)
         logger.info(f"Users in group {group_name}: {users}")
 
-    @sync_to_async
+    @db_sync_to_async
     def get_all_users(self, group_name):
         cache_key = f"group_{group_name}"
         return cache.get(cache_key, [])
 
-    @sync_to_async
+    @db_sync_to_async
     def get_other_users(self, group_name):
         cache_key = f"group_{group_name}"
         users = cache.get(cache_key, [])
@@ -237,7 +234,7 @@ class SignalingConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
+            data = loads(text_data)
             type_ = data.get('type')
             logger.info(f"Received message type: {type_}")
             if type_ == 'JOIN':
@@ -246,7 +243,7 @@ class SignalingConsumer(AsyncWebsocketConsumer):
                 await self.add_user_to_group(self.group_name, self.channel_name)
                 other_user = await self.get_other_user(self.group_name)
                 if other_user:
-                    await self.send(json.dumps({"type": "OTHER_USER", "payload": other_user}))
+                    await self.send(dumps({"type": "OTHER_USER", "payload": other_user}))
                     await self.channel_layer.send(other_user, {"type": "user_joined", "payload": self.channel_name})
             elif type_ == 'OFFER':
                 await self.channel_layer.send(data['target'], {"type": "offer", "sdp": data['sdp']})
@@ -262,21 +259,21 @@ class SignalingConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error in SignalingConsumer: {e}")
 
     async def user_joined(self, event):
-        await self.send(json.dumps({"type": "USER_JOINED", "payload": event['payload']}))
+        await self.send(dumps({"type": "USER_JOINED", "payload": event['payload']}))
 
     async def offer(self, event):
-        await self.send(json.dumps({"type": "OFFER", "sdp": event['sdp']}))
+        await self.send(dumps({"type": "OFFER", "sdp": event['sdp']}))
 
     async def answer(self, event):
-        await self.send(json.dumps({"type": "ANSWER", "sdp": event['sdp']}))
+        await self.send(dumps({"type": "ANSWER", "sdp": event['sdp']}))
 
     async def ice_candidate(self, event):
-        await self.send(json.dumps({"type": "ICE_CANDIDATE", "candidate": event['candidate']}))
+        await self.send(dumps({"type": "ICE_CANDIDATE", "candidate": event['candidate']}))
 
     async def signal_message(self, event):
-        await self.send(json.dumps(event['message']))
+        await self.send(dumps(event['message']))
 
-    @database_sync_to_async
+    @db_sync_to_async
     def add_user_to_group(self, group_name, channel_name):
         group_users = cache.get(group_name, [])
         if channel_name not in group_users:
@@ -284,7 +281,7 @@ class SignalingConsumer(AsyncWebsocketConsumer):
             cache.set(group_name, group_users, timeout=86400)
         logger.info(f"Added {channel_name} to group {group_name}")
 
-    @database_sync_to_async
+    @db_sync_to_async
     def remove_user_from_group(self, group_name, channel_name):
         group_users = cache.get(group_name, [])
         if channel_name in group_users:
@@ -292,53 +289,162 @@ class SignalingConsumer(AsyncWebsocketConsumer):
             cache.set(group_name, group_users, timeout=86400)
         logger.info(f"Removed {channel_name} from group {group_name}")
 
-    @database_sync_to_async
+    @db_sync_to_async
     def get_other_user(self, group_name):
         users = cache.get(group_name, [])
         return next((user for user in users if user != self.channel_name), None)
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+class ChatConsumer(AsyncWebsocketConsumer):
+    # Every ORM touch happens inside a db_sync_to_async unit so that an idle
+    # socket (or one waiting on the channel layer) does not pin a worker thread.
+
+    async def connect(self):
         user = self.scope['user']
         if not user.is_authenticated:
-            self.close()
+            await self.close()
             return
 
+        # Everything disconnect() reads is set before the first await, so a socket
+        # that fails or closes halfway through connecting still tears down cleanly
         self.username = user.username
-        async_to_sync(self.channel_layer.group_add)(self.username, self.channel_name)
-        user.last_online = timezone.now()
-        user.is_online = True
-        user.save()
-        self.broadcast_online_status(user.username, True)
-        self.send_initial_friend_status(user)
-        self.accept()
-    
-    def receive_voicecall_request(self, data):
+        self.codec = negotiate(self.scope)
+        self.pending_receipts = {}
+        self.receipt_flush = None
+        self.presence_heartbeat = None
+        self.present = False
+        self.chat_groups = set()
+        self.typing = {}  # {channel-layer group: typing state}, see receive_message_type
+        self.limiter = SocketLimiter()
+        self.closing = False
+        self.outbound = OutboundQueue(self.send, slow_consumer_close(self))
+        await self.channel_layer.group_add(self.username, self.channel_name)
+        # Join the channel-layer group of every chat Group so group traffic is one group_send
+        for chat_group in await self.get_chat_group_names():
+            self.chat_groups.add(chat_group)
+            await self.channel_layer.group_add(chat_group, self.channel_name)
+        announce = await presence.connected(user.pk, self.channel_name)
+        self.present = True
+        if announce:
+            await self.broadcast_online_status(user.username, True)
+        await self.accept(None if self.codec == JSON else self.codec)
+        # Full friend presence once; later changes arrive as online.status diffs
+        await self.send_presence_snapshot()
+        await self.replay_incognito()
+        await self.replay_mailbox()
+        self.presence_heartbeat = asyncio.ensure_future(self.keep_presence_alive())
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'receipt_flush', None):
+            self.receipt_flush.cancel()
+        if getattr(self, 'presence_heartbeat', None):
+            self.presence_heartbeat.cancel()
+        if getattr(self, 'outbound', None):
+            self.outbound.discard()
+        if hasattr(self, 'username'):
+            await self.stop_typing()
+            await self.channel_layer.group_discard(self.username, self.channel_name)
+            for chat_group in self.chat_groups:
+                await self.channel_layer.group_discard(chat_group, self.channel_name)
+        if getattr(self, 'present', False):
+            await presence.disconnected(
+                self.scope['user'].pk, self.channel_name,
+                functools.partial(self.broadcast_online_status, self.username, False),
+            )
+
+    @db_sync_to_async
+    def get_chat_group_names(self):
+        group_ids = Group.objects.filter(members=self.scope['user']).values_list('id', flat=True)
+        return [chat_group_name(group_id) for group_id in group_ids]
+
+    async def chatgroup_membership(self, event):
+        """Join or leave a chat Group's channel-layer group after this user's membership changed."""
+        if event['joined']:
+            self.chat_groups.add(event['group'])
+            await self.channel_layer.group_add(event['group'], self.channel_name)
+        else:
+            self.chat_groups.discard(event['group'])
+            await self.channel_layer.group_discard(event['group'], self.channel_name)
+
+    async def keep_presence_alive(self):
+        """Push this socket's presence expiry forward for as long as it stays connected."""
+        user = self.scope['user']
+        while True:
+            await asyncio.sleep(presence.heartbeat_interval())
+            try:
+                await presence.heartbeat(user.pk, self.channel_name)
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed for {self.username}: {e}")
+
+    @db_sync_to_async
+    def get_friend_usernames(self, user):
+        friends = Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user), accepted=True
+        ).values_list('sender__username', 'receiver__username')
+        return [
+            receiver if sender == user.username else sender
+            for sender, receiver in friends
+        ]
+
+    @db_sync_to_async
+    def get_friends(self, user):
+        """``(id, username)`` of every accepted connection of ``user``."""
+        friends = Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user), accepted=True
+        ).values_list('sender_id', 'sender__username', 'receiver_id', 'receiver__username')
+        return [
+            (receiver_id, receiver) if sender_id == user.pk else (sender_id, sender)
+            for sender_id, sender, receiver_id, receiver in friends
+        ]
+
+    async def send_presence_snapshot(self):
+        """One ``presence.snapshot`` frame mapping each friend's username to whether they are online."""
+        friends = await self.get_friends(self.scope['user'])
+        online = await presence.aonline_ids(pk for pk, _ in friends)
+        await self.send_frame({
+            'source': 'presence.snapshot',
+            'data': {'friends': {username: pk in online for pk, username in friends}},
+        })
+
+    async def broadcast_online_status(self, username, online):
+        await self.send_groups(
+            await self.get_friend_usernames(self.scope['user']),
+            'online.status', {'username': username, 'online': online}, collapse=f'online.status:{username}'
+        )
+
+    @db_sync_to_async
+    def get_peer_username(self, connection_id):
+        """Return the username on the other side of ``connection_id``, or None if it does not exist."""
+        try:
+            connection = Connection.objects.select_related('sender', 'receiver').get(id=connection_id)
+        except Connection.DoesNotExist:
+            return None
+        user = self.scope['user']
+        return connection.sender.username if connection.sender != user else connection.receiver.username
+
+    async def receive_voicecall_request(self, data):
         inner_data = data.get("data", {})
         connection_id = inner_data.get("connectionId")
         room_id = inner_data.get("roomId")
 
         if not connection_id:
             logger.error("No connection ID provided in receive_voicecall_request")
-            self.send_error("Connection ID is required")
+            await self.send_error("Connection ID is required")
             return
 
         if not room_id:
             logger.error("No room ID provided in receive_voicecall_request")
-            self.send_error("Room ID is required")
+            await self.send_error("Room ID is required")
             return
 
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+        recipient = await self.get_peer_username(connection_id)
+        if recipient is None:
             logger.error(f"Connection with ID {connection_id} does not exist")
-            self.send_error("Connection not found")
+            await self.send_error("Connection not found")
             return
 
         user = self.scope["user"]
-        recipient = connection.sender if connection.sender != user else connection.receiver
-        self.send_group(
-            recipient.username,
+        await self.send_group(
+            recipient,
             "voicecall.request",
             {
                 "caller": user.username,
@@ -346,298 +452,248 @@ class ChatConsumer(WebsocketConsumer):
                 "connectionId": connection_id,
             },
         )
-        print(f"Voice call request from {user.username} to {recipient.username} for room {room_id}")
+        logger.info(f"Voice call request from {user.username} to {recipient} for room {room_id}")
 
-    def receive_voicecall_accept(self, data):
+    async def receive_voicecall_accept(self, data):
         inner_data = data.get("data", {})
         connection_id = inner_data.get("connectionId")
         room_id = inner_data.get("roomId")
 
         if not connection_id:
             logger.error("No connection ID provided in receive_voicecall_accept")
-            self.send_error("Connection ID is required")
+            await self.send_error("Connection ID is required")
             return
 
         if not room_id:
             logger.error("No room ID provided in receive_voicecall_accept")
-            self.send_error("Room ID is required")
+            await self.send_error("Room ID is required")
             return
 
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+        caller = await self.get_peer_username(connection_id)
+        if caller is None:
             logger.error(f"Connection with ID {connection_id} does not exist in receive_voicecall_accept")
-            self.send_error("Connection not found")
+            await self.send_error("Connection not found")
             return
 
         user = self.scope["user"]
-        caller = connection.sender if connection.receiver == user else connection.receiver
-        self.send_group(
-            caller.username,
+        await self.send_group(
+            caller,
             "voicecall.accept",
             {"roomId": room_id, "connectionId": connection_id},
         )
-        logger.info(f"Voice call accepted by {user.username} from {caller.username} for room {room_id}")
+        logger.info(f"Voice call accepted by {user.username} from {caller} for room {room_id}")
 
-    def receive_voicecall_reject(self, data):
+    async def receive_voicecall_reject(self, data):
         inner_data = data.get("data", {})
         connection_id = inner_data.get("connectionId")
 
         if not connection_id:
             logger.error("No connection ID provided in receive_voicecall_reject")
-            self.send_error("Connection ID is required")
+            await self.send_error("Connection ID is required")
             return
 
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+        caller = await self.get_peer_username(connection_id)
+        if caller is None:
             logger.error(f"Connection with ID {connection_id} does not exist in receive_voicecall_reject")
-            self.send_error("Connection not found")
+            await self.send_error("Connection not found")
             return
 
         user = self.scope["user"]
-        caller = connection.sender if connection.receiver == user else connection.receiver
-        self.send_group(
-            caller.username,
+        await self.send_group(
+            caller,
             "voicecall.reject",
             {"connectionId": connection_id},
         )
-        logger.info(f"Voice call rejected by {user.username} from {caller.username}")
+        logger.info(f"Voice call rejected by {user.username} from {caller}")
 
-    def receive_voicecall_cancel(self, data):
+    async def receive_voicecall_cancel(self, data):
         inner_data = data.get("data", {})
         connection_id = inner_data.get("connectionId")
 
         if not connection_id:
             logger.error("No connection ID provided in receive_voicecall_cancel")
-            self.send_error("Connection ID is required")
+            await self.send_error("Connection ID is required")
             return
 
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+        recipient = await self.get_peer_username(connection_id)
+        if recipient is None:
             logger.error(f"Connection with ID {connection_id} does not exist in receive_voicecall_cancel")
-            self.send_error("Connection not found")
+            await self.send_error("Connection not found")
             return
 
         user = self.scope["user"]
-        recipient = connection.sender if connection.sender != user else connection.receiver
-        self.send_group(
-            recipient.username,
+        await self.send_group(
+            recipient,
             "voicecall.cancel",
             {"connectionId": connection_id},
         )
-        logger.info(f"Voice call canceled by {user.username} to {recipient.username}")
-        
-    def receive_call_request(self, data):
-    # Access the nested 'data' dictionary, default to {} if missing
+        logger.info(f"Voice call canceled by {user.username} to {recipient}")
+
+    async def receive_call_request(self, data):
+        # Access the nested 'data' dictionary, default to {} if missing
         inner_data = data.get('data', {})
         connection_id = inner_data.get('connectionId')
         room_id = inner_data.get('roomId')
-        
+
         # Validate that connection_id is provided
         if connection_id is None:
             logger.error("No connection ID provided in receive_call_request")
-            self.send_error('Connection ID is required')
+            await self.send_error('Connection ID is required')
             return
-        
+
         # Validate that room_id is provided
         if not room_id:
             logger.error("No room ID provided in receive_call_request")
-            self.send_error('Room ID is required')
+            await self.send_error('Room ID is required')
             return
-        
-        # Proceed with the logic (example implementation)
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+
+        recipient = await self.get_peer_username(connection_id)
+        if recipient is None:
             logger.error(f"Connection with ID {connection_id} does not exist")
-            self.send_error('Connection not found')
+            await self.send_error('Connection not found')
             return
-        
+
         user = self.scope['user']
-        recipient = connection.sender if connection.sender != user else connection.receiver
-        self.send_group(recipient.username, 'call.request', {
+        await self.send_group(recipient, 'call.request', {
             'caller': user.username,
             'roomId': room_id,
             'connectionId': connection_id
         })
-        logger.info(f"Call request from {user.username} to {recipient.username} for room {room_id}")
-        
-    def receive_call_accept(self, data):
+        logger.info(f"Call request from {user.username} to {recipient} for room {room_id}")
+
+    async def receive_call_accept(self, data):
         inner_data = data.get('data', {})
         connection_id = inner_data.get('connectionId')
         room_id = inner_data.get('roomId')
-        
+
         if not connection_id:
             logger.error("No connection ID provided in receive_call_accept")
-            self.send_error('Connection ID is required')
+            await self.send_error('Connection ID is required')
             return
-        
+
         if not room_id:
             logger.error("No room ID provided in receive_call_accept")
-            self.send_error('Room ID is required')
+            await self.send_error('Room ID is required')
             return
-        
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+
+        caller = await self.get_peer_username(connection_id)
+        if caller is None:
             logger.error(f"Connection with ID {connection_id} does not exist in receive_call_accept")
-            self.send_error('Connection not found')
+            await self.send_error('Connection not found')
             return
-        
+
         user = self.scope['user']
-        caller = connection.sender if connection.receiver == user else connection.receiver
-        
+
         # Notify caller that call is accepted
-        self.send_group(caller.username, 'call.accept', {
+        await self.send_group(caller, 'call.accept', {
             'roomId': room_id,
             'connectionId': connection_id
         })
-        logger.info(f"Call accepted by {user.username} from {caller.username} for room {room_id}")
-    
-    def receive_call_reject(self, data):
+        logger.info(f"Call accepted by {user.username} from {caller} for room {room_id}")
+
+    async def receive_call_reject(self, data):
         inner_data = data.get('data', {})
         connection_id = inner_data.get('connectionId')
-        
+
         if not connection_id:
             logger.error("No connection ID provided in receive_call_reject")
-            self.send_error('Connection ID is required')
+            await self.send_error('Connection ID is required')
             return
-        
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+
+        caller = await self.get_peer_username(connection_id)
+        if caller is None:
             logger.error(f"Connection with ID {connection_id} does not exist in receive_call_reject")
-            self.send_error('Connection not found')
+            await self.send_error('Connection not found')
             return
-        
+
         user = self.scope['user']
-        caller = connection.sender if connection.receiver == user else connection.receiver
-        
+
         # Notify caller that call is rejected
-        self.send_group(caller.username, 'call.reject', {
+        await self.send_group(caller, 'call.reject', {
             'connectionId': connection_id
         })
-        logger.info(f"Call rejected by {user.username} from {caller.username}")
-    def receive_call_cancel(self, data):
+        logger.info(f"Call rejected by {user.username} from {caller}")
+
+    async def receive_call_cancel(self, data):
         inner_data = data.get('data', {})
         connection_id = inner_data.get('connectionId')
-        
+
         if not connection_id:
             logger.error("No connection ID provided in receive_call_cancel")
-            self.send_error('Connection ID is required')
+            await self.send_error('Connection ID is required')
             return
-        
-        try:
-            connection = Connection.objects.get(id=connection_id)
-        except Connection.DoesNotExist:
+
+        recipient = await self.get_peer_username(connection_id)
+        if recipient is None:
             logger.error(f"Connection with ID {connection_id} does not exist in receive_call_cancel")
-            self.send_error('Connection not found')
+            await self.send_error('Connection not found')
             return
-        
+
         user = self.scope['user']
-        recipient = connection.sender if connection.sender != user else connection.receiver
-        
+
         # Notify recipient that call is canceled
-        self.send_group(recipient.username, 'call.cancel', {
+        await self.send_group(recipient, 'call.cancel', {
             'connectionId': connection_id
         })
-        logger.info(f"Call canceled by {user.username} to {recipient.username}")
-    
-    def get_preview_text(self, message):
-        if message.is_deleted:
-            return "Message deleted"
-        elif message.type == 'text':
-            return message.text
-        else:
-            return f"{message.type.capitalize()} message"
+        logger.info(f"Call canceled by {user.username} to {recipient}")
 
-    def disconnect(self, close_code):
-        if hasattr(self, 'username'):
-            async_to_sync(self.channel_layer.group_discard)(self.username, self.channel_name)
-            user = User.objects.get(username=self.username)
-            user.last_online = timezone.now()
-            user.is_online = False
-            user.save()
-            self.broadcast_online_status(self.username, False)
-
-    def send_initial_friend_status(self, user):
-        friends = Connection.objects.filter(
-            Q(sender=user) | Q(receiver=user), accepted=True
-        )
-        friend_usernames = [
-            friend.receiver.username if friend.sender == user else friend.sender.username
-            for friend in friends
-        ]
-        online_users = User.objects.filter(username__in=friend_usernames)
-        for friend in online_users:
-            is_online = friend.is_online and (timezone.now() - friend.last_online).total_seconds() < 300
-            self.send_group(user.username, 'online.status', {
-                'username': friend.username,
-                'online': is_online
-            })
-
-    def broadcast_online_status(self, username, online):
-        user = User.objects.get(username=username)
-        friends = Connection.objects.filter(
-            Q(sender=user) | Q(receiver=user), accepted=True
-        )
-        for friend in friends:
-            recipient = friend.receiver if friend.sender == user else friend.sender
-            async_to_sync(self.channel_layer.group_send)(
-                recipient.username,
-                {
-                    'type': 'broadcast_group',
-                    'message': {'source': 'online.status', 'data': {'username': username, 'online': online}}
-                }
-            )
-    def receive_message_delete(self, data):
+    @db_sync_to_async
+    def delete_message(self, message_id):
         user = self.scope['user']
-        message_id = data.get('messageId')
-        message = Message.objects.get(id=message_id, user=user)
+        message = Message.objects.select_related('connection__sender', 'connection__receiver', 'group').get(id=message_id, user=user)
         message.is_deleted = True
         message.save()
 
         if message.connection:
             recipient = message.connection.sender if message.connection.sender != user else message.connection.receiver
-            recipients = [user, recipient]
+            recipients = [user.username, recipient.username]
             connection_id = str(message.connection.id)
-            latest_message = Message.objects.filter(connection=message.connection, is_deleted=False).order_by('-created').first()
-            new_preview = self.get_preview_text(latest_message) if latest_message else 'No messages'
-            new_updated = latest_message.created.isoformat() if latest_message else message.connection.updated.isoformat()
         elif message.group:
-            recipients = message.group.members.all()
+            recipients = [chat_group_name(message.group.id)]
             connection_id = f'group_{message.group.id}'
-            latest_message = Message.objects.filter(group=message.group, is_deleted=False).order_by('-created').first()
-            new_preview = self.get_preview_text(latest_message) if latest_message else 'No messages'
-            new_updated = latest_message.created.isoformat() if latest_message else message.group.created.isoformat()
         else:
-            recipients = []
-            connection_id = None
+            return message.id, [], None, None, None, None
+        sync.touch(message)
+        new_preview, new_updated = inbox.record_delete(message)
+        return (
+            message.id, recipients, connection_id, new_preview,
+            new_updated.isoformat() if new_updated else None, message.change_seq,
+        )
+
+    async def receive_message_delete(self, data):
+        message_id, recipients, connection_id, new_preview, new_updated, change_seq = await self.delete_message(
+            data.get('messageId')
+        )
 
         # Update friend preview and broadcast deletion
-        for recipient in recipients:
-            self.send_group(recipient.username, 'friend.preview.update', {
-                'connectionId': connection_id,
-                'preview': new_preview,
-                'updated': new_updated
-            })
-            self.send_group(recipient.username, 'message.delete', {
-                'messageId': message.id,
-                'connectionId': connection_id
-            })
+        await self.send_groups(recipients, 'friend.preview.update', {
+            'connectionId': connection_id,
+            'preview': new_preview,
+            'updated': new_updated
+        })
+        await self.send_groups(recipients, 'message.delete', {
+            'messageId': message_id,
+            'connectionId': connection_id,
+            'changeSeq': change_seq,
+        })
 
-    def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.closing:
+            # Frames already queued behind a rate-limit close
+            return
         try:
-            data = json.loads(text_data)
+            data = decode_frame(text_data, bytes_data, self.codec)
             data_source = data.get('source')
-            logger.info('receive: %s', json.dumps(data, indent=2))
+            logger.info('receive: %s', data)
 
             handlers = {
                 'friend.list': self.receive_friend_list,
                 'message.list': self.receive_message_list,
+                'message.context': self.receive_message_context,
+                'sync': self.receive_sync,
+                'mailbox.ack': self.receive_mailbox_ack,
                 'message.send': self.receive_message_send,
+                'message.forward': self.receive_message_forward,
                 'message.type': self.receive_message_type,
                 'request.accept': self.receive_request_accept,
                 'request.connect': self.receive_request_connect,
@@ -645,9 +701,10 @@ class ChatConsumer(WebsocketConsumer):
                 'search': self.receive_search,
                 'thumbnail': self.receive_thumbnail,
                 'image': self.receive_image,
-                'online.status': self.receive_online_status,
+                'presence.snapshot': self.receive_presence_snapshot,
+                # Older clients still ask for online.status; they get the snapshot too
+                'online.status': self.receive_presence_snapshot,
                 'groups.create': self.receive_group_create,
-                'call.reject': self.receive_call_reject,
                 'message.edit': self.receive_message_edit,
                 'message.delete': self.receive_message_delete,
                 'call.request': self.receive_call_request,
@@ -661,239 +718,493 @@ class ChatConsumer(WebsocketConsumer):
             }
 
             handler = handlers.get(data_source)
+            if not self.limiter.allow(data_source if handler else None):
+                await self.reject_over_limit(data_source if handler else None)
+                return
             if handler:
-                handler(data)
+                await handler(data)
             else:
                 logger.warning(f"Unknown source: {data_source}")
-                self.send_error("Unknown source")
+                await self.send_error("Unknown source")
         except json.JSONDecodeError as e:
             logger.error(f"JSON decode error: {e}")
-            self.send_error("Invalid JSON format")
+            await self.send_error("Invalid JSON format")
+        except FrameDecodeError as e:
+            logger.error(f"{self.codec} decode error: {e}")
+            await self.send_error("Invalid JSON format" if self.codec == JSON else "Invalid msgpack format")
         except Exception as e:
             logger.error(f"Error in receive: {e}")
-            self.send_error("Server error")
-            
+            await self.send_error("Server error")
 
-
-    # Update the receive_message_edit method in ChatConsumer
-    def receive_message_edit(self, data):
+    @db_sync_to_async
+    def edit_message(self, message_id, new_text):
         user = self.scope['user']
-        message_id = data.get('messageId')
-        new_text = data.get('newText')
-        message = Message.objects.get(id=message_id, user=user)
+        message = Message.objects.for_serialization().select_related(
+            'connection__sender', 'connection__receiver', 'group'
+        ).get(id=message_id, user=user)
         message.text = new_text
         message.save()
-        serialized_message = MessageSerializer(message, context={'user': user}).data
-
-        connection_id = None
-        recipients = []
-        new_preview = None
-        new_updated = None
+        sync.touch(message)
+        serialized_message, author_message = message_variants(serialize_message(message))
 
         if message.connection:
             connection = message.connection
             connection_id = str(connection.id)
             recipient = connection.sender if connection.sender != user else connection.receiver
-            recipients = [user, recipient]
-            latest_message = Message.objects.filter(connection=connection, is_deleted=False).order_by('-created').first()
+            recipients = [user.username, recipient.username]
         elif message.group:
             group = message.group
             connection_id = f'group_{group.id}'
-            recipients = group.members.all()
-            latest_message = Message.objects.filter(group=group, is_deleted=False).order_by('-created').first()
+            recipients = [chat_group_name(group.id)]
         else:
+            return None
+
+        preview_update = None
+        if inbox.record_edit(message):
+            preview_update = {
+                'connectionId': connection_id,
+                'preview': inbox.preview_text(message),
+                'updated': message.created.isoformat(),
+                'messageId': message.id  # Include message ID for validation
+            }
+        update_event = envelope(
+            'message.update', {'message': serialized_message},
+            author=user.username, author_data={'message': author_message}
+        )
+        return update_event, recipients, preview_update
+
+    async def receive_message_edit(self, data):
+        result = await self.edit_message(data.get('messageId'), data.get('newText'))
+        if result is None:
             return
+        update_event, recipients, preview_update = result
 
         # Update preview if edited message is the latest
-        if latest_message and latest_message.id == message.id:
-            new_preview = self.get_preview_text(message)
-            new_updated = message.created.isoformat()
-            
-            # Send friend.preview.update to all participants
-            for recipient in recipients:
-                self.send_group(recipient.username, 'friend.preview.update', {
-                    'connectionId': connection_id,
-                    'preview': new_preview,
-                    'updated': new_updated,
-                    'messageId': message.id  # Include message ID for validation
-                })
+        if preview_update:
+            await self.send_groups(recipients, 'friend.preview.update', preview_update)
 
         # Always send message.update
-        for recipient in recipients:
-            self.send_group(recipient.username, 'message.update', {
-                'message': serialized_message
-            })
-                    
-
-    # def receive_message_edit(self, data):
-    #     user = self.scope['user']
-    #     message_id = data.get('messageId')
-    #     new_text = data.get('newText')
-    #     message = Message.objects.get(id=message_id, user=user)
-    #     message.text = new_text
-    #     message.save()
-    #     serialized_message = MessageSerializer(message, context={'user': user}).data
-
-    #     if message.connection:
-    #         recipient = message.connection.sender if message.connection.sender != user else message.connection.receiver
-    #         recipients = [user, recipient]
-    #         connection_id = str(message.connection.id)
-    #         latest_message = Message.objects.filter(connection=message.connection, is_deleted=False).order_by('-created').first()
-    #     elif message.group:
-    #         recipients = message.group.members.all()
-    #         connection_id = f'group_{message.group.id}'
-    #         latest_message = Message.objects.filter(group=message.group, is_deleted=False).order_by('-created').first()
-    #     else:
-    #         recipients = []
-    #         connection_id = None
-
-    #     # Send friend.preview.update if the edited message is the latest
-    #     if latest_message and latest_message.id == message.id:
-    #         print(f"Sending friend.preview.update: connectionId={connection_id}, preview={new_preview}, updated={new_updated}")
-
-    #         new_preview = self.get_preview_text(message)
-    #         new_updated = message.created.isoformat()
-    #         logger.info(f"Sending friend.preview.update - connectionId: {connection_id}, preview: {new_preview}, messageId: {message.id}")
-    #         for recipient in recipients:
-    #             self.send_group(recipient.username, 'friend.preview.update', {
-    #                 'connectionId': connection_id,
-    #                 'preview': new_preview,
-    #                 'updated': new_updated,
-    #             })
-
-    #     # Always send message.update
-    #     for recipient in recipients:
-    #         self.send_group(recipient.username, 'message.update', {'message': serialized_message})
-            
-    # def receive_call_reject(self, data):
-    #     recipient_username = data.get('recipient')
-    #     roomId = data.get('roomId')
-    #     self.send_group(recipient_username, 'call.rejected', {'roomId': roomId})
-    #     logger.info(f"Call rejection sent to {recipient_username} for room {roomId}")
-
-    def send_group(self, group, source, data):
-        serialized_data = serialize_datetime(data)
-        response = {'source': source, 'data': serialized_data}
-        try:
-            async_to_sync(self.channel_layer.group_send)(
-                group, {'type': 'broadcast_group', 'message': response}
-            )
-        except Exception as e:
-            logger.error(f"Error sending group message: {e}")
-
-    def send_error(self, message):
-        self.send(text_data=json.dumps({'source': 'error', 'data': {'message': message}}))
+        await mailbox.send_or_hold(self.channel_layer, recipients, update_event)
+
+    async def send_group(self, group, source, data, skip=None, collapse=None):
+        """
+        Send a frame to every socket in ``group``, except those of the user named ``skip``.
+
+        Frames with a ``collapse`` key only need their latest value delivered: a receiving
+        socket that still has one with the same key queued replaces it.
+        """
+        event = {'type': 'broadcast_group', 'message': {'source': source, 'data': data}}
+        if skip:
+            event['skip'] = skip
+        if collapse:
+            event['collapse'] = collapse
+        if group == self.username:
+            await self.channel_layer.group_send(group, event)
+            return
+        await asyncio.gather(self.channel_layer.group_send(group, event), mailbox.hold([group], event))
+
+    async def send_groups(self, groups, source, data, collapse=None):
+        """Fan one frame out to many groups in a single channel-layer call, encoded once."""
+        event = envelope(source, data)
+        if collapse:
+            event['collapse'] = collapse
+        await asyncio.gather(
+            group_send_many(self.channel_layer, groups, event),
+            mailbox.hold([group for group in groups if group != self.username], event),
+        )
 
-    def broadcast_group(self, event):
-        message = event['message']
-        serialized_message = serialize_datetime(message)
-        self.send(text_data=json.dumps(serialized_message))
+    async def send_frame(self, frame, policy=RELIABLE, key=None):
+        """Queue ``frame`` for this socket in the encoding it negotiated on connect."""
+        text_data, bytes_data = encode_frame(frame, self.codec)
+        self.outbound.put(text_data, bytes_data, policy, key)
+
+    async def reject_over_limit(self, source):
+        """Refuse a frame over its rate limit, closing sockets that keep doing it."""
+        if not self.limiter.strike():
+            logger.warning(f"Closing socket of {self.username}: rate limits exceeded repeatedly")
+            self.closing = True
+            await self.close(code=4008)  # 1008 policy violation, in the application range
+            return
+        await self.send_frame({'source': 'error', 'data': {
+            'message': 'Rate limit exceeded',
+            'limitedSource': source,
+            'retryAfter': self.limiter.bucket(source).retry_after(),
+        }})
 
+    async def send_error(self, message):
+        await self.send_frame({'source': 'error', 'data': {'message': message}})
 
-    def receive_message_send(self, data):
+    async def broadcast_group(self, event):
+        if event.get('skip') == self.username:
+            return
+        policy, key = (LATEST, event['collapse']) if 'collapse' in event else (RELIABLE, None)
+        if 'text' in event:
+            # Pre-encoded envelope; the author's own sockets get their variant of the frame
+            if 'author_text' in event and event['author'] == self.username:
+                text = event['author_text']
+            else:
+                text = event['text']
+            if self.codec == JSON:
+                self.outbound.put(text, None, policy, key)
+            else:
+                # Envelopes stay JSON-only so fanout cost does not depend on which
+                # codecs are connected; binary sockets re-encode the decoded frame
+                await self.send_frame(loads(text), policy, key)
+            return
+        await self.send_frame(event['message'], policy, key)
+
+    async def read_receipt(self, event):
+        """
+        Queue a read receipt from another member. Receipts are held for
+        CHAT_READ_RECEIPT_DELAY and only the furthest cursor per reader and
+        conversation is sent, so a burst of reads becomes one frame.
+        """
+        if event['username'] == self.username:
+            return
+        key = (event['connectionId'], event['username'])
+        pending = self.pending_receipts.get(key)
+        if pending is None or event['lastReadMessageId'] > pending['lastReadMessageId']:
+            self.pending_receipts[key] = {k: v for k, v in event.items() if k != 'type'}
+        if self.receipt_flush is None:
+            self.receipt_flush = asyncio.ensure_future(self.flush_read_receipts())
+
+    async def flush_read_receipts(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_READ_RECEIPT_DELAY', 0.5))
+        receipts, self.pending_receipts = self.pending_receipts, {}
+        self.receipt_flush = None
+        for receipt in receipts.values():
+            await self.send_frame({'source': 'message.read', 'data': receipt})
+
+    def insert_message(self, conversation, client_message_id, **fields):
+        """
+        Create a message of this user with the next sequence number of ``conversation``
+        (``sync.allocate`` keyword arguments). If the user already sent one with
+        ``client_message_id``, return that instead. Returns ``(message, created)``.
+        """
         user = self.scope['user']
-        connection_id = data.get('connectionId')
-        message_text = data.get('message')
-        type_ = data.get('type', 'text')
-        replied_to_id = data.get('replied_to')
-        is_group = data.get('isGroup', False)
-        incognito = data.get('incognito', False)
-        disappearing = data.get('disappearing', None)
-
-        # Determine recipients and create message
+        if client_message_id:
+            try:
+                return Message.objects.get(user=user, client_message_id=client_message_id), False
+            except Message.DoesNotExist:
+                pass
+        try:
+            with transaction.atomic():
+                seq = sync.allocate(**conversation)
+                message = Message.objects.create(
+                    user=user, client_message_id=client_message_id, seq=seq, change_seq=seq, **fields
+                )
+        except IntegrityError:
+            if not client_message_id:
+                raise
+            # A concurrent retry inserted it between the lookup and the insert
+            return Message.objects.get(user=user, client_message_id=client_message_id), False
+        return message, True
+
+    @db_sync_to_async
+    def create_message(self, connection_id, message_text, type_, replied_to_id, is_group, incognito, disappearing,
+                       client_message_id=None):
+        """
+        Persist an outgoing message and serialize it once, without a viewer. Incognito
+        messages are only serialized, never stored.
+
+        Returns None when the 1:1 connection does not exist. ``created`` is False when
+        ``client_message_id`` matched a message sent earlier, which is returned unchanged.
+        """
+        user = self.scope['user']
+        replied_to = Message.objects.select_related('user').get(id=replied_to_id) if replied_to_id else None
         if is_group:
             group = Group.objects.get(id=connection_id.replace('group_', ''))
-            message = Message.objects.create(
-                group=group, user=user, text=message_text, type=type_,
-                replied_to=Message.objects.get(id=replied_to_id) if replied_to_id else None,
-                incognito=incognito, disappearing=disappearing
-            )
-            recipients = group.members.exclude(username=user.username)
+            conversation = {'group': group}
+            recipients = list(group.members.exclude(username=user.username))
             friend_data = {'username': group.name}
             group_name = group.name
+            chat_group = chat_group_name(group.id)
         else:
             try:
-                connection = Connection.objects.get(id=connection_id)
+                connection = Connection.objects.select_related('sender', 'receiver').get(id=connection_id)
             except Connection.DoesNotExist:
-                logger.error(f"Connection with ID {connection_id} does not exist in receive_message_send")
-                self.send_error('Connection not found')
-                return
+                return None
             recipient = connection.sender if connection.sender != user else connection.receiver
-            BlockedUser.objects.filter(user=user, blocked_user=recipient).exists()
-            message = Message.objects.create(
-                connection=connection, user=user, text=message_text, type=type_,
-                replied_to=Message.objects.get(id=replied_to_id) if replied_to_id else None,
-                incognito=incognito, disappearing=disappearing
-            )
+            conversation = {'connection': connection}
             recipients = [recipient]
-            friend_data = UserSerializer(recipient).data
+            friend_data = serialize_user(recipient)
             group_name = None
+            chat_group = None
+
+        if incognito:
+            # Never stored: delivered through the channel layer and chat.ephemeral only
+            created = True
+            message_id = ephemeral.new_message_id()
+            message_data = incognito_message_data(message_id, message_text, type_, replied_to, disappearing)
+        else:
+            message, created = self.insert_message(
+                {f'{kind}_id': target.id for kind, target in conversation.items()}, client_message_id,
+                text=message_text, type=type_, replied_to=replied_to, disappearing=disappearing,
+                expires_at=expiry.expires_at(disappearing), **conversation
+            )
+            message_id = message.id
+            message_data = serialize_message(Message.objects.for_serialization().get(pk=message.pk))
+            if created:
+                inbox.record_message(message, recipients + [user])
+                recent.added(message, message_data)
+
+        # Only push to recipients with an FCM token that the sender has not blocked
+        pushes = []
+        if created:
+            blocked = blocks.blocked_ids(user.pk)
+            pushes = [
+                (recipient.username, recipient.fcm_token)
+                for recipient in recipients
+                if recipient.fcm_token and recipient.pk not in blocked
+            ]
+
+        return {
+            'created': created,
+            'message_id': message_id,
+            'group_name': group_name,
+            # chatgroup_<id> for group chats, otherwise both participants' user groups
+            'targets': [chat_group] if chat_group else [recipients[0].username, user.username],
+            'recipients': {recipient.pk: recipient.username for recipient in recipients},
+            'friend_data': friend_data,
+            'sender_data': serialize_user(user),
+            'message': message_data,
+            'pushes': pushes,
+        }
+
+    async def receive_message_send(self, data):
+        user = self.scope['user']
+        connection_id = data.get('connectionId')
+        message_text = data.get('message')
+        type_ = data.get('type', 'text')
+        replied_to_id = data.get('replied_to')
+        is_group = data.get('isGroup', False)
+        incognito = data.get('incognito', False)
+        disappearing = data.get('disappearing', None)
+        client_message_id = data.get('clientMessageId') or None
+        if client_message_id is not None and (not isinstance(client_message_id, str) or len(client_message_id) > 64):
+            await self.send_error('Invalid clientMessageId')
+            return
+
+        # Determine recipients and create message
+        result = await self.create_message(
+            connection_id, message_text, type_, replied_to_id, is_group, incognito, disappearing, client_message_id
+        )
+        if result is None:
+            logger.error(f"Connection with ID {connection_id} does not exist in receive_message_send")
+            await self.send_error('Connection not found')
+            return
+        group_name = result['group_name']
+
+        message_data, author_message_data = message_variants(result['message'])
+        author_data = {'message': author_message_data, 'friend': result['friend_data'], 'connectionId': connection_id}
+        if client_message_id:
+            author_data['clientMessageId'] = client_message_id
+        if not result['created']:
+            # A retry of a message that was already sent: answer this socket only, notify nobody again
+            await self.send_frame({'source': 'message.send', 'data': author_data})
+            return
+
+        # Notify recipients and sender with one envelope
+        event = envelope(
+            'message.send',
+            {'message': message_data, 'friend': result['sender_data'], 'connectionId': connection_id},
+            author=user.username, author_data=author_data,
+        )
+        await group_send_many(self.channel_layer, result['targets'], event)
+        # The typist has sent what they were typing
+        await self.stop_typing(result['targets'])
+        if incognito:
+            # sync cannot recover it later, so keep it briefly for recipients who are reconnecting
+            await ephemeral.hold(result['recipients'], event['text'])
 
         # Prepare notification details
         sender_name = user.username
         notification_title = f"{sender_name} sent a {type_.capitalize()}"
         if is_group:
             notification_title = f"{sender_name} sent a {type_.capitalize()} in {group_name}"
-        
+
         timestamp = timezone.now().strftime('%I:%M %p')
         notification_body = self.get_notification_body(type_, message_text, timestamp)
-        
-        thumbnail_url = f"https://{settings.SITE_DOMAIN}{settings.MEDIA_URL}{user.thumbnail}" if user.thumbnail else ""
-        custom_payload = {
-            "message": {
-                "token": None,  # Will be set per recipient
-                "notification": {
-                    "title": notification_title,
-                    "body": notification_body
-                },
-                "data": {
-                    "connectionId": str(connection_id),
-                    "messageId": str(message.id),
-                    "sender": sender_name,
-                    "senderThumbnail": thumbnail_url,
-                    "content": message_text,
-                    "type": type_,
-                    "timestamp": timestamp,
-                    "isGroup": str(is_group),
-                    "groupName": group_name if is_group else "",
-                    "click_action": "OPEN_CHAT"
-                },
-                "android": {"priority": "high"},
-                "apns": {"headers": {"apns-priority": "10"}}
-            }
-        }
 
-        # Notify recipients
-        for recipient in recipients:
-            serialized_message = MessageSerializer(message, context={'user': recipient}).data
-            self.send_group(recipient.username, 'message.send', {
-                'message': serialized_message,
-                'friend': UserSerializer(user).data,
-                'connectionId': connection_id
-            })
-            
-            # Check if recipient has an FCM token and is not blocked
-            if recipient.fcm_token and not BlockedUser.objects.filter(user=user, blocked_user=recipient).exists():
-                custom_payload["message"]["token"] = recipient.fcm_token
-                result = send_fcm_notification(
-                    fcm_token=recipient.fcm_token,
-                    title=notification_title,
-                    body=notification_body,
-                    custom_payload=custom_payload
-                )
-                if result:
-                    logger.info(f"Notification sent to {recipient.username}")
-                else:
-                    logger.error(f"Failed to send notification to {recipient.username}")
-
-        # Notify sender
-        serialized_message = MessageSerializer(message, context={'user': user}).data
-        self.send_group(user.username, 'message.send', {
-            'message': serialized_message,
-            'friend': friend_data,
-            'connectionId': connection_id
+        await self.send_pushes(result['pushes'], notification_title, notification_body, {
+            "connectionId": str(connection_id),
+            "messageId": str(result['message_id']),
+            "sender": sender_name,
+            "senderThumbnail": self.thumbnail_url(user),
+            "content": message_text,
+            "type": type_,
+            "timestamp": timestamp,
+            "isGroup": str(is_group),
+            "groupName": group_name if is_group else "",
+            "click_action": "OPEN_CHAT"
         })
 
+    def thumbnail_url(self, user):
+        return f"https://{settings.SITE_DOMAIN}{settings.MEDIA_URL}{user.thumbnail}" if user.thumbnail else ""
+
+    async def send_pushes(self, pushes, title, body, data):
+        """Send one FCM notification per ``(username, fcm_token)`` in ``pushes``, concurrently."""
+        async def push(recipient, push_token):
+            notification = await http_sync_to_async(send_fcm_notification)(
+                fcm_token=push_token,
+                title=title,
+                body=body,
+                custom_payload={
+                    "message": {
+                        "token": push_token,
+                        "notification": {"title": title, "body": body},
+                        "data": data,
+                        "android": {"priority": "high"},
+                        "apns": {"headers": {"apns-priority": "10"}}
+                    }
+                }
+            )
+            if notification:
+                logger.info(f"Notification sent to {recipient}")
+            else:
+                logger.error(f"Failed to send notification to {recipient}")
+
+        await asyncio.gather(*(push(recipient, push_token) for recipient, push_token in pushes))
+
+    @db_sync_to_async
+    def forward_message(self, message_id, connection_ids):
+        """
+        Copy a message the user can see into each conversation of ``connection_ids``
+        (``"<connection id>"`` or ``"group_<id>"``) they belong to. All copies are
+        inserted with one ``bulk_create`` and share the original's media file.
+
+        Returns None when the message is not visible to the user. Raises ValueError
+        for malformed or too many ids.
+        """
+        user = self.scope['user']
+        if not isinstance(connection_ids, list) or len(connection_ids) > getattr(settings, 'CHAT_FORWARD_MAX_TARGETS', 50):
+            raise ValueError('connectionIds must be a list of at most CHAT_FORWARD_MAX_TARGETS ids')
+        requested = {}
+        for key in dict.fromkeys(map(str, connection_ids)):
+            requested[key] = ('group', int(key[len('group_'):])) if key.startswith('group_') else ('connection', int(key))
+
+        original = Message.objects.filter(
+            Q(connection__sender=user) | Q(connection__receiver=user) | Q(group__members=user),
+            id=int(message_id), is_deleted=False, incognito=False,
+        ).first()
+        if original is None:
+            return None
+
+        wanted = {kind: [pk for k, pk in requested.values() if k == kind] for kind in ('connection', 'group')}
+        connections = Connection.objects.select_related('sender', 'receiver').filter(
+            Q(sender=user) | Q(receiver=user), id__in=wanted['connection'], accepted=True
+        )
+        groups = Group.objects.prefetch_related('members').filter(members=user, id__in=wanted['group'])
+        # (connectionId, conversation kwargs, participants, channel-layer targets, friend data, group name)
+        conversations = [
+            (str(connection.id), {'connection': connection},
+             [connection.receiver if connection.sender_id == user.pk else connection.sender, user],
+             [connection.sender.username, connection.receiver.username], None, None)
+            for connection in connections.order_by('id')
+        ] + [
+            (f'group_{group.id}', {'group': group}, list(group.members.all()),
+             [chat_group_name(group.id)], {'username': group.name}, group.name)
+            for group in groups.order_by('id')
+        ]
+
+        fields = {
+            'user': user, 'text': original.text, 'type': original.type,
+            'media_file': original.media_file.name or None, 'disappearing': original.disappearing,
+            'expires_at': expiry.expires_at(original.disappearing),
+        }
+        with transaction.atomic():
+            # Counters are taken in id order, so concurrent forwards cannot deadlock on them
+            copies = []
+            for _, conversation, *_ in conversations:
+                seq = sync.allocate(**{f'{kind}_id': target.id for kind, target in conversation.items()})
+                copies.append(Message(seq=seq, change_seq=seq, **conversation, **fields))
+            Message.objects.bulk_create(copies)
+        for copy, (_, _, participants, *_) in zip(copies, conversations):
+            inbox.record_message(copy, participants)
+
+        stored = list(Message.objects.for_serialization().filter(pk__in=[copy.pk for copy in copies]))
+        serialized = {message.pk: data for message, data in zip(stored, serialize_messages(stored))}
+        for copy in copies:
+            recent.added(copy, serialized[copy.pk])
+        pushed = {user.pk} | blocks.blocked_ids(user.pk)
+        forwarded = []
+        for copy, (key, _, participants, targets, friend_data, group_name) in zip(copies, conversations):
+            # One push per recipient, however many of the forwarded-to conversations they share
+            pushes = []
+            for participant in participants:
+                if participant.pk not in pushed and participant.fcm_token:
+                    pushed.add(participant.pk)
+                    pushes.append((participant.username, participant.fcm_token))
+            forwarded.append({
+                'connectionId': key,
+                'message': serialized[copy.pk],
+                'targets': targets,
+                'friend_data': friend_data or serialize_user(participants[0]),
+                'group_name': group_name,
+                'pushes': pushes,
+            })
+        return {
+            'type': original.type,
+            'text': original.text,
+            'sender_data': serialize_user(user),
+            'forwarded': forwarded,
+            'skipped': [key for key in requested if key not in {entry['connectionId'] for entry in forwarded}],
+        }
+
+    async def receive_message_forward(self, data):
+        """Forward one message to many conversations: one insert, one fanout per copy, one push per recipient."""
+        user = self.scope['user']
+        try:
+            result = await self.forward_message(data.get('messageId'), data.get('connectionIds'))
+        except (TypeError, ValueError):
+            await self.send_error('Invalid messageId or connectionIds')
+            return
+        if result is None:
+            await self.send_error('Message not found')
+            return
+
+        sender_data = result['sender_data']
+        events = []
+        for entry in result['forwarded']:
+            message_data, author_message_data = message_variants(entry['message'])
+            connection_id = entry['connectionId']
+            events.append(group_send_many(self.channel_layer, entry['targets'], envelope(
+                'message.send',
+                {'message': message_data, 'friend': sender_data, 'connectionId': connection_id},
+                author=user.username,
+                author_data={'message': author_message_data, 'friend': entry['friend_data'], 'connectionId': connection_id},
+            )))
+        await asyncio.gather(*events)
+        await self.send_frame({'source': 'message.forward', 'data': {
+            'messageId': data.get('messageId'),
+            'forwarded': {entry['connectionId']: entry['message']['id'] for entry in result['forwarded']},
+            'skipped': result['skipped'],
+        }})
+
+        type_ = result['type']
+        timestamp = timezone.now().strftime('%I:%M %p')
+        notification_body = self.get_notification_body(type_, result['text'], timestamp)
+        pushes = []
+        for entry in result['forwarded']:
+            if not entry['pushes']:
+                continue
+            title = f"{user.username} forwarded a {type_.capitalize()}"
+            if entry['group_name']:
+                title = f"{title} in {entry['group_name']}"
+            pushes.append(self.send_pushes(entry['pushes'], title, notification_body, {
+                "connectionId": entry['connectionId'],
+                "messageId": str(entry['message']['id']),
+                "sender": user.username,
+                "senderThumbnail": self.thumbnail_url(user),
+                "content": result['text'],
+                "type": type_,
+                "timestamp": timestamp,
+                "isGroup": str(bool(entry['group_name'])),
+                "groupName": entry['group_name'] or "",
+                "click_action": "OPEN_CHAT"
+            }))
+        await asyncio.gather(*pushes)
+
     def get_notification_body(self, type_, message_text, timestamp):
         """Generate notification body based on message type."""
         if type_ == 'text':
@@ -908,136 +1219,346 @@ class ChatConsumer(WebsocketConsumer):
             return f"Join to {type_} together | {timestamp}"
         return f"{message_text} | {timestamp}"
 
-    def send_group(self, group, source, data):
-        async_to_sync(self.channel_layer.group_send)(
-            group, {'type': 'broadcast_group', 'message': {'source': source, 'data': data}}
-        )
-
-    def broadcast_group(self, event):
-        self.send(text_data=json.dumps(event['message']))
-        
-    def receive_friend_list(self, data):
+    @db_sync_to_async
+    def get_friend_list(self, limit, cursor):
+        """
+        Read the inbox. Without ``limit`` or ``cursor`` this is the whole list, as
+        older clients expect; otherwise one page with its ``next`` cursor.
+        """
         user = self.scope['user']
-        latest_message = Message.objects.filter(connection=OuterRef('id'), is_deleted=False).order_by('-created')[:1]
-        connections = Connection.objects.filter(
-            Q(sender=user) | Q(receiver=user), accepted=True
-        ).annotate(
-            latest_text=latest_message.values('text'),
-            latest_type=latest_message.values('type'),
-            latest_created=latest_message.values('created')
-        ).order_by(Coalesce('latest_created', 'updated').desc())
-        groups = Group.objects.filter(members=user)
-        group_connections = [
-            {
-                'id': f'group_{group.id}',
-                'friend': {'username': group.name, 'name': group.name, 'thumbnail': None, 'online': True},
-                'preview': self.get_group_preview(group),
-                'updated': group.created.isoformat(),  # Fixed here
-                'unread_count': group.messages.filter(seen=False).exclude(user=user).count()
-            } for group in groups
-        ]
-        serialized = FriendSerializer(connections, context={'user': user}, many=True)
-        friend_list = serialized.data + group_connections
-        self.send_group(user.username, 'friend.list', friend_list)
-        
-        
-    def get_group_preview(self, group):
-        latest_message = group.messages.filter(is_deleted=False).order_by('-created').first()
-        if latest_message:
-            return self.get_preview_text(latest_message)
-        return 'Group created'
-
-    def receive_message_list(self, data):
+        if limit is None and cursor is None:
+            return inbox.friend_list(user)
+        return inbox.friend_page(user, limit or inbox.DEFAULT_PAGE_SIZE, cursor)
+
+    async def receive_friend_list(self, data):
+        try:
+            friend_list = await self.get_friend_list(data.get('limit'), data.get('cursor'))
+        except ValueError:
+            await self.send_error('Invalid cursor or limit')
+            return
+        await self.send_group(self.username, 'friend.list', friend_list)
+
+    def load_conversation(self, connectionId):
+        """
+        Return the messages of a connection or group together with the ``friend``,
+        ``is_blocked`` and ``i_blocked_friend`` fields of a message page and the
+        Connection or Group itself, or an error string for the client. Conversations
+        the user is not part of are reported as not found.
+        """
         user = self.scope['user']
-        connectionId = data.get('connectionId')
-        page = data.get('page', 0)
-        page_size = 15
         connectionId_str = str(connectionId)
 
         if connectionId_str.startswith('group_'):
             group_id = connectionId_str.replace('group_', '')
             try:
-                group = Group.objects.get(id=group_id)
-                messages = Message.objects.filter(group=group).order_by('-created')[page * page_size:(page + 1) * page_size]
-                recipient = {'username': group.name, 'thumbnail': None}
-                messages_count = Message.objects.filter(group=group).count()
-                is_blocked = False
-                i_blocked_friend = False
+                group = Group.objects.filter(members=user).get(id=group_id)
             except Group.DoesNotExist:
-                self.send_error('Group not found')
-                return
-        else:
-            try:
-                connection = Connection.objects.get(id=int(connectionId))
-                messages = Message.objects.filter(connection=connection).order_by('-created')[page * page_size:(page + 1) * page_size]
-                recipient = connection.sender if connection.sender != user else connection.receiver
-                messages_count = Message.objects.filter(connection=connection).count()
-                is_blocked = BlockedUser.objects.filter(user=recipient, blocked_user=user).exists()
-                i_blocked_friend = BlockedUser.objects.filter(user=user, blocked_user=recipient).exists()
-            except Connection.DoesNotExist:
-                self.send_error('Connection not found')
-                return
+                return 'Group not found'
+            return Message.objects.for_serialization().filter(group=group), {
+                'friend': {'username': group.name},
+                'is_blocked': False,
+                'i_blocked_friend': False,
+            }, group
 
-        serialized_messages = MessageSerializer(messages, context={'user': user}, many=True)
-        serialized_friend = UserSerializer(recipient) if not connectionId_str.startswith('group_') else {'username': recipient['username']}
-        next_page = page + 1 if messages_count > (page + 1) * page_size else None
-        data_response = {
-            'messages': serialized_messages.data,
+        try:
+            connection = Connection.objects.select_related('sender', 'receiver').filter(
+                Q(sender=user) | Q(receiver=user)
+            ).get(id=int(connectionId))
+        except Connection.DoesNotExist:
+            return 'Connection not found'
+        recipient = connection.sender if connection.sender != user else connection.receiver
+        return Message.objects.for_serialization().filter(connection=connection), {
+            'friend': serialize_user(recipient),
+            'is_blocked': blocks.is_blocked(recipient.pk, user.pk),
+            'i_blocked_friend': blocks.is_blocked(user.pk, recipient.pk),
+        }, connection
+
+    def message_page(self, messages, header, next_page, more_older, more_newer):
+        """
+        ``before``/``after`` are the message ids to anchor the next older/newer
+        request on, or None when there is nothing more in that direction.
+        """
+        return {
+            'messages': serialize_messages(messages, self.scope['user']),
             'next': next_page,
-            'friend': serialized_friend.data,
-            'is_blocked': is_blocked,
-            'i_blocked_friend': i_blocked_friend,
+            **header,
+            'before': messages[-1].id if messages and more_older else None,
+            'after': messages[0].id if messages and more_newer else None,
         }
-        self.send_group(user.username, 'message.list', data_response)
 
-    def receive_message_type(self, data):
+    @db_sync_to_async
+    def get_message_list(self, connectionId, page, before=None, after=None, size=None):
+        """
+        Build the ``message.list`` payload, or return an error string for the client.
+
+        With a ``before`` or ``after`` message id this is a keyset page on that
+        anchor. Otherwise ``page`` is the legacy page number, still supported for
+        older clients but without the COUNT query it used to need.
+        """
+        loaded = self.load_conversation(connectionId)
+        if isinstance(loaded, str):
+            return loaded
+        messages, header, conversation = loaded
+        size = history.page_size(size)
+
+        if before is None and after is None and page == 0:
+            return self.newest_page(messages, header, conversation, size)
+        if before is None and after is None:
+            page_messages = list(messages.order_by('-created', '-id')[page * size:(page + 1) * size + 1])
+            more_older = len(page_messages) > size
+            page_messages = page_messages[:size]
+            return self.message_page(page_messages, header, page + 1 if more_older else None, more_older, page > 0)
+
+        anchor = history.anchor(messages, int(after if after is not None else before))
+        if anchor is None:
+            return 'Message not found'
+        if after is not None:
+            page_messages, more_newer = history.newer(messages, anchor, size)
+            return self.message_page(page_messages, header, None, True, more_newer)
+        page_messages, more_older = history.older(messages, anchor, size)
+        return self.message_page(page_messages, header, None, more_older, True)
+
+    def newest_page(self, messages, header, conversation, size):
+        """
+        Page 0 of ``message.list``, from the hot-conversation cache when it holds the
+        conversation at its current ``last_seq``. A miss reads enough messages to refill it.
+        """
         user = self.scope['user']
-        recipient_username = data.get('username')
-        data_response = {'username': user.username}
-        self.send_group(recipient_username, 'message.type', data_response)
+        if isinstance(conversation, Group):
+            connection_id, group_id = None, conversation.id
+        else:
+            connection_id, group_id = conversation.id, None
+        key = recent.conversation_key(connection_id, group_id)
+        entries = recent.newest(key, conversation.last_seq, size)
+        if entries is None:
+            newest = list(messages.order_by('-created', '-id')[:max(size, recent.cache_size()) + 1])
+            payloads = serialize_messages(newest)
+            recent.fill(key, conversation.last_seq, newest, payloads)
+            entries = [(message.id, message.user_id, payload) for message, payload in zip(newest, payloads)]
+
+        more_older = len(entries) > size
+        entries = entries[:size]
+        read_state = ReadState.load(connection_id, group_id)
+        return {
+            'messages': viewer_messages_data([(author_id, payload) for _, author_id, payload in entries], user, read_state),
+            'next': 1 if more_older else None,
+            **header,
+            'before': entries[-1][0] if entries and more_older else None,
+            'after': None,
+        }
 
-    def receive_request_accept(self, data):
-        username = data.get('username')
+    async def receive_message_list(self, data):
         try:
-            connection = Connection.objects.get(sender__username=username, receiver=self.scope['user'])
-        except Connection.DoesNotExist:
-            self.send_error('Connection not found')
+            data_response = await self.get_message_list(
+                data.get('connectionId'), int(data.get('page', 0)),
+                data.get('before'), data.get('after'), data.get('page_size')
+            )
+        except ValueError:
+            await self.send_error('Invalid page, anchor or page size')
+            return
+        if isinstance(data_response, str):
+            await self.send_error(data_response)
+            return
+        await self.send_group(self.username, 'message.list', data_response)
+
+    @db_sync_to_async
+    def get_message_context(self, connectionId, message_id, size=None):
+        """Build the ``message.context`` payload: a page centred on ``message_id``."""
+        loaded = self.load_conversation(connectionId)
+        if isinstance(loaded, str):
+            return loaded
+        messages, header, _ = loaded
+        around = history.anchor(messages, int(message_id))
+        if around is None:
+            return 'Message not found'
+        page_messages, more_older, more_newer = history.window(messages, around, history.page_size(size))
+        return {'messageId': around[1], **self.message_page(page_messages, header, None, more_older, more_newer)}
+
+    async def receive_message_context(self, data):
+        try:
+            data_response = await self.get_message_context(
+                data.get('connectionId'), data.get('messageId'), data.get('page_size')
+            )
+        except (TypeError, ValueError):
+            await self.send_error('Invalid message id or page size')
+            return
+        if isinstance(data_response, str):
+            await self.send_error(data_response)
+            return
+        await self.send_group(self.username, 'message.context', data_response)
+
+    @db_sync_to_async
+    def get_sync(self, conversations, limit):
+        return sync.changes(self.scope['user'], conversations, limit)
+
+    async def receive_sync(self, data):
+        """
+        Catch up after a reconnect: ``conversations`` maps each connectionId the client
+        holds to the highest seq/change_seq it has seen there; the reply carries only
+        messages created or changed since (see chat.sync).
+        """
+        try:
+            changes = await self.get_sync(data.get('conversations') or {}, data.get('limit') or sync.DEFAULT_LIMIT)
+        except (TypeError, ValueError):
+            await self.send_error('Invalid conversations or limit')
             return
+        await self.send_frame({'source': 'sync', 'data': {'conversations': changes}})
+
+    async def replay_mailbox(self):
+        """
+        Send the frames held for this user while they were offline, oldest first, then a
+        ``mailbox.replay`` frame whose ``lastId`` the client acknowledges with ``mailbox.ack``.
+        """
+        entries, more = await mailbox.read(self.username)
+        if not entries:
+            return
+        for _, text in entries:
+            await self.send_held(text)
+        await self.send_frame({'source': 'mailbox.replay', 'data': {
+            'lastId': entries[-1][0], 'count': len(entries), 'more': more,
+        }})
+
+    async def replay_incognito(self):
+        """Send the incognito messages that arrived while this user was reconnecting."""
+        for text in await ephemeral.take(self.username):
+            await self.send_held(text)
+
+    async def send_held(self, text):
+        """Send a frame stored JSON-encoded, re-encoding it if this socket negotiated another codec."""
+        if self.codec == JSON:
+            self.outbound.put(text)
+        else:
+            await self.send_frame(loads(text))
 
-        connection.accepted = True
-        connection.save()
+    async def receive_mailbox_ack(self, data):
+        """Trim held frames up to ``lastId`` and send the next batch, if any."""
+        try:
+            await mailbox.ack(self.username, data.get('lastId'))
+        except ValueError:
+            await self.send_error('Invalid mailbox id')
+            return
+        await self.replay_mailbox()
+
+    async def receive_message_type(self, data):
+        """
+        Forward a typing indicator, at most once per CHAT_TYPING_THROTTLE seconds per
+        conversation however often the client sends them. A ``typing.stop`` follows
+        once the client has been quiet for CHAT_TYPING_TIMEOUT seconds.
+
+        1:1 chats name the recipient in ``username``; group chats pass ``connectionId``
+        ("group_<id>") and reach every other member with one group send.
+        """
+        connection_id = str(data.get('connectionId') or '')
+        if connection_id.startswith('group_'):
+            target = chat_group_name(connection_id.replace('group_', ''))
+            if target not in self.chat_groups:
+                await self.send_error("Group not found")
+                return
+            payload = {'username': self.username, 'connectionId': connection_id}
+        else:
+            target = data.get('username')
+            if not target:
+                return
+            payload = {'username': self.username}
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        state = self.typing.get(target)
+        if state is None:
+            state = self.typing[target] = {'payload': payload, 'last_sent': None}
+            state['expiry'] = asyncio.ensure_future(self.expire_typing(target))
+        state['expires'] = now + getattr(settings, 'CHAT_TYPING_TIMEOUT', 5.0)
+        if state['last_sent'] is None or now - state['last_sent'] >= getattr(settings, 'CHAT_TYPING_THROTTLE', 2.0):
+            state['last_sent'] = now
+            await self.send_typing(target, 'message.type', payload)
+
+    async def send_typing(self, target, source, payload):
+        # Group sends skip the typist's own sockets
+        skip = self.username if target.startswith('chatgroup_') else None
+        # message.type and typing.stop from one typist collapse into whichever is newest
+        collapse = f"typing:{payload['username']}:{payload.get('connectionId', '')}"
+        await self.send_group(target, source, payload, skip=skip, collapse=collapse)
+
+    async def expire_typing(self, target):
+        """Send ``typing.stop`` once ``target``'s typing state has gone without a refresh until it expires."""
+        loop = asyncio.get_running_loop()
+        while (delay := self.typing[target]['expires'] - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        state = self.typing.pop(target)
+        await self.send_typing(target, 'typing.stop', state['payload'])
+
+    async def stop_typing(self, targets=None):
+        """
+        End this socket's typing indicators towards ``targets`` (all of them by default) now,
+        e.g. when it sends a message or disconnects.
+        """
+        ended = list(self.typing) if targets is None else [target for target in targets if target in self.typing]
+        for target in ended:
+            state = self.typing.pop(target)
+            state['expiry'].cancel()
+            await self.send_typing(target, 'typing.stop', state['payload'])
+
+    @db_sync_to_async
+    def accept_request(self, username):
+        try:
+            connection = Connection.objects.select_related('sender', 'receiver').get(
+                sender__username=username, receiver=self.scope['user']
+            )
+        except Connection.DoesNotExist:
+            return None
 
-        serialized = RequestSerializer(connection)
-        self.send_group(connection.sender.username, 'request.accept', serialized.data)
-        self.send_group(connection.receiver.username, 'request.accept', serialized.data)
+        connection.accepted = True
+        connection.save(update_fields=['accepted', 'updated'])
+        inbox.open_conversation([connection.sender, connection.receiver], connection=connection)
+        return (
+            connection.sender.username,
+            connection.receiver.username,
+            serialize_request(connection),
+            inbox.find_entry(connection.sender, connection_id=connection.id),
+            inbox.find_entry(connection.receiver, connection_id=connection.id),
+        )
 
-        serialized_friend_sender = FriendSerializer(connection, context={'user': connection.sender}).data
-        self.send_group(connection.sender.username, 'friend.new', serialized_friend_sender)
+    async def receive_request_accept(self, data):
+        result = await self.accept_request(data.get('username'))
+        if result is None:
+            await self.send_error('Connection not found')
+            return
+        sender, receiver, serialized_request, serialized_friend_sender, serialized_friend_receiver = result
 
-        serialized_friend_receiver = FriendSerializer(connection, context={'user': connection.receiver}).data
-        self.send_group(connection.receiver.username, 'friend.new', serialized_friend_receiver)
+        await self.send_group(sender, 'request.accept', serialized_request)
+        await self.send_group(receiver, 'request.accept', serialized_request)
+        await self.send_group(sender, 'friend.new', serialized_friend_sender)
+        await self.send_group(receiver, 'friend.new', serialized_friend_receiver)
 
-    def receive_request_connect(self, data):
-        username = data.get('username')
+    @db_sync_to_async
+    def connect_request(self, username):
         try:
             receiver = User.objects.get(username=username)
         except User.DoesNotExist:
-            self.send_error('User not found')
-            return
+            return None
 
         connection, _ = Connection.objects.get_or_create(sender=self.scope['user'], receiver=receiver)
-        serialized = RequestSerializer(connection)
-        self.send_group(connection.sender.username, 'request.connect', serialized.data)
-        self.send_group(connection.receiver.username, 'request.connect', serialized.data)
+        return connection.sender.username, connection.receiver.username, serialize_request(connection)
 
-    def receive_request_list(self, data):
-        user = self.scope['user']
-        connections = Connection.objects.filter(receiver=user, accepted=False)
-        serialized = RequestSerializer(connections, many=True)
-        self.send_group(user.username, 'request.list', serialized.data)
+    async def receive_request_connect(self, data):
+        result = await self.connect_request(data.get('username'))
+        if result is None:
+            await self.send_error('User not found')
+            return
+        sender, receiver, serialized_request = result
+        await self.send_group(sender, 'request.connect', serialized_request)
+        await self.send_group(receiver, 'request.connect', serialized_request)
+
+    @db_sync_to_async
+    def get_request_list(self):
+        connections = Connection.objects.filter(receiver=self.scope['user'], accepted=False).select_related('sender', 'receiver')
+        return serialize_requests(connections)
+
+    async def receive_request_list(self, data):
+        await self.send_group(self.username, 'request.list', await self.get_request_list())
 
-    def receive_search(self, data):
-        query = data.get('query')
+    @db_sync_to_async
+    def search_users(self, query):
         users = User.objects.filter(
             Q(username__istartswith=query) | Q(first_name__istartswith=query) | Q(last_name__istartswith=query)
         ).exclude(username=self.username).annotate(
@@ -1048,81 +1569,93 @@ class ChatConsumer(WebsocketConsumer):
                 accepted=True
             ))
         )
-        serialized = SearchSerializer(users, many=True)
-        self.send_group(self.username, 'search', serialized.data)
+        return SearchSerializer(users, many=True).data
 
-    def receive_thumbnail(self, data):
-        user = self.scope['user']
-        image_str = data.get('base64')
+    async def receive_search(self, data):
+        await self.send_group(self.username, 'search', await self.search_users(data.get('query')))
+
+    @cpu_sync_to_async
+    def decode_upload(self, image_str):
+        """Decode a base64 upload into a ContentFile, or return None if it is not valid base64."""
         try:
-            image = ContentFile(base64.b64decode(image_str))
+            return ContentFile(base64.b64decode(image_str))
         except Exception as e:
-            logger.error(f"Error decoding thumbnail: {e}")
-            self.send_error("Invalid thumbnail image")
-            return
+            logger.error(f"Error decoding upload: {e}")
+            return None
 
-        filename = data.get('filename')
+    @db_sync_to_async
+    def save_thumbnail(self, image, filename):
+        user = self.scope['user']
         user.thumbnail.save(filename, image, save=True)
-        serialized = UserSerializer(user)
-        self.send_group(self.username, 'thumbnail', serialized.data)
+        return UserSerializer(user).data
 
-    def receive_image(self, data):
-        user = self.scope['user']
-        image_str = data.get('base64')
-        try:
-            image = ContentFile(base64.b64decode(image_str))
-        except Exception as e:
-            logger.error(f"Error decoding image: {e}")
-            self.send_error("Invalid image file")
+    async def receive_thumbnail(self, data):
+        image = await self.decode_upload(data.get('base64'))
+        if image is None:
+            await self.send_error("Invalid thumbnail image")
             return
+        serialized = await self.save_thumbnail(image, data.get('filename'))
+        await self.send_group(self.username, 'thumbnail', serialized)
 
-        filename = data.get('filename', f"{user.username}_uploaded_image.jpg")
+    @cpu_sync_to_async
+    def save_image(self, image, filename):
+        """Write an uploaded image to MEDIA_ROOT and return its path."""
         file_path = os.path.join(settings.MEDIA_ROOT, 'uploads', filename)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         with open(file_path, 'wb') as f:
             f.write(image.read())
+        return file_path
+
+    async def receive_image(self, data):
+        image = await self.decode_upload(data.get('base64'))
+        if image is None:
+            await self.send_error("Invalid image file")
+            return
+        filename = data.get('filename', f"{self.username}_uploaded_image.jpg")
+        file_path = await self.save_image(image, filename)
         response_data = {'message': 'Image uploaded successfully', 'file_path': file_path}
-        self.send_group(self.username, 'image', response_data)
+        await self.send_group(self.username, 'image', response_data)
 
-    def receive_online_status(self, data):
-        user = self.scope['user']
-        online_users = User.objects.filter(last_online__gte=timezone.now() - timezone.timedelta(minutes=5))
-        for online_user in online_users:
-            is_online = online_user.is_online and (timezone.now() - online_user.last_online).total_seconds() < 300
-            self.send_group(user.username, 'online.status', {
-                'username': online_user.username,
-                'online': is_online
-            })
+    async def receive_presence_snapshot(self, data):
+        await self.send_presence_snapshot()
 
-    def receive_group_create(self, data):
+    @db_sync_to_async
+    def create_group(self, name):
         user = self.scope['user']
-        name = data.get('name')
-        if not name:
-            self.send_error("Group name is required")
-            return
         group = Group.objects.create(name=name, creator=user)
         group.admins.add(user)
+        # Opens the inbox row and joins this user's sockets, see chat.membership
         group.members.add(user)
-        serialized = GroupSerializer(group)
-        self.send_group(user.username, 'group.created', serialized.data)
+        return GroupSerializer(group).data
+
+    async def receive_group_create(self, data):
+        name = data.get('name')
+        if not name:
+            await self.send_error("Group name is required")
+            return
+        serialized = await self.create_group(name)
+        await self.send_group(self.username, 'group.created', serialized)
 
 class FeedConsumer(AsyncWebsocketConsumer):
     
     async def connect(self):
+        self.outbound = OutboundQueue(self.send, slow_consumer_close(self))
         await self.channel_layer.group_add("feed_updates", self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
+        self.outbound.discard()
         await self.channel_layer.group_discard("feed_updates", self.channel_name)
 
+    # Feed notifications are droppable: a slow client misses stale ones rather than stalling
     async def new_post(self, event):
-        await self.send(text_data=json.dumps({
+        self.outbound.put(dumps({
             'type': 'new_post',
             'post': event['post']
-        }))
+        }), policy=DROPPABLE)
 
     async def new_comment(self, event):
-        await self.send(text_data=json.dumps({
+        self.outbound.put(dumps({
             'type': 'new_comment',
             'comment': event['comment']
-        }))
\ No newline at end of file
+        }), policy=DROPPABLE)
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+JSON encoding for websocket frames.
+
+All consumers encode outgoing frames with ``dumps`` and decode incoming ones
+with ``loads``. Datetimes, dates, times, Decimals and UUIDs are encoded in the
+same single pass as everything else, so payloads never need a separate
+walk to stringify them first. When orjson is installed it is used
+automatically. Both backends produce the same compact output.
+
+Sockets can also negotiate a binary msgpack subprotocol; see ``negotiate``,
+``encode_frame`` and ``decode_frame``.
+"""
+import datetime
+import decimal
+import json
+import uuid
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def stdlib_dumps(obj):
+    """Encode ``obj`` with the standard library, matching orjson's compact output."""
+    return json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        """Encode ``obj`` as a JSON text frame."""
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode()
+
+    loads = orjson.loads
+else:
+    dumps = stdlib_dumps
+    loads = json.loads
+
+
+# Websocket subprotocols. Clients that offer none of these keep getting JSON
+# text frames; the msgpack variants send binary frames instead. In the short
+# variant, high-volume events also have their keys replaced by SHORT_KEYS.
+JSON = 'json'
+MSGPACK = 'msgpack'
+MSGPACK_SHORT = 'msgpack.short'
+SUBPROTOCOLS = (MSGPACK_SHORT, MSGPACK)  # server preference order
+
+SHORT_KEY_EVENTS = frozenset({'message.send', 'online.status', 'rider_location'})
+SHORT_KEYS = {
+    'source': 's', 'data': 'd', 'type': 't',
+    'message': 'm', 'friend': 'f', 'connectionId': 'c',
+    'id': 'i', 'is_me': 'me', 'text': 'x', 'created': 'ts',
+    'replied_to': 'r', 'replied_to_message': 'rm', 'reactions': 'rx', 'mentions': 'mn',
+    'is_deleted': 'del', 'pinned': 'p', 'disappearing': 'ds', 'incognito': 'ic',
+    'seen': 'sn', 'seen_at': 'sa', 'media_file': 'mf', 'seq': 'sq', 'change_seq': 'cs', 'user': 'us', 'emoji': 'e',
+    'username': 'u', 'name': 'n', 'thumbnail': 'th', 'user_Bg_thumbnail': 'bg',
+    'following': 'fg', 'followers': 'fr', 'online': 'o',
+    'latitude': 'la', 'longitude': 'lo', 'trip_id': 'tr',
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+class FrameDecodeError(ValueError):
+    """An incoming binary frame is not valid for its socket's codec."""
+
+
+def negotiate(scope):
+    """Pick the codec for a websocket from the subprotocols its client offered."""
+    offered = scope.get('subprotocols') or ()
+    for codec in SUBPROTOCOLS:
+        if codec in offered:
+            return codec
+    return JSON
+
+
+def _rename_keys(obj, names):
+    if isinstance(obj, dict):
+        return {names.get(key, key): _rename_keys(value, names) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_rename_keys(item, names) for item in obj]
+    return obj
+
+
+def encode_frame(frame, codec):
+    """Encode ``frame`` for ``codec`` and return ``(text_data, bytes_data)`` for ``send``."""
+    if codec == JSON:
+        return dumps(frame), None
+    if codec == MSGPACK_SHORT and (frame.get('source') or frame.get('type')) in SHORT_KEY_EVENTS:
+        frame = _rename_keys(frame, SHORT_KEYS)
+    return None, msgpack.packb(frame, default=_default, use_bin_type=True)
+
+
+def decode_frame(text_data, bytes_data, codec):
+    """
+    Decode an incoming websocket frame. Text frames are always JSON, and so are
+    binary frames on a JSON socket, as UTF-8.
+    """
+    if bytes_data is None:
+        return loads(text_data)
+    if codec == JSON:
+        try:
+            return loads(bytes_data.decode('utf-8'))
+        except UnicodeDecodeError as e:
+            raise FrameDecodeError(str(e)) from e
+    try:
+        frame = msgpack.unpackb(bytes_data, raw=False)
+    except ValueError as e:
+        raise FrameDecodeError(str(e)) from e
+    if codec == MSGPACK_SHORT and isinstance(frame, dict) and ('s' in frame or 't' in frame):
+        frame = _rename_keys(frame, LONG_KEYS)
+    return frame
@@ -0,0 +1,34 @@
+"""
+Serialize-once envelopes for frames that fan out to many sockets.
+
+A plain ``broadcast_group`` event carries the frame as a dict and every socket
+that receives it JSON-encodes it again. An envelope carries the frame already
+encoded, so the cost of a fanout no longer depends on how many sockets it
+reaches. The only viewer-dependent part of chat frames is the author's own
+view of their message (``is_me`` and, for ``message.send``, the ``friend``
+block), so an envelope holds at most two encoded variants and
+``ChatConsumer.broadcast_group`` picks one by comparing usernames.
+"""
+from .encoding import dumps
+
+
+def envelope(source, data, author=None, author_data=None):
+    """
+    Build a ``broadcast_group`` event with ``{'source': source, 'data': data}`` pre-encoded.
+
+    When ``author_data`` is given, sockets belonging to ``author`` receive it instead of ``data``.
+    """
+    event = {'type': 'broadcast_group', 'source': source, 'text': dumps({'source': source, 'data': data})}
+    if author is not None and author_data is not None:
+        event['author'] = author
+        event['author_text'] = dumps({'source': source, 'data': author_data})
+    return event
+
+
+def message_variants(message_data):
+    """
+    Split a viewer-neutral ``MessageSerializer`` payload into (everyone else, author) variants.
+
+    The payload must have been serialized without a viewer, so ``is_me`` is False.
+    """
+    return message_data, {**message_data, 'is_me': True}
@@ -0,0 +1,118 @@
+"""
+Incognito messages, delivered through the channel layer only.
+
+An incognito ``message.send`` is never written to ``chat_message``: the consumer
+builds its payload in memory and fans it out like any other message. Because
+``sync`` cannot recover what was never stored, a copy of the frame is kept for
+CHAT_INCOGNITO_TTL seconds for each recipient that ``chat.presence`` reports
+offline, so a phone that is in the middle of reconnecting still receives it.
+``ChatConsumer`` takes the copies (removing them) right after connecting.
+
+Buffers hold at most CHAT_INCOGNITO_MAXLEN frames per user. They live in one
+Redis sorted set per user, scored by expiry, when CHAT_INCOGNITO_REDIS_URL is
+set and in process memory otherwise.
+
+Incognito messages have string ids (``incognito-<hex>``) that cannot collide
+with stored ones, and no ``seq``: they cannot be edited, reacted to or synced.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from . import presence
+from .redis_clients import LoopClients
+
+
+def incognito_ttl():
+    return getattr(settings, 'CHAT_INCOGNITO_TTL', 120)
+
+
+def incognito_maxlen():
+    return getattr(settings, 'CHAT_INCOGNITO_MAXLEN', 200)
+
+
+def new_message_id():
+    return f'incognito-{uuid.uuid4().hex}'
+
+
+class LocalBuffer:
+    """Buffers in process memory: only sockets of this process can take them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buffers = {}  # {username: [(expires, text)]}
+
+    async def add(self, username, text):
+        now = time.time()
+        with self._lock:
+            buffer = [entry for entry in self.buffers.get(username, []) if entry[0] > now]
+            buffer.append((now + incognito_ttl(), text))
+            self.buffers[username] = buffer[-incognito_maxlen():]
+
+    async def take(self, username):
+        now = time.time()
+        with self._lock:
+            return [text for expires, text in self.buffers.pop(username, []) if expires > now]
+
+
+class RedisBuffer:
+    """``incognito:<username>`` sorted sets of encoded frames scored by expiry time."""
+
+    def __init__(self, url):
+        self.url = url
+        self._clients = LoopClients(url)
+
+    @property
+    def client(self):
+        return self._clients.get()
+
+    def key(self, username):
+        return f'incognito:{username}'
+
+    async def add(self, username, text):
+        now, ttl = time.time(), incognito_ttl()
+        key = self.key(username)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zadd(key, {text: now + ttl})
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zremrangebyrank(key, 0, -incognito_maxlen() - 1)
+        pipe.expire(key, int(ttl) + 1)
+        await pipe.execute()
+
+    async def take(self, username):
+        key = self.key(username)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrangebyscore(key, time.time(), '+inf')
+        pipe.delete(key)
+        texts, _ = await pipe.execute()
+        return [text.decode() for text in texts]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                url = getattr(settings, 'CHAT_INCOGNITO_REDIS_URL', '')
+                _backend = RedisBuffer(url) if url else LocalBuffer()
+    return _backend
+
+
+async def hold(recipients, text):
+    """Keep the encoded frame ``text`` for each of ``recipients`` (``{user_id: username}``) who is offline."""
+    online = await presence.aonline_ids(recipients)
+    backend = get_backend()
+    for user_id, username in recipients.items():
+        if user_id not in online:
+            await backend.add(username, text)
+
+
+async def take(username):
+    """The unexpired frames held for ``username``, oldest first. They are removed from the buffer."""
+    return await get_backend().take(username)
@@ -0,0 +1,88 @@
+"""
+Named thread pools for the blocking work done inside websocket consumers.
+
+By default every ``database_sync_to_async``/``sync_to_async`` call shares one
+thread-sensitive executor, so a slow FCM request or a large base64 decode holds
+up the ORM work of every other socket in the process. Consumers instead pick
+the pool that matches the kind of work:
+
+    db_sync_to_async    ORM queries and cache backend access
+    cpu_sync_to_async   serialization, base64 decoding, image handling
+    http_sync_to_async  blocking outbound HTTP (FCM pushes)
+
+Pool sizes come from the CHAT_DB_POOL_SIZE, CHAT_CPU_POOL_SIZE and
+CHAT_HTTP_POOL_SIZE settings. ``pool_stats()`` reports queue depth per pool.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that keeps counters of queued, running and finished work."""
+
+    def __init__(self, name, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f'chat-{name}')
+        self.name = name
+        self.size = max_workers
+        self._counter_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.peak_queued = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._counter_lock:
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+
+        def run():
+            with self._counter_lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counter_lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return super().submit(run)
+
+    def stats(self):
+        with self._counter_lock:
+            return {
+                'size': self.size,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'peak_queued': self.peak_queued,
+            }
+
+
+POOLS = {
+    'db': InstrumentedThreadPoolExecutor('db', getattr(settings, 'CHAT_DB_POOL_SIZE', 8)),
+    'cpu': InstrumentedThreadPoolExecutor('cpu', getattr(settings, 'CHAT_CPU_POOL_SIZE', 4)),
+    'http': InstrumentedThreadPoolExecutor('http', getattr(settings, 'CHAT_HTTP_POOL_SIZE', 16)),
+}
+
+
+def db_sync_to_async(func):
+    """Run ``func`` on the ORM pool, closing stale DB connections like ``database_sync_to_async``."""
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=POOLS['db'])
+
+
+def cpu_sync_to_async(func):
+    return SyncToAsync(func, thread_sensitive=False, executor=POOLS['cpu'])
+
+
+def http_sync_to_async(func):
+    return SyncToAsync(func, thread_sensitive=False, executor=POOLS['http'])
+
+
+def pool_stats():
+    """Return a snapshot of every pool's counters, keyed by pool name."""
+    return {name: pool.stats() for name, pool in POOLS.items()}
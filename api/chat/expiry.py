@@ -0,0 +1,123 @@
+"""
+Enforcement of disappearing messages.
+
+A message sent with ``disappearing`` seconds gets ``expires_at`` at send time.
+``expire_due`` tombstones messages whose time has come, oldest first, in
+batches of CHAT_EXPIRY_BATCH_SIZE: it blanks their text and media, marks them
+deleted, gives them a new ``change_seq`` so ``sync`` reports them, moves
+previews that showed them and tells each conversation with one
+``message.delete.many`` frame.
+
+Finding due messages is a range read of ``chat_message_expiring``, a partial
+index holding only messages still waiting to expire, so its cost depends on
+the batch size and not on the size of the table. Rows are claimed with
+``SELECT ... FOR UPDATE SKIP LOCKED`` where the database supports it, so
+several ``expire_messages`` workers can run side by side.
+"""
+import asyncio
+import collections
+import datetime
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import inbox, sync
+from .envelopes import envelope
+from .layers import chat_group_name, group_send_many
+from .models import Message
+
+
+def expires_at(disappearing, sent=None):
+    """When a message sent at ``sent`` (default now) that disappears after ``disappearing`` seconds expires."""
+    seconds = int(disappearing or 0)
+    if seconds <= 0:
+        return None
+    return (sent or timezone.now()) + datetime.timedelta(seconds=seconds)
+
+
+def _targets(message):
+    """Channel-layer groups that hear about changes to ``message``."""
+    if message.connection_id:
+        return [message.connection.sender.username, message.connection.receiver.username]
+    return [chat_group_name(message.group_id)]
+
+
+def _connection_key(message):
+    return str(message.connection_id) if message.connection_id else f'group_{message.group_id}'
+
+
+@transaction.atomic
+def tombstone_due(now=None, limit=None):
+    """
+    Tombstone up to ``limit`` messages whose ``expires_at`` has passed.
+
+    Returns one ``(targets, connectionId, deleted [(id, change_seq)], preview, updated)``
+    tuple per conversation touched.
+    """
+    now = now or timezone.now()
+    limit = limit or getattr(settings, 'CHAT_EXPIRY_BATCH_SIZE', 500)
+    due = list(
+        Message.objects.filter(expires_at__lte=now, is_deleted=False)
+        .select_related('connection__sender', 'connection__receiver', 'group')
+        .select_for_update(skip_locked=True, of=('self',))
+        .only(
+            'id', 'connection', 'group',
+            'connection__updated', 'connection__sender__username', 'connection__receiver__username',
+            'group__created',
+        )
+        .order_by('expires_at')[:limit]
+    )
+    by_conversation = collections.defaultdict(list)
+    for message in due:
+        by_conversation[(message.connection_id, message.group_id)].append(message)
+
+    # Counters are locked in a fixed order so concurrent workers cannot deadlock on them
+    for (connection_id, group_id), messages in sorted(by_conversation.items(), key=lambda item: (item[0][0] or 0, item[0][1] or 0)):
+        last = sync.allocate(connection_id, group_id, count=len(messages))
+        for change_seq, message in enumerate(messages, start=last - len(messages) + 1):
+            message.is_deleted = True
+            message.text = ''
+            message.media_file = None
+            message.change_seq = change_seq
+    Message.objects.bulk_update(due, ['is_deleted', 'text', 'media_file', 'change_seq'], batch_size=500)
+
+    changes = []
+    for messages in by_conversation.values():
+        preview, updated = inbox.record_delete(messages[-1], [message.pk for message in messages])
+        changes.append((
+            _targets(messages[0]), _connection_key(messages[0]),
+            [(message.pk, message.change_seq) for message in messages],
+            preview, updated.isoformat() if updated else None,
+        ))
+    return changes
+
+
+async def announce(changes):
+    """
+    Send each conversation one preview update and one ``message.delete.many`` frame
+    listing all of its tombstoned messages, so a batch costs two layer calls per
+    conversation however many messages expired. Neither is held for offline users:
+    ``sync`` returns the tombstones and ``friend.list`` the previews.
+    """
+    channel_layer = get_channel_layer()
+    sends = []
+    for targets, connection_id, deleted, preview, updated in changes:
+        sends.append(group_send_many(channel_layer, targets, envelope('friend.preview.update', {
+            'connectionId': connection_id, 'preview': preview, 'updated': updated,
+        })))
+        sends.append(group_send_many(channel_layer, targets, envelope('message.delete.many', {
+            'connectionId': connection_id,
+            'messages': [{'messageId': message_id, 'changeSeq': change_seq} for message_id, change_seq in deleted],
+        })))
+    await asyncio.gather(*sends)
+
+
+def expire_due(now=None, limit=None):
+    """Tombstone and announce one batch of expired messages. Returns how many expired."""
+    changes = tombstone_due(now, limit)
+    if changes:
+        async_to_sync(announce)(changes)
+    return sum(len(deleted) for _, _, deleted, _, _ in changes)
@@ -0,0 +1,232 @@
+"""
+Plain-function serializers for the payloads the websocket consumers send most.
+
+``MessageSerializer``, ``UserSerializer`` and ``RequestSerializer`` spend most
+of their time binding fields and dispatching ``SerializerMethodField``s for
+every instance. The functions here build the same dicts directly and encode to
+the same bytes, for output rendered without a request (as in the consumers).
+
+Call sites use ``serialize_user``, ``serialize_messages`` and friends, which
+pick the fast path or the DRF serializer according to the
+CHAT_FAST_SERIALIZERS setting.
+"""
+import datetime
+import re
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import presence
+from .receipts import ReadState
+from .serializers import MessageSerializer, RequestSerializer, UserSerializer
+
+_MENTION = re.compile(r'@(\w+)')
+
+
+def fast_serializers_enabled():
+    return getattr(settings, 'CHAT_FAST_SERIALIZERS', False)
+
+
+def _output_timezone():
+    return timezone.get_current_timezone() if settings.USE_TZ else None
+
+
+def _datetime(value, tz):
+    """
+    ``DateTimeField().to_representation`` with the default ISO 8601 format. ``tz`` is
+    ``_output_timezone()``, looked up once per batch because it is a context-local read.
+    """
+    if not value:
+        return None
+    if tz is not None:
+        value = value.astimezone(tz) if timezone.is_aware(value) else timezone.make_aware(value, tz)
+    elif timezone.is_aware(value):
+        value = timezone.make_naive(value, datetime.timezone.utc)
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _file_url(value):
+    """``FileField``/``ImageField`` output without a request: the storage URL, or None."""
+    if not value:
+        return None
+    try:
+        return value.url
+    except AttributeError:
+        return None
+
+
+def _prefetched(instance, name):
+    """A related manager's objects, without building the manager when they were prefetched."""
+    related = getattr(instance, '_prefetched_objects_cache', {}).get(name)
+    return related if related is not None else getattr(instance, name).all()
+
+
+def _related_pks(instance, name):
+    return [obj.pk for obj in _prefetched(instance, name)]
+
+
+def user_data(user, online_ids=None):
+    """``online_ids`` is the result of one ``presence.online_ids`` lookup for a whole batch of users."""
+    return {
+        'username': user.username,
+        'name': f"{user.first_name.capitalize()} {user.last_name.capitalize()}",
+        'thumbnail': _file_url(user.thumbnail),
+        'user_Bg_thumbnail': _file_url(user.user_Bg_thumbnail),
+        'following': _related_pks(user, 'following'),
+        'followers': _related_pks(user, 'followers'),
+        'online': user.pk in online_ids if online_ids is not None else presence.is_online(user.pk),
+    }
+
+
+def message_data(message, user=None, context=None):
+    """
+    One ``MessageSerializer`` payload as seen by ``user`` (None for viewer-neutral).
+
+    Pass the same ``context`` dict for every message of a batch: like a serializer
+    context it caches the read state of each conversation and the output timezone.
+    """
+    context = {} if context is None else context
+    if 'timezone' not in context:
+        context['timezone'] = _output_timezone()
+    tz = context['timezone']
+    read_states = context.setdefault('read_states', {})
+    key = (message.connection_id, message.group_id)
+    if key not in read_states:
+        read_states[key] = ReadState.load(*key) if any(key) else ReadState([])
+    seen_at = read_states[key].seen_at(message)
+
+    replied_to = message.replied_to
+    return {
+        'id': message.id,
+        'is_me': user.pk == message.user_id if user else False,
+        'text': message.text,
+        'created': _datetime(message.created, tz),
+        'type': message.type,
+        'replied_to': message.replied_to_id,
+        'replied_to_message': {
+            'id': replied_to.id,
+            'text': replied_to.text,
+            'type': replied_to.type,
+            'user': replied_to.user.username,
+            'created': replied_to.created.isoformat(),
+        } if replied_to else None,
+        'reactions': [
+            {
+                'id': reaction.id,
+                'message': reaction.message_id,
+                'user': reaction.user.username,
+                'emoji': reaction.emoji,
+                'created': _datetime(reaction.created, tz),
+            }
+            for reaction in _prefetched(message, 'reactions')
+        ],
+        'mentions': _MENTION.findall(message.text) if message.type == 'text' else [],
+        'is_deleted': message.is_deleted,
+        'pinned': message.pinned,
+        'disappearing': message.disappearing,
+        'incognito': message.incognito,
+        'seen': seen_at is not None,
+        'seen_at': _datetime(seen_at, tz),
+        'media_file': _file_url(message.media_file),
+        'seq': message.seq,
+        'change_seq': message.change_seq,
+    }
+
+
+def viewer_messages_data(entries, user, read_state):
+    """
+    Viewer-neutral message payloads kept since they were serialized, given as
+    ``(author_id, payload)`` pairs, as seen by ``user`` now: ``is_me`` set for their
+    author and the read state taken from ``read_state``, the conversation's ``ReadState``.
+    """
+    tz = _output_timezone()
+    result = []
+    for author_id, payload in entries:
+        seen_at = read_state.read_at(author_id, payload['id'])
+        result.append({
+            **payload, 'is_me': user.pk == author_id, 'seen': seen_at is not None, 'seen_at': _datetime(seen_at, tz),
+        })
+    return result
+
+
+def incognito_message_data(message_id, text, type_, replied_to=None, disappearing=None):
+    """
+    The viewer-neutral ``message_data`` payload of an incognito message, which has no
+    database row: no reactions, read state or sequence numbers.
+    """
+    return {
+        'id': message_id,
+        'is_me': False,
+        'text': text,
+        'created': _datetime(timezone.now(), _output_timezone()),
+        'type': type_,
+        'replied_to': replied_to.id if replied_to else None,
+        'replied_to_message': {
+            'id': replied_to.id,
+            'text': replied_to.text,
+            'type': replied_to.type,
+            'user': replied_to.user.username,
+            'created': replied_to.created.isoformat(),
+        } if replied_to else None,
+        'reactions': [],
+        'mentions': _MENTION.findall(text) if type_ == 'text' else [],
+        'is_deleted': False,
+        'pinned': False,
+        'disappearing': disappearing,
+        'incognito': True,
+        'seen': False,
+        'seen_at': None,
+        'media_file': None,
+        'seq': None,
+        'change_seq': None,
+    }
+
+
+def request_data(connection, online_ids=None):
+    if online_ids is None:
+        online_ids = presence.online_ids([connection.sender_id, connection.receiver_id])
+    return {
+        'id': connection.id,
+        'sender': user_data(connection.sender, online_ids),
+        'receiver': user_data(connection.receiver, online_ids),
+        'created': _datetime(connection.created, _output_timezone()),
+    }
+
+
+def serialize_user(user, online_ids=None):
+    if fast_serializers_enabled():
+        return user_data(user, online_ids)
+    return UserSerializer(user, context={'online_ids': online_ids}).data
+
+
+def serialize_message(message, user=None):
+    if fast_serializers_enabled():
+        return message_data(message, user)
+    return MessageSerializer(message, context={'user': user}).data
+
+
+def serialize_messages(messages, user=None):
+    if fast_serializers_enabled():
+        context = {}
+        return [message_data(message, user, context) for message in messages]
+    return MessageSerializer(messages, context={'user': user}, many=True).data
+
+
+def serialize_request(connection):
+    if fast_serializers_enabled():
+        return request_data(connection)
+    online_ids = presence.online_ids([connection.sender_id, connection.receiver_id])
+    return RequestSerializer(connection, context={'online_ids': online_ids}).data
+
+
+def serialize_requests(connections):
+    connections = list(connections)
+    online_ids = presence.online_ids(
+        {user_id for connection in connections for user_id in (connection.sender_id, connection.receiver_id)}
+    )
+    if fast_serializers_enabled():
+        return [request_data(connection, online_ids) for connection in connections]
+    return RequestSerializer(connections, context={'online_ids': online_ids}, many=True).data
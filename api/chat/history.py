@@ -0,0 +1,55 @@
+"""
+Keyset pagination over a conversation's messages.
+
+Pages are ordered newest first on ``(created, id)`` and anchored on a message:
+``older`` returns what comes before an anchor and ``newer`` what comes after
+it. Each query reads one row past the page to tell whether more remain, so no
+page ever needs a COUNT or an OFFSET, and the composite ``(connection,
+created, id)`` / ``(group, created, id)`` indexes serve every page in the same
+time however far back it is.
+"""
+from django.db.models import Q
+
+PAGE_SIZE = 15
+MAX_PAGE_SIZE = 100
+
+
+def page_size(value, default=PAGE_SIZE):
+    return max(1, min(int(value), MAX_PAGE_SIZE)) if value is not None else default
+
+
+def anchor(messages, message_id):
+    """``(created, id)`` of ``message_id`` if it belongs to ``messages``, otherwise None."""
+    return messages.filter(id=message_id).values_list('created', 'id').first()
+
+
+def older(messages, before=None, size=PAGE_SIZE, inclusive=False):
+    """
+    Up to ``size`` messages older than the ``before`` anchor (or the newest ones),
+    newest first, and whether more remain. ``inclusive`` also takes the anchor itself.
+    """
+    if before is not None:
+        created, pk = before
+        same_time = Q(created=created, id__lte=pk) if inclusive else Q(created=created, id__lt=pk)
+        messages = messages.filter(Q(created__lt=created) | same_time)
+    page = list(messages.order_by('-created', '-id')[:size + 1])
+    return page[:size], len(page) > size
+
+
+def newer(messages, after, size=PAGE_SIZE):
+    """Up to ``size`` messages newer than the ``after`` anchor, newest first, and whether more remain."""
+    created, pk = after
+    messages = messages.filter(Q(created__gt=created) | Q(created=created, id__gt=pk))
+    page = list(messages.order_by('created', 'id')[:size + 1])
+    return page[:size][::-1], len(page) > size
+
+
+def window(messages, around, size=PAGE_SIZE):
+    """
+    The message at the ``around`` anchor with about ``size // 2`` messages on either
+    side, newest first, plus whether more remain older and newer.
+    """
+    half = size // 2
+    before, more_older = older(messages, around, half + 1, inclusive=True)
+    after, more_newer = newer(messages, around, half)
+    return after + before, more_older, more_newer
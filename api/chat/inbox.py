@@ -0,0 +1,223 @@
+"""
+Per-user conversation inbox backed by ``ConversationSummary``.
+
+Every participant of a 1:1 connection or group has one summary row holding the
+latest message, its preview text, the timestamp the inbox is ordered by and
+that participant's unread count. The write paths (send, edit, delete, mark
+seen) keep the rows current, so ``friend.list`` is one indexed read of the
+user's own rows. ``User.unread_total`` mirrors the sum of their unread counts
+for an O(1) badge.
+"""
+import base64
+import datetime
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from . import presence, receipts
+from .models import ConversationSummary, User
+from .receipts import conversation_filter
+from .fast_serializers import serialize_user
+
+NEW_CONNECTION_PREVIEW = 'New connection'
+NEW_GROUP_PREVIEW = 'Group created'
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+
+
+def preview_text(message):
+    if message.is_deleted:
+        return "Message deleted"
+    elif message.type == 'text':
+        return message.text[:255]
+    return f"{message.type.capitalize()} message"
+
+
+def open_conversation(users, connection=None, group=None):
+    """Give each of ``users`` an empty summary row for a new connection or group."""
+    if connection is not None:
+        conversation = {'connection': connection, 'preview': NEW_CONNECTION_PREVIEW, 'updated': connection.updated}
+    else:
+        conversation = {'group': group, 'preview': NEW_GROUP_PREVIEW, 'updated': group.created}
+    ConversationSummary.objects.bulk_create(
+        [ConversationSummary(user=user, **conversation) for user in users], ignore_conflicts=True
+    )
+
+
+@transaction.atomic
+def close_conversation(user_ids, connection_id=None, group_id=None):
+    """Drop the summary rows of ``user_ids`` for a conversation they left, taking its unread messages off their badges."""
+    summaries = ConversationSummary.objects.filter(user_id__in=user_ids, **conversation_filter(connection_id, group_id))
+    for user_id, unread in summaries.filter(unread_count__gt=0).values_list('user_id', 'unread_count'):
+        User.objects.filter(pk=user_id).update(unread_total=Greatest(F('unread_total') - unread, 0))
+    summaries.delete()
+
+
+@transaction.atomic
+def record_message(message, participants):
+    """Make ``message`` the latest of its conversation and count it as unread for everyone but its author."""
+    conversation = conversation_filter(message.connection_id, message.group_id)
+    latest = {'last_message': message, 'preview': preview_text(message), 'updated': message.created}
+    readers = [user.pk for user in participants if user.pk != message.user_id]
+
+    summaries = ConversationSummary.objects.filter(**conversation)
+    updated = summaries.filter(user_id=message.user_id).update(**latest)
+    updated += summaries.filter(user_id__in=readers).update(unread_count=F('unread_count') + 1, **latest)
+    if updated < len(participants):
+        # First message to someone without a row yet (e.g. a pending connection)
+        existing = set(summaries.values_list('user_id', flat=True))
+        ConversationSummary.objects.bulk_create([
+            ConversationSummary(user_id=user.pk, unread_count=int(user.pk != message.user_id), **conversation, **latest)
+            for user in participants if user.pk not in existing
+        ], ignore_conflicts=True)
+    User.objects.filter(pk__in=readers).update(unread_total=F('unread_total') + 1)
+
+
+def record_edit(message):
+    """Refresh previews that show ``message``. Returns True if it is the latest message of its conversation."""
+    return ConversationSummary.objects.filter(last_message=message).update(preview=preview_text(message)) > 0
+
+
+def record_delete(message, deleted_ids=None):
+    """
+    Move previews that showed ``message`` back to the latest message still visible.
+    ``deleted_ids`` lists every message of the same conversation deleted along with it.
+
+    Returns the conversation's ``(preview, updated)`` after the delete.
+    """
+    conversation = message.connection or message.group
+    summaries = ConversationSummary.objects.filter(**conversation_filter(message.connection_id, message.group_id))
+    if summaries.filter(last_message_id__in=deleted_ids or [message.pk]).exists():
+        latest = conversation.messages.filter(is_deleted=False).order_by('-created').first()
+        if latest:
+            summaries.update(last_message=latest, preview=preview_text(latest), updated=latest.created)
+        elif message.connection_id:
+            summaries.update(last_message=None, preview=NEW_CONNECTION_PREVIEW, updated=conversation.updated)
+        else:
+            summaries.update(last_message=None, preview=NEW_GROUP_PREVIEW, updated=conversation.created)
+    summary = summaries.only('preview', 'updated').first()
+    if summary is None:
+        return None, None
+    return summary.preview, summary.updated
+
+
+@transaction.atomic
+def mark_read(user, connection_id=None, group_id=None, message_id=None):
+    """
+    Advance ``user``'s read cursor (see ``receipts.advance``) and recount their unread
+    messages above it, keeping the badge total in step.
+
+    Returns ``(last_read_message_id, read_at, newly_read)`` if the cursor moved, otherwise None.
+    """
+    moved = receipts.advance(user, connection_id, group_id, message_id)
+    if moved is None:
+        return None
+    last_read_message_id, read_at = moved
+    unread = receipts.unread_count(user, last_read_message_id, connection_id, group_id)
+    summary = ConversationSummary.objects.select_for_update().filter(
+        user=user, **conversation_filter(connection_id, group_id)
+    ).only('unread_count').first()
+    newly_read = 0
+    if summary is not None and summary.unread_count != unread:
+        newly_read = summary.unread_count - unread
+        User.objects.filter(pk=user.pk).update(unread_total=Greatest(F('unread_total') - newly_read, 0))
+        summary.unread_count = unread
+        summary.save(update_fields=['unread_count'])
+    return last_read_message_id, read_at, newly_read
+
+
+def unread_total(user):
+    return User.objects.filter(pk=user.pk).values_list('unread_total', flat=True).first() or 0
+
+
+def encode_cursor(summary):
+    raw = f'{summary.updated.isoformat()}|{summary.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return ``(updated, id)`` for a cursor from ``encode_cursor``. Raises ValueError if it is malformed."""
+    try:
+        updated, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(updated), int(pk)
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def _summaries(user):
+    return ConversationSummary.objects.filter(
+        Q(group__isnull=False) | Q(connection__accepted=True), user=user
+    ).select_related(
+        'connection__sender', 'connection__receiver', 'group'
+    ).prefetch_related(
+        'connection__sender__following', 'connection__sender__followers',
+        'connection__receiver__following', 'connection__receiver__followers',
+    ).order_by('-updated', '-id')
+
+
+def _friend_id(summary, user):
+    connection = summary.connection
+    return connection.receiver_id if connection.sender_id == user.pk else connection.sender_id
+
+
+def _online_friends(summaries, user):
+    """Presence of the friends behind ``summaries``, in one lookup."""
+    return presence.online_ids({_friend_id(summary, user) for summary in summaries if summary.connection_id})
+
+
+def conversation_entry(summary, user, online_ids=None):
+    """The ``friend.list`` entry for one summary row, in the shape clients already know."""
+    if summary.group_id:
+        group = summary.group
+        return {
+            'id': f'group_{group.id}',
+            'friend': {'username': group.name, 'name': group.name, 'thumbnail': None, 'online': True},
+            'preview': summary.preview,
+            'updated': summary.updated.isoformat(),
+            'unread_count': summary.unread_count,
+        }
+    connection = summary.connection
+    friend = connection.receiver if connection.sender_id == user.pk else connection.sender
+    return {
+        'id': connection.id,
+        'friend': serialize_user(friend, online_ids),
+        'preview': summary.preview,
+        'updated': summary.updated.isoformat(),
+        'unread_count': summary.unread_count,
+    }
+
+
+def find_entry(user, connection_id=None, group_id=None):
+    """``user``'s entry for one conversation, or None if they have no row for it."""
+    summary = _summaries(user).filter(**conversation_filter(connection_id, group_id)).first()
+    return conversation_entry(summary, user) if summary else None
+
+
+def friend_list(user):
+    """Every conversation of ``user``, most recently active first."""
+    summaries = list(_summaries(user))
+    online_ids = _online_friends(summaries, user)
+    return [conversation_entry(summary, user, online_ids) for summary in summaries]
+
+
+def friend_page(user, limit, cursor=None):
+    """
+    One page of ``user``'s inbox, most recently active first.
+
+    ``next`` is the cursor for the following page, or None on the last page.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    summaries = _summaries(user)
+    if cursor:
+        updated, pk = decode_cursor(cursor)
+        summaries = summaries.filter(Q(updated__lt=updated) | Q(updated=updated, id__lt=pk))
+    page = list(summaries[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    online_ids = _online_friends(page, user)
+    return {
+        'conversations': [conversation_entry(summary, user, online_ids) for summary in page],
+        'next': encode_cursor(page[-1]) if has_more else None,
+        'unread_total': unread_total(user),
+    }
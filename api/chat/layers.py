@@ -0,0 +1,110 @@
+"""
+Channel layer helpers for fanning one event out to many groups.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# Same delivery rules as channels_redis' group_send script, plus the expired
+# message cleanup that group_send otherwise does in a separate pipeline.
+GROUP_SEND_MANY_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, math.floor(tonumber(current_time)) - tonumber(expiry))
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class RedisChannelLayer(BaseRedisChannelLayer):
+    """channels_redis layer with a batched ``group_send_many``."""
+
+    async def group_send_many(self, groups, message):
+        """
+        Send ``message`` to every channel that belongs to any of ``groups``.
+
+        Group membership is read with one pipeline per Redis shard and delivery is
+        one script call per shard, so the number of round trips does not grow with
+        the number of groups. A channel that is in several of the groups gets the
+        message once.
+        """
+        keys_by_connection = collections.defaultdict(list)
+        for group in groups:
+            assert self.valid_group_name(group), "Group name not valid"
+            keys_by_connection[self.consistent_hash(group)].append(self._group_key(group))
+
+        cutoff = int(time.time()) - self.group_expiry
+        channel_names = set()
+        for index, keys in keys_by_connection.items():
+            pipe = self.connection(index).pipeline(transaction=False)
+            for key in keys:
+                pipe.zremrangebyscore(key, min=0, max=cutoff)
+                pipe.zrange(key, 0, -1)
+            results = await pipe.execute()
+            for members in results[1::2]:
+                channel_names.update(member.decode('utf8') for member in members)
+
+        if not channel_names:
+            return
+
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(sorted(channel_names), message)
+
+        for index, channel_keys in connection_to_channel_keys.items():
+            args = [channel_keys_to_message[key] for key in channel_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_keys]
+            args += [time.time(), self.expiry]
+            over_capacity = await self.connection(index).eval(
+                GROUP_SEND_MANY_LUA, len(channel_keys), *channel_keys, *args
+            )
+            if over_capacity > 0:
+                logger.info(
+                    "%s of %s channels over capacity in group_send_many to %s groups",
+                    over_capacity, len(channel_names), len(groups),
+                )
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+    Send ``message`` to each of ``groups``.
+
+    Uses the layer's batched ``group_send_many`` when it has one and falls back
+    to concurrent ``group_send`` calls otherwise (e.g. the in-memory layer).
+    """
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return
+    if hasattr(channel_layer, 'group_send_many'):
+        await channel_layer.group_send_many(groups, message)
+    else:
+        await asyncio.gather(*(channel_layer.group_send(group, message) for group in groups))
+
+
+def chat_group_name(group_id):
+    """Channel-layer group joined by every connected socket of a chat Group's members."""
+    return f'chatgroup_{group_id}'
+
+
+async def announce_membership(channel_layer, usernames, group_id, joined):
+    """Tell the sockets of ``usernames`` to join (or leave) the channel-layer group of a chat Group."""
+    await group_send_many(channel_layer, usernames, {
+        'type': 'chatgroup_membership',
+        'group': chat_group_name(group_id),
+        'joined': joined,
+    })
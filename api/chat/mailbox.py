@@ -0,0 +1,236 @@
+"""
+Store-and-forward mailbox for frames sent to users with no live socket.
+
+Frames addressed to a user's channel-layer group (reactions, edits, deletes,
+request.accept, block.status, ...) used to vanish when the
+user had no socket open. ``hold`` keeps a copy for each addressed user that
+``chat.presence`` reports offline; on connect ``ChatConsumer`` replays the
+copies in order, followed by a ``mailbox.replay`` frame with the id of the last
+one, and the client trims what it has applied with ``mailbox.ack``.
+
+Not held:
+  * frames with a collapse key (presence, typing): only their live value matters
+  * message.send and friend.preview.update: ``sync`` and ``friend.list`` already
+    recover them from the database
+  * group fanout (``chatgroup_*``): those frames are all covered by ``sync``
+  * call signalling (``call.*``, ``voicecall.*``): a ring replayed after the
+    call ended would look live
+
+A user whose socket is connecting while a frame is sent may receive it both
+live and from the mailbox; clients should treat replays as idempotent.
+
+Mailboxes hold at most CHAT_MAILBOX_MAXLEN frames for CHAT_MAILBOX_TTL seconds.
+They live in one Redis stream per user when CHAT_MAILBOX_REDIS_URL is set and
+in process memory otherwise.
+"""
+import asyncio
+import collections
+import itertools
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from . import presence
+from .encoding import dumps
+from .executors import db_sync_to_async
+from .layers import group_send_many
+from .models import User
+from .redis_clients import LoopClients
+
+logger = logging.getLogger(__name__)
+
+DURABLE_SOURCES = frozenset({'message.send', 'friend.preview.update'})
+LIVE_PREFIXES = ('call.', 'voicecall.')
+_ENTRY_ID = re.compile(r'^(\d+)-(\d+)$')
+
+
+def mailbox_ttl():
+    return getattr(settings, 'CHAT_MAILBOX_TTL', 7 * 24 * 3600)
+
+
+def mailbox_maxlen():
+    return getattr(settings, 'CHAT_MAILBOX_MAXLEN', 500)
+
+
+def parse_entry_id(entry_id):
+    """``(milliseconds, sequence)`` of a stream entry id. Raises ValueError if it is malformed."""
+    match = _ENTRY_ID.match(str(entry_id))
+    if match is None:
+        raise ValueError(f'Invalid mailbox entry id: {entry_id!r}')
+    return int(match.group(1)), int(match.group(2))
+
+
+class LocalMailbox:
+    """Mailboxes in process memory, with stream-style ``<ms>-<seq>`` entry ids."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.boxes = {}  # {username: deque of (entry_id, stored_at, text)}
+        self.sequence = itertools.count()
+
+    async def add(self, username, text):
+        now = time.time()
+        with self._lock:
+            box = self.boxes.get(username)
+            if box is None:
+                box = self.boxes[username] = collections.deque(maxlen=mailbox_maxlen())
+            box.append((f'{int(now * 1000)}-{next(self.sequence)}', now, text))
+
+    async def read(self, username, count):
+        cutoff = time.time() - mailbox_ttl()
+        with self._lock:
+            box = self.boxes.get(username, ())
+            return [(entry_id, text) for entry_id, stored_at, text in box if stored_at > cutoff][:count]
+
+    async def ack(self, username, entry_id):
+        acked = parse_entry_id(entry_id)
+        with self._lock:
+            box = self.boxes.get(username)
+            while box and parse_entry_id(box[0][0]) <= acked:
+                box.popleft()
+            if box is not None and not box:
+                del self.boxes[username]
+
+
+class RedisMailbox:
+    """One Redis stream per user, ``mailbox:<username>``, capped by MAXLEN and expired by TTL."""
+
+    def __init__(self, url):
+        self.url = url
+        self._clients = LoopClients(url)
+
+    @property
+    def client(self):
+        return self._clients.get()
+
+    def key(self, username):
+        return f'mailbox:{username}'
+
+    async def add(self, username, text):
+        key = self.key(username)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.xadd(key, {'frame': text}, maxlen=mailbox_maxlen(), approximate=True)
+        pipe.expire(key, int(mailbox_ttl()))
+        await pipe.execute()
+
+    async def read(self, username, count):
+        oldest = f'{int((time.time() - mailbox_ttl()) * 1000)}-0'
+        entries = await self.client.xrange(self.key(username), min=oldest, max='+', count=count)
+        return [(entry_id.decode(), fields[b'frame'].decode()) for entry_id, fields in entries]
+
+    async def ack(self, username, entry_id):
+        ms, seq = parse_entry_id(entry_id)
+        # MINID keeps entries at or above the given id, i.e. everything after the acked one
+        await self.client.xtrim(self.key(username), minid=f'{ms}-{seq + 1}')
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                url = getattr(settings, 'CHAT_MAILBOX_REDIS_URL', '')
+                _backend = RedisMailbox(url) if url else LocalMailbox()
+    return _backend
+
+
+def _source(event):
+    return event['message'].get('source') if 'message' in event else event.get('source')
+
+
+def _frame_text(event, username):
+    """The encoded frame ``username``'s sockets would have been sent for a ``broadcast_group`` event."""
+    if 'text' in event:
+        if 'author_text' in event and event.get('author') == username:
+            return event['author_text']
+        return event['text']
+    return dumps(event['message'])
+
+
+@db_sync_to_async
+def _user_ids(usernames):
+    return dict(User.objects.filter(username__in=usernames).values_list('id', 'username'))
+
+
+USER_ID_CACHE_SIZE = 10000
+_user_id_cache = collections.OrderedDict()  # {username: user id}, least recently used first
+_user_id_cache_lock = threading.Lock()
+
+
+async def user_ids(usernames):
+    """``{user id: username}`` for ``usernames``, querying only names this process has not looked up before."""
+    found, missing = {}, []
+    with _user_id_cache_lock:
+        for username in usernames:
+            user_id = _user_id_cache.get(username)
+            if user_id is None:
+                missing.append(username)
+            else:
+                _user_id_cache.move_to_end(username)
+                found[user_id] = username
+    if missing:
+        fetched = await _user_ids(missing)
+        found.update(fetched)
+        with _user_id_cache_lock:
+            for user_id, username in fetched.items():
+                _user_id_cache[username] = user_id
+            while len(_user_id_cache) > USER_ID_CACHE_SIZE:
+                _user_id_cache.popitem(last=False)
+    return found
+
+
+async def hold(groups, event):
+    """
+    Keep ``event`` for every user among ``groups`` (channel-layer group names) without a live
+    socket. Best effort: the frame is sent live either way, so a failure here is logged and
+    never reaches the sender, who would otherwise retry a frame that was delivered.
+    """
+    try:
+        await _hold(groups, event)
+    except Exception as e:
+        logger.error(f"Error holding {_source(event)} for {groups}: {e}")
+
+
+async def _hold(groups, event):
+    source = _source(event) or ''
+    if event.get('type') != 'broadcast_group' or 'collapse' in event or source in DURABLE_SOURCES:
+        return
+    if source.startswith(LIVE_PREFIXES):
+        return
+    usernames = [group for group in groups if not group.startswith('chatgroup_')]
+    if not usernames:
+        return
+    users = await user_ids(usernames)
+    online = await presence.aonline_ids(users)
+    backend = get_backend()
+    for user_id, username in users.items():
+        if user_id not in online:
+            await backend.add(username, _frame_text(event, username))
+
+
+async def send_or_hold(channel_layer, groups, event):
+    """
+    ``group_send_many``, keeping a copy for addressed users who are offline. The send
+    does not wait for the presence lookup behind ``hold``: both run at once.
+    """
+    groups = list(groups)
+    await asyncio.gather(group_send_many(channel_layer, groups, event), hold(groups, event))
+
+
+async def read(username, count=None):
+    """The oldest held frames of ``username`` as ``(entry_id, text)``, and whether more are waiting."""
+    count = count or getattr(settings, 'CHAT_MAILBOX_REPLAY_BATCH', 100)
+    entries = await get_backend().read(username, count + 1)
+    return entries[:count], len(entries) > count
+
+
+async def ack(username, entry_id):
+    """Drop held frames of ``username`` up to and including ``entry_id``."""
+    await get_backend().ack(username, entry_id)
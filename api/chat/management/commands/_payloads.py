@@ -0,0 +1,112 @@
+"""
+Representative websocket payloads for the chat benchmark commands.
+
+The shapes mirror what MessageSerializer, UserSerializer and FriendSerializer
+produce for ``message.list`` and ``friend.list`` frames.
+"""
+import datetime
+
+BASE_TIME = datetime.datetime(2024, 5, 1, 9, 30, tzinfo=datetime.timezone.utc)
+
+
+def _timestamp(minutes):
+    return (BASE_TIME + datetime.timedelta(minutes=minutes)).isoformat().replace('+00:00', 'Z')
+
+
+def user_payload(index):
+    return {
+        'username': f'user{index}',
+        'name': f'User {index}',
+        'thumbnail': f'/media/uploads/thumbnails/user{index}.jpg',
+        'user_Bg_thumbnail': None,
+        'following': list(range(index % 7)),
+        'followers': list(range(index % 5)),
+        'online': index % 3 == 0,
+    }
+
+
+def message_payload(index, connection_id=1):
+    reply = index % 4 == 0 and index > 0
+    return {
+        'id': 10_000 + index,
+        'is_me': index % 2 == 0,
+        'text': f'Message number {index} @user{index % 9} see you at the usual place',
+        'created': _timestamp(index),
+        'type': 'text',
+        'replied_to': 10_000 + index - 1 if reply else None,
+        'replied_to_message': {
+            'id': 10_000 + index - 1,
+            'text': f'Message number {index - 1}',
+            'type': 'text',
+            'user': 'user1',
+            'created': _timestamp(index - 1),
+        } if reply else None,
+        'reactions': [
+            {'id': index * 3 + r, 'message': 10_000 + index, 'user': f'user{r}', 'emoji': '👍', 'created': _timestamp(index)}
+            for r in range(index % 3)
+        ],
+        'mentions': [f'user{index % 9}'],
+        'is_deleted': False,
+        'pinned': False,
+        'disappearing': None,
+        'incognito': False,
+        'seen': index > 3,
+        'seen_at': _timestamp(index + 1) if index > 3 else None,
+        'media_file': None,
+    }
+
+
+def message_list_frame(page_size=15):
+    return {'source': 'message.list', 'data': {
+        'messages': [message_payload(i) for i in range(page_size)],
+        'next': 1,
+        'friend': user_payload(1),
+        'is_blocked': False,
+        'i_blocked_friend': False,
+    }}
+
+
+def friend_list_frame(friends=50):
+    return {'source': 'friend.list', 'data': [
+        {
+            'id': i,
+            'friend': user_payload(i),
+            'preview': f'Last message in conversation {i}',
+            'updated': _timestamp(i).replace('Z', '+00:00'),
+            'unread_count': i % 4,
+        }
+        for i in range(friends)
+    ]}
+
+
+def message_send_frame(index=1):
+    return {'source': 'message.send', 'data': {
+        'message': message_payload(index),
+        'friend': user_payload(2),
+        'connectionId': 1,
+    }}
+
+
+def online_status_frame(index=1):
+    return {'source': 'online.status', 'data': {'username': f'user{index}', 'online': True}}
+
+
+def rider_location_frame(index=1):
+    return {'type': 'rider_location', 'latitude': 26.1445 + index / 10_000, 'longitude': 91.7362, 'trip_id': 42}
+
+
+def sample_frames():
+    return {
+        'message.list': message_list_frame(),
+        'friend.list': friend_list_frame(),
+    }
+
+
+def all_frames():
+    """``sample_frames`` plus the high-volume single-event frames."""
+    return {
+        **sample_frames(),
+        'message.send': message_send_frame(),
+        'online.status': online_status_frame(),
+        'rider_location': rider_location_frame(),
+    }
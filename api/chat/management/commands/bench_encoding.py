@@ -0,0 +1,54 @@
+import datetime
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import encoding
+from ._payloads import sample_frames
+
+
+def legacy_serialize_datetime(obj):
+    """The recursive walk ChatConsumer used to run before json.dumps."""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    elif isinstance(obj, dict):
+        return {k: legacy_serialize_datetime(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [legacy_serialize_datetime(item) for item in obj]
+    elif hasattr(obj, '__dict__'):
+        return legacy_serialize_datetime(obj.__dict__)
+    return obj
+
+
+class Command(BaseCommand):
+    help = "Compare websocket frame encoders on typical message.list and friend.list payloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        encoders = [
+            ('serialize_datetime + json.dumps', lambda frame: json.dumps(legacy_serialize_datetime(frame))),
+            ('json.dumps', json.dumps),
+            ('encoding.stdlib_dumps', encoding.stdlib_dumps),
+        ]
+        if encoding.orjson is not None:
+            encoders.append(('encoding.dumps (orjson)', encoding.dumps))
+
+        for name, frame in sample_frames().items():
+            self.stdout.write(f"{name} frame, {iterations} iterations")
+            baseline = None
+            for label, encode in encoders:
+                encode(frame)
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    encode(frame)
+                elapsed = time.perf_counter() - started
+                per_frame = elapsed / iterations * 1e6
+                baseline = baseline or per_frame
+                self.stdout.write(
+                    f"  {label:<34} {per_frame:9.1f} us/frame  {baseline / per_frame:5.1f}x  "
+                    f"{len(encode(frame).encode()):7d} bytes"
+                )
@@ -0,0 +1,93 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.encoding import dumps
+from chat.fast_serializers import message_data, request_data, user_data
+from chat.models import Connection, Message, Reaction, User
+from chat.receipts import ReadState
+from chat.serializers import MessageSerializer, RequestSerializer, UserSerializer
+
+
+def build_users(count):
+    users = []
+    for i in range(count):
+        user = User(
+            pk=i + 1, username=f'user{i}', first_name=f'user{i}', last_name='x',
+            thumbnail=f'uploads/thumbnails/user{i}.jpg' if i % 2 else None,
+            is_online=bool(i % 3), last_online=timezone.now(),
+        )
+        # Stand-ins for prefetched following/followers so nothing touches the database
+        user._prefetched_objects_cache = {'following': users[:i % 5], 'followers': users[:i % 3]}
+        users.append(user)
+    return users
+
+
+def build_messages(count, users):
+    """Unsaved messages shaped like a for_serialization() page: replies, reactions, mentions."""
+    base = timezone.now() - datetime.timedelta(days=1)
+    messages = []
+    for i in range(count):
+        message = Message(
+            pk=i + 1, connection_id=1, user=users[i % 2], text=f'message {i} for @user{i % 7}',
+            type='text' if i % 5 else 'image', created=base + datetime.timedelta(seconds=i),
+            replied_to=messages[-1] if i % 4 == 0 and messages else None,
+            media_file='' if i % 5 else f'uploads/messages/{i}.jpg',
+        )
+        message._prefetched_objects_cache = {'reactions': [
+            Reaction(pk=i * 3 + r, message_id=message.pk, user=users[r], emoji='👍', created=message.created)
+            for r in range(i % 3)
+        ]}
+        messages.append(message)
+    return messages
+
+
+class Command(BaseCommand):
+    help = "Compare objects/sec of the DRF serializers and chat.fast_serializers on in-memory payloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000)
+
+    def run(self, label, count, serialize):
+        serialize()
+        started = time.perf_counter()
+        serialize()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"  {label:<22} {count / elapsed:12,.0f} objects/sec")
+        return elapsed
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        users = build_users(50)
+        messages = build_messages(count, users)
+        viewer = users[0]
+        read_states = {(1, None): ReadState([(users[1].pk, count // 2, timezone.now())])}
+        context = {'read_states': read_states}
+        connections = [
+            Connection(pk=i + 1, sender=users[i % 50], receiver=users[(i + 1) % 50], created=timezone.now())
+            for i in range(count // 10)
+        ]
+
+        # Sanity check before timing anything: both paths must encode to the same bytes
+        drf_page = MessageSerializer(messages[:50], context={'user': viewer, 'read_states': read_states}, many=True).data
+        fast_page = [message_data(message, viewer, {'read_states': read_states}) for message in messages[:50]]
+        assert dumps(drf_page) == dumps(fast_page), "fast message serializer output differs from DRF"
+
+        suites = [
+            ('MessageSerializer', count,
+             lambda: MessageSerializer(messages, context={'user': viewer, 'read_states': read_states}, many=True).data,
+             lambda: [message_data(message, viewer, context) for message in messages]),
+            ('UserSerializer', count,
+             lambda: [UserSerializer(users[i % 50]).data for i in range(count)],
+             lambda: [user_data(users[i % 50]) for i in range(count)]),
+            ('RequestSerializer', len(connections),
+             lambda: RequestSerializer(connections, many=True).data,
+             lambda: [request_data(connection) for connection in connections]),
+        ]
+        for name, total, drf, fast in suites:
+            self.stdout.write(f"{name}, {total} objects")
+            drf_elapsed = self.run('DRF', total, drf)
+            fast_elapsed = self.run('fast_serializers', total, fast)
+            self.stdout.write(f"  speedup {drf_elapsed / fast_elapsed:.1f}x")
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import encoding
+from ._payloads import all_frames
+
+
+def _frame_bytes(frame, codec):
+    text_data, bytes_data = encoding.encode_frame(frame, codec)
+    return text_data.encode() if bytes_data is None else bytes_data
+
+
+class Command(BaseCommand):
+    help = "Compare frame size and encode time of the JSON, msgpack and msgpack.short websocket codecs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        codecs = [encoding.JSON, encoding.MSGPACK, encoding.MSGPACK_SHORT]
+
+        for name, frame in all_frames().items():
+            self.stdout.write(f"{name} frame, {iterations} iterations")
+            json_size = len(_frame_bytes(frame, encoding.JSON))
+            for codec in codecs:
+                size = len(_frame_bytes(frame, codec))
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    encoding.encode_frame(frame, codec)
+                per_frame = (time.perf_counter() - started) / iterations * 1e6
+                self.stdout.write(
+                    f"  {codec:<14} {per_frame:9.1f} us/frame  {size:7d} bytes  {size / json_size:6.1%} of JSON"
+                )
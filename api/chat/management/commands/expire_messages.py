@@ -0,0 +1,37 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import expiry
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Tombstone disappearing messages once their expires_at has passed, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'CHAT_EXPIRY_BATCH_SIZE', 500))
+        parser.add_argument(
+            '--interval', type=float, default=getattr(settings, 'CHAT_EXPIRY_INTERVAL', 5),
+            help="Seconds to wait once no expired messages are left.",
+        )
+        parser.add_argument('--once', action='store_true', help="Expire everything due now, then exit.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        while True:
+            try:
+                expired = expiry.expire_due(limit=batch_size)
+            except Exception as e:
+                logger.error(f"Error expiring messages: {e}")
+                expired = 0
+            if expired:
+                self.stdout.write(f"Expired {expired} messages")
+            if expired < batch_size:
+                # Caught up: anything else that is due can wait for the next pass
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,66 @@
+"""
+Inbox rows and channel-layer groups that follow ``Group.members``.
+
+Every change to a group's members, from a view, a consumer, the admin or the
+shell, sends ``m2m_changed``. Members who joined get an inbox row and, once the
+change commits, their open sockets join ``chatgroup_<id>``. Members who left
+lose their row (and its unread count) and their sockets leave the group, so
+they stop receiving its broadcasts.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from . import inbox
+from .layers import announce_membership
+from .models import Group, User
+
+logger = logging.getLogger(__name__)
+
+
+def _announce(usernames, group_id, joined):
+    try:
+        async_to_sync(announce_membership)(get_channel_layer(), usernames, group_id, joined)
+    except Exception as e:
+        # Sockets keep their old membership until they reconnect and rebuild it from the database
+        logger.error(f"Error announcing membership of group {group_id} to {usernames}: {e}")
+
+
+def joined(group, user_ids):
+    users = list(User.objects.filter(pk__in=user_ids))
+    inbox.open_conversation(users, group=group)
+    usernames = [user.username for user in users]
+    transaction.on_commit(lambda: _announce(usernames, group.pk, True))
+
+
+def left(group_id, user_ids):
+    inbox.close_conversation(user_ids, group_id=group_id)
+    usernames = list(User.objects.filter(pk__in=user_ids).values_list('username', flat=True))
+    transaction.on_commit(lambda: _announce(usernames, group_id, False))
+
+
+@receiver(m2m_changed, sender=Group.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """``instance`` is the Group, or the User when changed through ``user.chat_groups``."""
+    if action == 'pre_clear':
+        # post_clear does not say who was removed
+        related = instance.chat_groups if reverse else instance.members
+        instance._cleared_member_pks = set(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_member_pks', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if not pk_set:
+        return
+    changes = {group_id: {instance.pk} for group_id in pk_set} if reverse else {instance.pk: set(pk_set)}
+    groups = Group.objects.in_bulk(changes) if reverse else {instance.pk: instance}
+    for group_id, user_ids in changes.items():
+        if action == 'post_add':
+            joined(groups[group_id], user_ids)
+        else:
+            left(group_id, user_ids)
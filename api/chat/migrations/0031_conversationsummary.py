@@ -0,0 +1,44 @@
+# Generated by Django 4.2.4 on 2026-10-17 18:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0030_remove_message_call_session_delete_callsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='unread_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('preview', models.CharField(max_length=255)),
+                ('updated', models.DateTimeField()),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('connection', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='chat.connection')),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='chat.group')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-updated', '-id'], name='chat_inbox_order')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsummary',
+            constraint=models.UniqueConstraint(fields=('user', 'connection'), name='unique_connection_summary'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsummary',
+            constraint=models.UniqueConstraint(fields=('user', 'group'), name='unique_group_summary'),
+        ),
+    ]
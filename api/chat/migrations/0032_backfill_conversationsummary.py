@@ -0,0 +1,58 @@
+from django.db import migrations
+from django.db.models import Q
+
+
+def preview_text(message):
+    if message.type == 'text':
+        return message.text[:255]
+    return f"{message.type.capitalize()} message"
+
+
+def backfill(apps, schema_editor):
+    User = apps.get_model('chat', 'User')
+    Connection = apps.get_model('chat', 'Connection')
+    Group = apps.get_model('chat', 'Group')
+    Message = apps.get_model('chat', 'Message')
+    ConversationSummary = apps.get_model('chat', 'ConversationSummary')
+
+    summaries = []
+    for connection in Connection.objects.filter(accepted=True).iterator():
+        latest = Message.objects.filter(connection=connection, is_deleted=False).order_by('-created').first()
+        for user_id, other_id in ((connection.sender_id, connection.receiver_id), (connection.receiver_id, connection.sender_id)):
+            summaries.append(ConversationSummary(
+                user_id=user_id,
+                connection=connection,
+                last_message=latest,
+                preview=preview_text(latest) if latest else 'New connection',
+                updated=latest.created if latest else connection.updated,
+                unread_count=Message.objects.filter(connection=connection, user_id=other_id, seen=False).count(),
+            ))
+    for group in Group.objects.all().iterator():
+        latest = Message.objects.filter(group=group, is_deleted=False).order_by('-created').first()
+        for user_id in group.members.values_list('id', flat=True):
+            summaries.append(ConversationSummary(
+                user_id=user_id,
+                group=group,
+                last_message=latest,
+                preview=preview_text(latest) if latest else 'Group created',
+                updated=latest.created if latest else group.created,
+                unread_count=Message.objects.filter(~Q(user_id=user_id), group=group, seen=False).count(),
+            ))
+    ConversationSummary.objects.bulk_create(summaries, batch_size=500, ignore_conflicts=True)
+
+    totals = {}
+    for summary in summaries:
+        totals[summary.user_id] = totals.get(summary.user_id, 0) + summary.unread_count
+    for user_id, total in totals.items():
+        User.objects.filter(id=user_id).update(unread_total=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0031_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.4 on 2026-10-17 18:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0032_backfill_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('read_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'id'], name='chat_message_conn_id'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['group', 'id'], name='chat_message_group_id'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='connection',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.connection'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.group'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'connection'), name='unique_connection_read_cursor'),
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'group'), name='unique_group_read_cursor'),
+        ),
+    ]
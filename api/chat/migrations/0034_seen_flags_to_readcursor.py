@@ -0,0 +1,42 @@
+from django.db import migrations
+from django.db.models import Max, Q
+from django.utils import timezone
+
+
+def seen_flags_to_cursors(apps, schema_editor):
+    """A member's cursor starts at the newest message from someone else that was flagged seen."""
+    Connection = apps.get_model('chat', 'Connection')
+    Group = apps.get_model('chat', 'Group')
+    Message = apps.get_model('chat', 'Message')
+    ReadCursor = apps.get_model('chat', 'ReadCursor')
+
+    cursors = []
+
+    def add_cursor(user_id, seen_messages, **conversation):
+        seen = seen_messages.aggregate(last_read=Max('id'), read_at=Max('seen_at'))
+        if seen['last_read'] is not None:
+            cursors.append(ReadCursor(
+                user_id=user_id,
+                last_read_message_id=seen['last_read'],
+                read_at=seen['read_at'] or timezone.now(),
+                **conversation
+            ))
+
+    for connection in Connection.objects.filter(accepted=True).iterator():
+        for user_id, other_id in ((connection.sender_id, connection.receiver_id), (connection.receiver_id, connection.sender_id)):
+            add_cursor(user_id, Message.objects.filter(connection=connection, user_id=other_id, seen=True), connection=connection)
+    for group in Group.objects.all().iterator():
+        for user_id in group.members.values_list('id', flat=True):
+            add_cursor(user_id, Message.objects.filter(~Q(user_id=user_id), group=group, seen=True), group=group)
+    ReadCursor.objects.bulk_create(cursors, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0033_readcursor'),
+    ]
+
+    operations = [
+        migrations.RunPython(seen_flags_to_cursors, migrations.RunPython.noop),
+    ]
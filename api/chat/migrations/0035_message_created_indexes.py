@@ -0,0 +1,21 @@
+# Generated by Django 4.2.4 on 2026-10-17 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0034_seen_flags_to_readcursor'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'created', 'id'], name='chat_message_conn_created'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['group', 'created', 'id'], name='chat_message_group_created'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.4 on 2026-10-17 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0035_message_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='change_seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'change_seq'], name='chat_message_conn_change'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['group', 'change_seq'], name='chat_message_group_change'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def number_messages(apps, schema_editor):
+    """Number each conversation's existing messages 1, 2, ... in id order."""
+    Connection = apps.get_model('chat', 'Connection')
+    Group = apps.get_model('chat', 'Group')
+    Message = apps.get_model('chat', 'Message')
+
+    def number(conversation, messages):
+        batch = []
+        for seq, message in enumerate(messages.order_by('id').only('id').iterator(), start=1):
+            message.seq = message.change_seq = seq
+            batch.append(message)
+        Message.objects.bulk_update(batch, ['seq', 'change_seq'], batch_size=500)
+        type(conversation).objects.filter(pk=conversation.pk).update(last_seq=len(batch))
+
+    for connection in Connection.objects.iterator():
+        number(connection, Message.objects.filter(connection=connection))
+    for group in Group.objects.iterator():
+        number(group, Message.objects.filter(group=group))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0036_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.4 on 2026-10-17 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0037_backfill_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_message_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_message_id__isnull', False)), fields=('user', 'client_message_id'), name='unique_client_message_id'),
+        ),
+    ]
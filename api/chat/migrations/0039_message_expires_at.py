@@ -0,0 +1,22 @@
+# Generated by Django 4.2.4 on 2026-10-17 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0038_message_client_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('expires_at__isnull', False), ('is_deleted', False)), fields=['expires_at'], name='chat_message_expiring'),
+        ),
+    ]
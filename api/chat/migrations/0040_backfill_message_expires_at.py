@@ -0,0 +1,28 @@
+import datetime
+
+from django.db import migrations
+
+
+def schedule_expiry(apps, schema_editor):
+    """Give existing disappearing messages the expires_at they would have been sent with."""
+    Message = apps.get_model('chat', 'Message')
+    pending = Message.objects.filter(disappearing__gt=0, expires_at__isnull=True, is_deleted=False)
+    batch = []
+    for message in pending.only('id', 'created', 'disappearing').iterator():
+        message.expires_at = message.created + datetime.timedelta(seconds=message.disappearing)
+        batch.append(message)
+        if len(batch) == 500:
+            Message.objects.bulk_update(batch, ['expires_at'])
+            batch = []
+    Message.objects.bulk_update(batch, ['expires_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0039_message_expires_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(schedule_expiry, migrations.RunPython.noop),
+    ]
@@ -14,33 +14,67 @@ class User(AbstractUser):
     user_Bg_thumbnail = models.ImageField(upload_to='uploads/backgrounds/', null=True, blank=True)
     following = models.ManyToManyField('self', symmetrical=False, related_name='followers', blank=True)
     phone_number = models.CharField(max_length=15, unique=True, null=True, blank=True)
-    last_online = models.DateTimeField(null=True, blank=True)
-    is_online = models.BooleanField(default=False)
+    last_online = models.DateTimeField(null=True, blank=True)  # Written lazily in batches by chat.presence
+    is_online = models.BooleanField(default=False)  # Superseded by chat.presence, no longer written
     fcm_token = models.CharField(max_length=255, null=True, blank=True)  # For push notifications
+    unread_total = models.PositiveIntegerField(default=0)  # Sum of unread_count over the user's ConversationSummary rows
 
     def __str__(self):
         return self.username
 
-class Connection(models.Model):
+class SequenceCounterMixin:
+    """
+    For models whose ``last_seq`` counter is advanced in SQL by ``chat.sync.allocate``.
+    Saving a loaded instance writes every field except ``last_seq`` unless ``update_fields``
+    says otherwise, so a stale in-memory value can never roll the counter back.
+    """
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'last_seq'
+            ]
+        super().save(*args, **kwargs)
+
+class Connection(SequenceCounterMixin, models.Model):
     sender = models.ForeignKey(User, related_name='sent_connections', on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name='received_connections', on_delete=models.CASCADE)
     accepted = models.BooleanField(default=False)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
+    last_seq = models.BigIntegerField(default=0)  # Last sequence number handed out by chat.sync
 
     def __str__(self):
         return f"{self.sender.username} -> {self.receiver.username}"
 
-class Group(models.Model):
+class Group(SequenceCounterMixin, models.Model):
     name = models.CharField(max_length=255)
     creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_groups')
     members = models.ManyToManyField(User, related_name='chat_groups')
     admins = models.ManyToManyField(User, related_name='admin_chat_groups')
     created = models.DateTimeField(auto_now_add=True)
+    last_seq = models.BigIntegerField(default=0)  # Last sequence number handed out by chat.sync
 
     def __str__(self):
         return self.name
 
+class MessageQuerySet(models.QuerySet):
+    def for_serialization(self):
+        """
+        Load everything ``MessageSerializer`` reads and nothing else: the replied-to
+        message and its author are joined in, reactions and their users arrive in one
+        extra query, so a page costs the same number of queries whatever its size.
+        """
+        return self.select_related('replied_to__user').prefetch_related(
+            models.Prefetch('reactions', queryset=Reaction.objects.select_related('user').only(
+                'id', 'message', 'emoji', 'created', 'user__username'
+            ))
+        ).only(
+            'id', 'user', 'connection', 'group', 'text', 'type', 'created', 'is_deleted', 'pinned',
+            'disappearing', 'incognito', 'media_file', 'seq', 'change_seq', 'replied_to__id', 'replied_to__text',
+            'replied_to__type', 'replied_to__created', 'replied_to__user__username',
+        )
+
 class Message(models.Model):
     TEXT = 'text'
     IMAGE = 'image'
@@ -67,14 +101,90 @@ class Message(models.Model):
     is_deleted = models.BooleanField(default=False)
     pinned = models.BooleanField(default=False)
     disappearing = models.IntegerField(null=True, blank=True)  # Seconds after which message disappears
-    incognito = models.BooleanField(default=False)
+    expires_at = models.DateTimeField(null=True, blank=True)  # created + disappearing, enforced by chat.expiry
+    incognito = models.BooleanField(default=False)  # Incognito messages are no longer stored, see chat.ephemeral
     media_file = models.FileField(upload_to='uploads/messages/', null=True, blank=True)
+    # Superseded by ReadCursor; kept for existing rows but no longer written
     seen = models.BooleanField(default=False)
     seen_at = models.DateTimeField(null=True, blank=True)
+    # Position in the conversation, and the sequence number of its latest edit, delete,
+    # pin or reaction (equal to seq until it changes); see chat.sync
+    seq = models.BigIntegerField(null=True, blank=True)
+    change_seq = models.BigIntegerField(null=True, blank=True)
+    # Sender-chosen id that makes a retried message.send return the original message
+    client_message_id = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'client_message_id'], name='unique_client_message_id',
+                condition=models.Q(client_message_id__isnull=False),
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['connection', 'id'], name='chat_message_conn_id'),
+            models.Index(fields=['group', 'id'], name='chat_message_group_id'),
+            models.Index(fields=['connection', 'created', 'id'], name='chat_message_conn_created'),
+            models.Index(fields=['group', 'created', 'id'], name='chat_message_group_created'),
+            models.Index(fields=['connection', 'change_seq'], name='chat_message_conn_change'),
+            models.Index(fields=['group', 'change_seq'], name='chat_message_group_change'),
+            # Only messages still waiting to expire, so the index stays as small as that backlog
+            models.Index(
+                fields=['expires_at'], name='chat_message_expiring',
+                condition=models.Q(expires_at__isnull=False, is_deleted=False),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} ({self.type}): {self.text}"
 
+class ConversationSummary(models.Model):
+    """
+    A user's inbox row for one conversation, either a 1:1 connection or a group.
+
+    Rows are kept current by ``chat.inbox`` whenever a message is sent, edited,
+    deleted or read, so ``friend.list`` never has to look at the messages.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations')
+    connection = models.ForeignKey(Connection, on_delete=models.CASCADE, null=True, blank=True, related_name='summaries')
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, null=True, blank=True, related_name='summaries')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    preview = models.CharField(max_length=255)
+    updated = models.DateTimeField()
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'connection'], name='unique_connection_summary'),
+            models.UniqueConstraint(fields=['user', 'group'], name='unique_group_summary'),
+        ]
+        indexes = [models.Index(fields=['user', '-updated', '-id'], name='chat_inbox_order')]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.preview}"
+
+class ReadCursor(models.Model):
+    """
+    How far one member has read a 1:1 connection or group: every message with an
+    id up to ``last_read_message_id`` counts as seen by ``user``.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    connection = models.ForeignKey(Connection, on_delete=models.CASCADE, null=True, blank=True, related_name='read_cursors')
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, null=True, blank=True, related_name='read_cursors')
+    last_read_message_id = models.BigIntegerField(default=0)
+    read_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'connection'], name='unique_connection_read_cursor'),
+            models.UniqueConstraint(fields=['user', 'group'], name='unique_group_read_cursor'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} read up to {self.last_read_message_id}"
+
 class Reaction(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reactions')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -0,0 +1,147 @@
+"""
+Bounded per-socket outbound queues for websocket consumers.
+
+Consumer event handlers used to ``await self.send(...)`` directly. On a server
+that applies backpressure to slow clients that await stalls the handler, the
+consumer stops reading its channel, and the channel layer starts discarding
+messages once the channel is over capacity, whatever they were. Handlers now
+put frames on an ``OutboundQueue`` and return; one writer task per socket
+sends them in order. Each frame has a policy:
+
+    RELIABLE    always delivered (chat messages, replies, call signalling)
+    LATEST      carries a collapse key; a queued frame with the same key is
+                replaced in place, so only the newest presence or location
+                value is sent
+    DROPPABLE   stale-tolerant (feed notifications); when the queue is at
+                CHAT_OUTBOUND_QUEUE_SIZE the oldest droppable frame is evicted
+
+A socket whose backlog still grows past CHAT_OUTBOUND_MAX_BACKLOG is closed
+with code 4009 so the client reconnects and resyncs, instead of the process
+buffering for it without bound. ``outbound_stats()`` reports depth and drop
+counters for the runtime metrics endpoint.
+"""
+import asyncio
+import collections
+import itertools
+import logging
+import threading
+import weakref
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RELIABLE = 'reliable'
+LATEST = 'latest'
+DROPPABLE = 'droppable'
+
+_lock = threading.Lock()
+_queues = weakref.WeakSet()
+_counters = collections.Counter()
+
+
+def _count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+class OutboundQueue:
+    def __init__(self, send, close):
+        """``send(text_data=..., bytes_data=...)`` writes one frame; ``close()`` closes the socket as a slow consumer."""
+        self._send = send
+        self._close = close
+        self.max_size = getattr(settings, 'CHAT_OUTBOUND_QUEUE_SIZE', 256)
+        self.max_backlog = getattr(settings, 'CHAT_OUTBOUND_MAX_BACKLOG', 2048)
+        self.entries = collections.OrderedDict()  # key -> (text_data, bytes_data)
+        self.droppable = collections.deque()  # keys of queued DROPPABLE entries, oldest first
+        self.ids = itertools.count()
+        self.peak = 0
+        self.writer = None
+        self.closed = False
+        with _lock:
+            _queues.add(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, text_data=None, bytes_data=None, policy=RELIABLE, key=None):
+        """Queue a frame for sending. Never blocks."""
+        if self.closed:
+            return
+        frame = (text_data, bytes_data)
+        if policy == LATEST and key is not None:
+            key = ('latest', key)
+            if key in self.entries:
+                self.entries[key] = frame
+                _count('collapsed')
+                return
+        else:
+            key = next(self.ids)
+
+        if len(self.entries) >= self.max_size and not self._evict_droppable():
+            if policy == DROPPABLE:
+                _count('dropped')
+                return
+            if len(self.entries) >= self.max_backlog:
+                self._overflow()
+                return
+        self.entries[key] = frame
+        if policy == DROPPABLE:
+            self.droppable.append(key)
+        self.peak = max(self.peak, len(self.entries))
+        _count('enqueued')
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self._write())
+
+    def _evict_droppable(self):
+        while self.droppable:
+            key = self.droppable.popleft()
+            if self.entries.pop(key, None) is not None:
+                _count('dropped')
+                return True
+        return False
+
+    def _overflow(self):
+        logger.warning(f"Closing slow websocket consumer with {len(self.entries)} frames queued")
+        _count('overflow_closes')
+        self.discard()
+        asyncio.ensure_future(self._close())
+
+    async def _write(self):
+        try:
+            while self.entries:
+                _, (text_data, bytes_data) = self.entries.popitem(last=False)
+                await self._send(text_data=text_data, bytes_data=bytes_data)
+                _count('sent')
+        except Exception as e:
+            logger.error(f"Error writing to websocket: {e}")
+            self.writer = None
+            self.discard()
+        finally:
+            self.writer = None
+
+    def discard(self):
+        """Stop sending: cancel the writer and forget queued frames, e.g. on disconnect."""
+        self.closed = True
+        if self.writer is not None:
+            self.writer.cancel()
+        self.entries.clear()
+        self.droppable.clear()
+
+
+def slow_consumer_close(consumer):
+    """The ``close`` callable for an ``OutboundQueue`` of ``consumer``."""
+    return lambda: consumer.close(code=4009)
+
+
+def outbound_stats():
+    with _lock:
+        depths = [(len(queue), queue.peak) for queue in _queues if not queue.closed]
+        counters = dict(_counters)
+    return {
+        'sockets': len(depths),
+        'queued': sum(depth for depth, _ in depths),
+        'max_depth': max((depth for depth, _ in depths), default=0),
+        'peak_depth': max((peak for _, peak in depths), default=0),
+        **{name: counters.get(name, 0) for name in ('enqueued', 'sent', 'collapsed', 'dropped', 'overflow_closes')},
+    }
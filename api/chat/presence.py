@@ -0,0 +1,282 @@
+"""
+Who is connected, for online indicators.
+
+Each ChatConsumer socket registers its channel name under its user with an
+expiry that the socket's heartbeat keeps pushing forward, so a user with
+several devices stays online until the last of them disconnects, and a
+socket whose process died simply expires. Two backends share the interface:
+
+    RedisPresence   one sorted set per user (channel name -> expiry), shared
+                    by every process; used when CHAT_PRESENCE_REDIS_URL is set
+    LocalPresence   the same bookkeeping in process memory, for development
+                    and tests
+
+Going offline is debounced: the last socket closing only announces the user
+offline if they are still gone CHAT_PRESENCE_OFFLINE_GRACE seconds later, and
+the announced state is remembered so a reconnect inside the grace period does
+not announce them online again. ``User.last_online`` is no longer written per
+connect/disconnect; disconnect times are buffered and written in one bulk
+update every CHAT_PRESENCE_FLUSH_INTERVAL seconds.
+"""
+import asyncio
+import datetime
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .executors import db_sync_to_async
+from .models import User
+from .redis_clients import LoopClients
+
+logger = logging.getLogger(__name__)
+
+
+def presence_ttl():
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+
+
+def heartbeat_interval():
+    """Sockets refresh their entry three times per TTL, so one late heartbeat does not expire them."""
+    return presence_ttl() / 3
+
+
+class LocalPresence:
+    """Presence for a single process: only sockets of this process are visible."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sockets = {}  # {user_id: {channel_name: expires}}
+        self.announced = set()
+        self.last_seen = {}
+
+    def _live(self, user_id, now):
+        sockets = self.sockets.get(user_id, {})
+        for channel_name in [name for name, expires in sockets.items() if expires <= now]:
+            del sockets[channel_name]
+        if not sockets:
+            self.sockets.pop(user_id, None)
+        return len(sockets)
+
+    async def add(self, user_id, channel_name):
+        now = time.time()
+        with self._lock:
+            self.sockets.setdefault(user_id, {})[channel_name] = now + presence_ttl()
+            return self._live(user_id, now)
+
+    async def remove(self, user_id, channel_name):
+        now = time.time()
+        with self._lock:
+            self.sockets.get(user_id, {}).pop(channel_name, None)
+            live = self._live(user_id, now)
+            if not live:
+                self.last_seen[user_id] = now
+            return live
+
+    def online_ids(self, user_ids):
+        now = time.time()
+        with self._lock:
+            return {user_id for user_id in user_ids if self._live(user_id, now)}
+
+    async def aonline_ids(self, user_ids):
+        return self.online_ids(user_ids)
+
+    async def mark_announced(self, user_id, online):
+        with self._lock:
+            if online == (user_id in self.announced):
+                return False
+            if online:
+                self.announced.add(user_id)
+            else:
+                self.announced.discard(user_id)
+            return True
+
+    async def pop_last_seen(self):
+        with self._lock:
+            last_seen, self.last_seen = self.last_seen, {}
+            return last_seen
+
+
+class RedisPresence:
+    """
+    Presence shared by every process through Redis.
+
+    ``presence:<user_id>`` is a sorted set of the user's channel names scored by
+    expiry time, with a key TTL so an abandoned set cleans itself up.
+    ``presence:announced`` is the set of users last announced online and
+    ``presence:last_seen`` buffers disconnect times until they are flushed.
+    """
+    ANNOUNCED_KEY = 'presence:announced'
+    LAST_SEEN_KEY = 'presence:last_seen'
+
+    def __init__(self, url):
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+        self._async_clients = LoopClients(url)
+
+    @property
+    def async_client(self):
+        return self._async_clients.get()
+
+    def key(self, user_id):
+        return f'presence:{user_id}'
+
+    async def add(self, user_id, channel_name):
+        now, ttl = time.time(), presence_ttl()
+        key = self.key(user_id)
+        pipe = self.async_client.pipeline(transaction=True)
+        pipe.zadd(key, {channel_name: now + ttl})
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        pipe.expire(key, int(ttl) + 1)
+        return (await pipe.execute())[2]
+
+    async def remove(self, user_id, channel_name):
+        now = time.time()
+        key = self.key(user_id)
+        pipe = self.async_client.pipeline(transaction=True)
+        pipe.zrem(key, channel_name)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        live = (await pipe.execute())[2]
+        if not live:
+            await self.async_client.hset(self.LAST_SEEN_KEY, user_id, now)
+        return live
+
+    def _count_live(self, pipe, user_ids):
+        now = time.time()
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), now, '+inf')
+
+    def online_ids(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        self._count_live(pipe, user_ids)
+        return {user_id for user_id, live in zip(user_ids, pipe.execute()) if live}
+
+    async def aonline_ids(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.async_client.pipeline(transaction=False)
+        self._count_live(pipe, user_ids)
+        return {user_id for user_id, live in zip(user_ids, await pipe.execute()) if live}
+
+    async def mark_announced(self, user_id, online):
+        if online:
+            return await self.async_client.sadd(self.ANNOUNCED_KEY, user_id) > 0
+        return await self.async_client.srem(self.ANNOUNCED_KEY, user_id) > 0
+
+    async def pop_last_seen(self):
+        pipe = self.async_client.pipeline(transaction=True)
+        pipe.hgetall(self.LAST_SEEN_KEY)
+        pipe.delete(self.LAST_SEEN_KEY)
+        last_seen, _ = await pipe.execute()
+        return {int(user_id): float(seen) for user_id, seen in last_seen.items()}
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                url = getattr(settings, 'CHAT_PRESENCE_REDIS_URL', '')
+                _backend = RedisPresence(url) if url else LocalPresence()
+    return _backend
+
+
+def online_ids(user_ids):
+    """The subset of ``user_ids`` with at least one live socket, in one backend round trip."""
+    user_ids = list(user_ids)
+    return get_backend().online_ids(user_ids) if user_ids else set()
+
+
+async def aonline_ids(user_ids):
+    user_ids = list(user_ids)
+    return await get_backend().aonline_ids(user_ids) if user_ids else set()
+
+
+def is_online(user_id):
+    return user_id in online_ids([user_id])
+
+
+# Offline announcements and the last_online flusher outlive the consumer that
+# scheduled them; keep references so the tasks are not garbage collected.
+_tasks = set()
+_flusher = None
+
+
+def _spawn(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def connected(user_id, channel_name):
+    """
+    Register a socket of ``user_id``. Returns True if the user should be
+    announced online, i.e. friends last heard they were offline.
+    """
+    await get_backend().add(user_id, channel_name)
+    _ensure_flusher()
+    return await get_backend().mark_announced(user_id, True)
+
+
+async def heartbeat(user_id, channel_name):
+    await get_backend().add(user_id, channel_name)
+
+
+async def disconnected(user_id, channel_name, announce_offline):
+    """
+    Unregister a socket of ``user_id``. If it was their last one, await
+    ``announce_offline()`` once the grace period has passed without a reconnect.
+    """
+    if not await get_backend().remove(user_id, channel_name):
+        _spawn(_settle_offline(user_id, announce_offline))
+
+
+async def _settle_offline(user_id, announce_offline):
+    await asyncio.sleep(getattr(settings, 'CHAT_PRESENCE_OFFLINE_GRACE', 10))
+    backend = get_backend()
+    try:
+        if not await backend.aonline_ids([user_id]) and await backend.mark_announced(user_id, False):
+            await announce_offline()
+    except Exception as e:
+        logger.error(f"Error announcing user {user_id} offline: {e}")
+
+
+@db_sync_to_async
+def _write_last_online(last_seen):
+    users = [
+        User(pk=user_id, last_online=datetime.datetime.fromtimestamp(seen, tz=datetime.timezone.utc))
+        for user_id, seen in last_seen.items()
+    ]
+    User.objects.bulk_update(users, ['last_online'], batch_size=500)
+
+
+async def flush_last_online():
+    """Write buffered disconnect times to ``User.last_online`` in bulk. Returns the number of users written."""
+    last_seen = await get_backend().pop_last_seen()
+    if last_seen:
+        await _write_last_online(last_seen)
+    return len(last_seen)
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 30))
+        try:
+            await flush_last_online()
+        except Exception as e:
+            logger.error(f"Error flushing last_online: {e}")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None or _flusher.done() or _flusher.get_loop() is not asyncio.get_running_loop():
+        _flusher = _spawn(_flush_forever())
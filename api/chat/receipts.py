@@ -0,0 +1,80 @@
+"""
+Per-member read cursors.
+
+A ``ReadCursor`` stores the id of the newest message a member has read in a
+conversation. Message ids grow in creation order, so a message counts as seen
+by a member when its id is at or below their cursor, and the member's unread
+count is a range count above it. Marking a conversation read moves one cursor
+row and leaves the messages alone.
+"""
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Message, ReadCursor
+
+
+def conversation_filter(connection_id=None, group_id=None):
+    """Filter kwargs selecting one conversation's rows on any model keyed by connection or group."""
+    return {'connection_id': connection_id} if connection_id is not None else {'group_id': group_id}
+
+
+def advance(user, connection_id=None, group_id=None, message_id=None):
+    """
+    Move ``user``'s cursor forward to ``message_id``, or to the newest message if not given.
+
+    Returns ``(last_read_message_id, read_at)`` if the cursor moved and None if it was
+    already there (or the conversation has no messages). It never moves backwards.
+    """
+    conversation = conversation_filter(connection_id, group_id)
+    newest = Message.objects.filter(**conversation).aggregate(newest=Max('id'))['newest']
+    if newest is None:
+        return None
+    message_id = newest if message_id is None else min(int(message_id), newest)
+    read_at = timezone.now()
+
+    cursors = ReadCursor.objects.filter(user=user, **conversation)
+    if not cursors.filter(last_read_message_id__lt=message_id).update(last_read_message_id=message_id, read_at=read_at):
+        _, created = ReadCursor.objects.get_or_create(
+            user=user, **conversation, defaults={'last_read_message_id': message_id, 'read_at': read_at}
+        )
+        if not created:
+            return None
+    return message_id, read_at
+
+
+def unread_count(user, last_read_message_id, connection_id=None, group_id=None):
+    """Messages from other members above ``last_read_message_id``."""
+    return Message.objects.filter(
+        id__gt=last_read_message_id, **conversation_filter(connection_id, group_id)
+    ).exclude(user=user).count()
+
+
+class ReadState:
+    """The read cursors of one conversation, for answering whether a message has been seen."""
+
+    def __init__(self, cursors):
+        self.cursors = cursors  # [(user_id, last_read_message_id, read_at)]
+
+    @classmethod
+    def load(cls, connection_id=None, group_id=None):
+        return cls(list(
+            ReadCursor.objects.filter(**conversation_filter(connection_id, group_id))
+            .values_list('user_id', 'last_read_message_id', 'read_at')
+        ))
+
+    def seen_at(self, message):
+        """
+        When ``message`` was read by a member other than its author, or None if nobody has.
+
+        A cursor only remembers when it last moved, so with several readers this is the
+        earliest of their ``read_at`` times rather than the exact moment of the first read.
+        """
+        return self.read_at(message.user_id, message.id)
+
+    def read_at(self, author_id, message_id):
+        """``seen_at`` for a message known only by its author and id."""
+        read_times = [
+            read_at for user_id, last_read_message_id, read_at in self.cursors
+            if user_id != author_id and last_read_message_id >= message_id
+        ]
+        return min(read_times) if read_times else None
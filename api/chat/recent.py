@@ -0,0 +1,232 @@
+"""
+Hot-conversation cache: the newest messages of each conversation, serialized.
+
+Opening a chat asks for page 0 of ``message.list``. For conversations in this
+cache that page is answered from up to CHAT_RECENT_MESSAGES + 1 stored
+viewer-neutral payloads (the extra one tells whether older messages exist)
+instead of a ``Message`` query and serialization. ``is_me`` and the read state
+are filled in per viewer when the page is served, so one copy serves everyone.
+
+Every cached page carries a version, the conversation's ``last_seq`` when it
+was built. Every write to a conversation's messages takes a new sequence
+number (see ``chat.sync``), so a page is only served while its version equals
+the ``last_seq`` just read from the database; anything else is a miss and the
+page is rebuilt. Writers keep pages current instead of dropping them:
+``added`` and ``changed`` apply a write at version N only to a page at version
+N - 1 and drop the page otherwise, so concurrent edits applied out of order
+can never leave a page that claims to be newer than its contents.
+
+Pages live in Redis, a list of entries plus a version key per conversation,
+when CHAT_RECENT_REDIS_URL is set and in process memory otherwise. They expire
+CHAT_RECENT_TTL seconds after their last write.
+"""
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .encoding import dumps, loads
+from .models import Message
+from .fast_serializers import serialize_message
+
+logger = logging.getLogger(__name__)
+
+# Replace the page at ARGV[1] (version) unless a newer one is already stored
+FILL_LUA = """
+    local current = redis.call('GET', KEYS[2])
+    if current and tonumber(current) >= tonumber(ARGV[1]) then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    if #ARGV > 2 then
+        redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+    return 1
+"""
+
+# Move the page from version ARGV[1] to ARGV[2]: the entry whose id prefix is ARGV[4] is replaced
+# by ARGV[5] if the page holds it, and otherwise ARGV[3] 'add' pushes ARGV[5] as the newest. A page
+# filled just after the message was sent already holds it, so 'add' must not push it twice. A
+# page at any other version is dropped.
+APPLY_LUA = """
+    local current = redis.call('GET', KEYS[2])
+    if not current then
+        return 0
+    end
+    if current ~= ARGV[1] then
+        redis.call('DEL', KEYS[1], KEYS[2])
+        return -1
+    end
+    local found = false
+    local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+    for i, entry in ipairs(entries) do
+        if string.sub(entry, 1, #ARGV[4]) == ARGV[4] then
+            redis.call('LSET', KEYS[1], i - 1, ARGV[5])
+            found = true
+            break
+        end
+    end
+    if ARGV[3] == 'add' and not found then
+        redis.call('LPUSH', KEYS[1], ARGV[5])
+        redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[6]) - 1)
+    end
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[7])
+    redis.call('EXPIRE', KEYS[1], ARGV[7])
+    return 1
+"""
+
+
+def cache_size():
+    return getattr(settings, 'CHAT_RECENT_MESSAGES', 50)
+
+
+def recent_ttl():
+    return getattr(settings, 'CHAT_RECENT_TTL', 3600)
+
+
+def conversation_key(connection_id=None, group_id=None):
+    return f'c{connection_id}' if connection_id is not None else f'g{group_id}'
+
+
+class LocalRecent:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pages = {}  # {key: (version, expires, [(message_id, author_id, payload)] newest first)}
+
+    def read(self, key):
+        with self._lock:
+            version, expires, entries = self.pages.get(key, (None, 0, []))
+            if expires <= time.time():
+                return None, []
+            return version, list(entries)
+
+    def fill(self, key, version, entries):
+        with self._lock:
+            current = self.pages.get(key)
+            if current is not None and current[1] > time.time() and current[0] >= version:
+                return
+            self.pages[key] = (version, time.time() + recent_ttl(), list(entries))
+
+    def apply(self, key, expected, version, entry, add):
+        with self._lock:
+            current = self.pages.get(key)
+            if current is None or current[1] <= time.time():
+                return
+            if current[0] != expected:
+                del self.pages[key]
+                return
+            entries = current[2]
+            if add and all(cached[0] != entry[0] for cached in entries):
+                entries = [entry] + entries[:cache_size()]
+            else:
+                entries = [entry if cached[0] == entry[0] else cached for cached in entries]
+            self.pages[key] = (version, time.time() + recent_ttl(), entries)
+
+
+class RedisRecent:
+    """``recent:<key>`` lists of ``<id>|<json>`` entries, newest first, and ``recent:<key>:v`` versions."""
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+        self.fill_script = self.client.register_script(FILL_LUA)
+        self.apply_script = self.client.register_script(APPLY_LUA)
+
+    def keys(self, key):
+        return [f'recent:{key}', f'recent:{key}:v']
+
+    @staticmethod
+    def encode(entry):
+        message_id, author_id, payload = entry
+        return f'{message_id}|{dumps([author_id, payload])}'
+
+    def read(self, key):
+        entries_key, version_key = self.keys(key)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(version_key)
+        pipe.lrange(entries_key, 0, -1)
+        version, entries = pipe.execute()
+        if version is None:
+            return None, []
+        decoded = []
+        for entry in entries:
+            message_id, data = entry.decode().split('|', 1)
+            author_id, payload = loads(data)
+            decoded.append((int(message_id), author_id, payload))
+        return int(version), decoded
+
+    def fill(self, key, version, entries):
+        self.fill_script(keys=self.keys(key), args=[version, int(recent_ttl()), *map(self.encode, entries)])
+
+    def apply(self, key, expected, version, entry, add):
+        self.apply_script(keys=self.keys(key), args=[
+            expected, version, 'add' if add else 'update', f'{entry[0]}|', self.encode(entry),
+            cache_size() + 1, int(recent_ttl()),
+        ])
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                url = getattr(settings, 'CHAT_RECENT_REDIS_URL', '')
+                _backend = RedisRecent(url) if url else LocalRecent()
+    return _backend
+
+
+def newest(key, version, size):
+    """
+    The newest ``size`` + 1 entries ``(message_id, author_id, payload)`` of a conversation
+    at ``version``, or None if the cache cannot answer (a miss, or a page larger than it keeps).
+    """
+    if size > cache_size():
+        return None
+    try:
+        cached_version, entries = get_backend().read(key)
+    except Exception as e:
+        logger.error(f"Error reading cached messages of {key}: {e}")
+        return None
+    if cached_version != version:
+        return None
+    return entries[:size + 1]
+
+
+def fill(key, version, messages, payloads):
+    """Store the newest messages of a conversation, read at ``version``, with their viewer-neutral payloads."""
+    entries = [(message.id, message.user_id, payload) for message, payload in zip(messages, payloads)]
+    try:
+        get_backend().fill(key, version, entries[:cache_size() + 1])
+    except Exception as e:
+        logger.error(f"Error caching messages of {key}: {e}")
+
+
+def added(message, payload):
+    """Record a newly sent message, with its viewer-neutral payload, in its conversation's page."""
+    try:
+        get_backend().apply(
+            conversation_key(message.connection_id, message.group_id), message.seq - 1, message.seq,
+            (message.id, message.user_id, payload), add=True,
+        )
+    except Exception as e:
+        # The page keeps its old version, so readers miss and rebuild it
+        logger.error(f"Error caching message {message.id}: {e}")
+
+
+def changed(message):
+    """Record an edit, delete, pin or reaction, i.e. a ``sync.touch`` of ``message``."""
+    try:
+        current = Message.objects.for_serialization().get(pk=message.pk)
+        get_backend().apply(
+            conversation_key(message.connection_id, message.group_id), message.change_seq - 1, message.change_seq,
+            (current.id, current.user_id, serialize_message(current)), add=False,
+        )
+    except Exception as e:
+        logger.error(f"Error caching change to message {message.pk}: {e}")
@@ -0,0 +1,53 @@
+"""
+``redis.asyncio`` clients for each event loop.
+
+A ``redis.asyncio`` connection belongs to the event loop it was opened on, and
+using it from another loop fails with "attached to a different loop" or hangs.
+Daphne serves every socket from one loop, but ``async_to_sync`` in views,
+management commands and tests runs coroutines on loops of their own. Like
+``channels_redis``, ``LoopClients`` keeps one client per running loop and
+closes it when that loop is closed.
+"""
+import asyncio
+import logging
+import threading
+
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+
+class LoopClients:
+    """One ``redis.asyncio.Redis`` for ``url`` per running event loop."""
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.Lock()
+        self._clients = {}  # {event loop: client}
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(loop)
+                if client is None:
+                    client = self._clients[loop] = redis.asyncio.Redis.from_url(self.url)
+                    self._close_with(loop)
+        return client
+
+    def _close_with(self, loop):
+        original_close = loop.close
+
+        def close(*args, **kwargs):
+            loop.close = original_close
+            with self._lock:
+                client = self._clients.pop(loop, None)
+            if client is not None:
+                try:
+                    loop.run_until_complete(client.close(close_connection_pool=True))
+                except Exception as e:
+                    logger.error(f"Error closing Redis client of a closed event loop: {e}")
+            return original_close(*args, **kwargs)
+
+        loop.close = close
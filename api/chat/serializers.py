@@ -1,6 +1,9 @@
 from rest_framework import serializers
-from .models import User, Connection, Message, ImageUpload, Group, Reaction, Post, PostMedia, Comment
+from .models import User, Connection, Message, ImageUpload, Group, Reaction, Post, PostMedia, Comment, ReadCursor
+from .receipts import ReadState
+from . import presence
 from django.core.files.storage import default_storage
+from django.db import models
 import re
 from django.utils import timezone
 import datetime
@@ -39,27 +42,77 @@ class SignUpSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class UserSerializer(serializers.ModelSerializer):
+def load_presence(context, user_ids):
+    """Look up, in one presence call, whichever of ``user_ids`` this serializer context has not seen yet."""
+    known = context.setdefault('presence', {})
+    missing = {user_id for user_id in user_ids if user_id is not None and user_id not in known}
+    if missing:
+        online = presence.online_ids(missing)
+        known.update((user_id, user_id in online) for user_id in missing)
+
+class PresenceListSerializer(serializers.ListSerializer):
+    """Loads the presence of every user a batch will show before serializing any item of it."""
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        if self.context.get('online_ids') is None:
+            load_presence(self.context, self.child.presence_ids(items))
+        return super().to_representation(items)
+
+class PresenceMixin:
+    """
+    Serializers that show users. ``presence_ids(instances)`` lists the ids of those users, so a
+    root serializer, one instance or many, looks their presence up once instead of per user.
+    """
+
+    class Meta:
+        list_serializer_class = PresenceListSerializer
+
+    @classmethod
+    def presence_ids(cls, instances):
+        raise NotImplementedError
+
+    def to_representation(self, instance):
+        if self.parent is None and self.context.get('online_ids') is None:
+            load_presence(self.context, self.presence_ids([instance]))
+        return super().to_representation(instance)
+
+class UserSerializer(PresenceMixin, serializers.ModelSerializer):
     name = serializers.SerializerMethodField()
     online = serializers.SerializerMethodField()
 
-    class Meta:
+    class Meta(PresenceMixin.Meta):
         model = User
         fields = ['username', 'name', 'thumbnail', 'user_Bg_thumbnail', 'following', 'followers', 'online']
 
+    @classmethod
+    def presence_ids(cls, instances):
+        return [user.pk for user in instances]
+
     def get_name(self, obj):
         return f"{obj.first_name.capitalize()} {obj.last_name.capitalize()}"
 
     def get_online(self, obj):
-        return obj.is_online and (timezone.now() - obj.last_online).total_seconds() < 300
+        # Callers serializing many users pass the batch's presence as context['online_ids'];
+        # otherwise the enclosing batch loaded it into context['presence']
+        online_ids = self.context.get('online_ids')
+        if online_ids is not None:
+            return obj.pk in online_ids
+        load_presence(self.context, [obj.pk])
+        return self.context['presence'][obj.pk]
 
 class SearchSerializer(UserSerializer):
     status = serializers.SerializerMethodField()
 
-    class Meta:
+    class Meta(UserSerializer.Meta):
         model = User
         fields = ['username', 'name', 'thumbnail', 'status']
 
+    @classmethod
+    def presence_ids(cls, instances):
+        # Search results do not show presence
+        return []
+
     def get_status(self, obj):
         if obj.pending_them:
             return 'pending-them'
@@ -69,22 +122,33 @@ class SearchSerializer(UserSerializer):
             return 'connected'
         return 'no-connection'
 
-class RequestSerializer(serializers.ModelSerializer):
+class RequestSerializer(PresenceMixin, serializers.ModelSerializer):
     sender = UserSerializer()
     receiver = UserSerializer()
 
-    class Meta:
+    class Meta(PresenceMixin.Meta):
         model = Connection
         fields = ['id', 'sender', 'receiver', 'created']
 
-class GroupSerializer(serializers.ModelSerializer):
+    @classmethod
+    def presence_ids(cls, instances):
+        return [user_id for connection in instances for user_id in (connection.sender_id, connection.receiver_id)]
+
+class GroupSerializer(PresenceMixin, serializers.ModelSerializer):
     members = UserSerializer(many=True)
     admins = UserSerializer(many=True)
 
-    class Meta:
+    class Meta(PresenceMixin.Meta):
         model = Group
         fields = ['id', 'name', 'creator', 'members', 'admins', 'created']
 
+    @classmethod
+    def presence_ids(cls, instances):
+        group_ids = [group.pk for group in instances]
+        members = Group.members.through.objects.filter(group_id__in=group_ids).values_list('user_id', flat=True)
+        admins = Group.admins.through.objects.filter(group_id__in=group_ids).values_list('user_id', flat=True)
+        return [*members, *admins]
+
 class ReactionSerializer(serializers.ModelSerializer):
     user = serializers.SlugRelatedField(slug_field='username', read_only=True)
     class Meta:
@@ -121,24 +185,28 @@ class FriendSerializer(serializers.ModelSerializer):
 
     def get_unread_count(self, obj):
         user = self.context['user']
-        other_user = obj.sender if user == obj.receiver else obj.receiver
-        return Message.objects.filter(connection=obj, user=other_user, seen=False).count()
+        cursor = ReadCursor.objects.filter(user=user, connection=obj).values_list('last_read_message_id', flat=True).first()
+        return Message.objects.filter(connection=obj, id__gt=cursor or 0).exclude(user=user).count()
+
+# Formats datetimes returned by SerializerMethodFields the same way as declared DateTimeFields
+_datetime_field = serializers.DateTimeField()
 
 class MessageSerializer(serializers.ModelSerializer):
     is_me = serializers.SerializerMethodField()
     replied_to_message = serializers.SerializerMethodField()
     reactions = ReactionSerializer(many=True, read_only=True)
     mentions = serializers.SerializerMethodField()
-    seen = serializers.BooleanField(read_only=True)
-    seen_at = serializers.DateTimeField(read_only=True)
+    seen = serializers.SerializerMethodField()
+    seen_at = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = [
             'id', 'is_me', 'text', 'created', 'type', 'replied_to', 'replied_to_message',
             'reactions', 'mentions', 'is_deleted', 'pinned', 'disappearing', 'incognito',
-            'seen', 'seen_at', 'media_file'
+            'seen', 'seen_at', 'media_file', 'seq', 'change_seq'
         ]
+        read_only_fields = ['seq', 'change_seq']
 
     def get_is_me(self, obj):
         # Try to get the user directly from the context (used in WebSocket consumer)
@@ -148,8 +216,23 @@ class MessageSerializer(serializers.ModelSerializer):
             request = self.context.get('request')
             if request and hasattr(request, 'user'):
                 user = request.user
-        # Compare the user with the message's user if user is available
-        return user == obj.user if user else False
+        # Compare ids so the message's author never has to be loaded
+        return user.pk == obj.user_id if user else False
+
+    def read_state(self, obj):
+        # One ReadState per conversation, shared by every message serialized with this context
+        states = self.context.setdefault('read_states', {})
+        key = (obj.connection_id, obj.group_id)
+        if key not in states:
+            states[key] = ReadState.load(*key) if any(key) else ReadState([])
+        return states[key]
+
+    def get_seen(self, obj):
+        return self.read_state(obj).seen_at(obj) is not None
+
+    def get_seen_at(self, obj):
+        seen_at = self.read_state(obj).seen_at(obj)
+        return _datetime_field.to_representation(seen_at) if seen_at else None
 
     # Other methods (unchanged)
     def get_replied_to_message(self, obj):
@@ -178,20 +261,24 @@ class PostMediaSerializer(serializers.ModelSerializer):
         model = PostMedia
         fields = ['media_type', 'file']
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(PresenceMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
 
-    class Meta:
+    class Meta(PresenceMixin.Meta):
         model = Comment
         fields = ['id', 'content', 'user', 'post', 'created']
         read_only_fields = ['user', 'post', 'created']
 
+    @classmethod
+    def presence_ids(cls, instances):
+        return [comment.user_id for comment in instances]
+
     def validate_content(self, value):
         if not value.strip():
             raise serializers.ValidationError("Comment content cannot be empty.")
         return value
 
-class PostSerializer(serializers.ModelSerializer):
+class PostSerializer(PresenceMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     media = PostMediaSerializer(many=True, read_only=True)
     comments = CommentSerializer(many=True, read_only=True)
@@ -200,13 +287,19 @@ class PostSerializer(serializers.ModelSerializer):
     is_liked = serializers.SerializerMethodField()
     is_retweeted = serializers.SerializerMethodField()
 
-    class Meta:
+    class Meta(PresenceMixin.Meta):
         model = Post
         fields = [
             'id', 'user', 'content', 'created', 'media', 'comments',
             'likes_count', 'retweets_count', 'is_liked', 'is_retweeted'
         ]
 
+    @classmethod
+    def presence_ids(cls, instances):
+        post_ids = [post.pk for post in instances]
+        commenters = Comment.objects.filter(post_id__in=post_ids).values_list('user_id', flat=True)
+        return [*(post.user_id for post in instances), *commenters]
+
     def get_likes_count(self, obj):
         return obj.likes.count()
 
@@ -0,0 +1,112 @@
+"""
+Per-conversation sequence numbers and delta sync.
+
+Every 1:1 connection and group keeps a ``last_seq`` counter. Creating a message
+takes the next number as its ``seq``; editing, deleting, pinning or reacting
+to it takes another one as its ``change_seq``. A reconnecting client sends the
+highest number it has seen per conversation and gets back exactly the
+messages whose ``change_seq`` is above it, instead of reloading
+``friend.list`` and every open ``message.list``.
+
+Numbers are taken with a single-row ``UPDATE ... SET last_seq = last_seq + 1``
+on the conversation, so writers to different conversations never wait on each
+other. The row stays locked until the surrounding transaction commits, so
+within a conversation numbers become visible in order and a client can never
+see seq N+1 committed before seq N.
+"""
+from django.db import transaction
+from django.db.models import F, Q
+
+from . import recent
+from .models import Connection, Group, Message
+from .receipts import conversation_filter
+from .fast_serializers import serialize_messages
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+MAX_CONVERSATIONS = 200
+
+
+def allocate(connection_id=None, group_id=None, count=1):
+    """
+    The next sequence number of a conversation. Call it inside the transaction that
+    writes the message, which then holds the conversation's row lock until commit.
+
+    With ``count``, reserves that many consecutive numbers and returns the last one.
+    """
+    model, pk = (Connection, connection_id) if connection_id is not None else (Group, group_id)
+    counter = model.objects.filter(pk=pk)
+    counter.update(last_seq=F('last_seq') + count)
+    return counter.values_list('last_seq', flat=True).get()
+
+
+@transaction.atomic
+def touch(message):
+    """
+    Give ``message`` a new ``change_seq`` after it changed, so the next ``sync`` returns it
+    again, and refresh its conversation's cached page once the change is committed.
+    """
+    message.change_seq = allocate(message.connection_id, message.group_id)
+    Message.objects.filter(pk=message.pk).update(change_seq=message.change_seq)
+    transaction.on_commit(lambda: recent.changed(message))
+
+
+def parse_known(known):
+    """
+    Split the client's ``{connectionId: last_seq}`` map into connection and group maps.
+    Raises ValueError for malformed ids or sequence numbers.
+    """
+    if not isinstance(known, dict) or len(known) > MAX_CONVERSATIONS:
+        raise ValueError('conversations must be a map of at most %d entries' % MAX_CONVERSATIONS)
+    connections, groups = {}, {}
+    for key, seq in known.items():
+        key = str(key)
+        seq = int(seq or 0)
+        if key.startswith('group_'):
+            groups[int(key[len('group_'):])] = seq
+        else:
+            connections[int(key)] = seq
+    return connections, groups
+
+
+def changes(user, known, limit=DEFAULT_LIMIT):
+    """
+    The messages created or changed since the client's last known sequence numbers.
+
+    Returns one entry per conversation that has anything new, with the messages in
+    ``change_seq`` order and the ``seq`` to send next time. When more than ``limit``
+    changes are waiting, ``hasMore`` is set and ``seq`` points at the last change
+    returned, so repeating the request continues where this page stopped.
+    Conversations the user is not part of are ignored.
+    """
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    connections, groups = parse_known(known)
+    current = [
+        ((connection_id, None), str(connection_id), last_seq)
+        for connection_id, last_seq in Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user), id__in=connections, accepted=True
+        ).values_list('id', 'last_seq')
+    ] + [
+        ((None, group_id), f'group_{group_id}', last_seq)
+        for group_id, last_seq in Group.objects.filter(members=user, id__in=groups).values_list('id', 'last_seq')
+    ]
+
+    result = []
+    for (connection_id, group_id), key, last_seq in current:
+        since = connections[connection_id] if connection_id is not None else groups[group_id]
+        if since >= last_seq:
+            continue
+        page = list(
+            Message.objects.for_serialization()
+            .filter(change_seq__gt=since, **conversation_filter(connection_id, group_id))
+            .order_by('change_seq')[:limit + 1]
+        )
+        has_more = len(page) > limit
+        page = page[:limit]
+        result.append({
+            'connectionId': key,
+            'seq': page[-1].change_seq if has_more else last_seq,
+            'messages': serialize_messages(page, user),
+            'hasMore': has_more,
+        })
+    return result
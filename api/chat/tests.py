@@ -1,3 +1,1479 @@
-from django.test import TestCase
+import asyncio
+import collections
+import datetime
+import decimal
+import importlib
+import threading
+import uuid
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.db import connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import blocks, ephemeral, executors, expiry, history, inbox, mailbox, outbound, presence, receipts, recent, sync, throttling
+from .consumers import ChatConsumer
+from . import encoding
+from .encoding import dumps
+from .envelopes import envelope
+from .layers import RedisChannelLayer, chat_group_name, group_send_many
+from .fast_serializers import message_data, request_data, serialize_message, user_data
+from .models import User, Comment, Connection, ConversationSummary, Group, Message, Post, Reaction, ReadCursor, BlockedUser
+from .redis_clients import LoopClients
+from .serializers import GroupSerializer, MessageSerializer, PostSerializer, RequestSerializer, UserSerializer
+
+
+class MessageSerializationQueryTests(TestCase):
+    """A message page must cost the same number of queries whatever its size."""
+
+    # The page itself, its reactions (with their users) and the conversation's read cursors
+    QUERIES_PER_PAGE = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        previous = None
+        for i in range(30):
+            author = cls.alice if i % 2 else cls.bob
+            previous = Message.objects.create(
+                connection=cls.connection, user=author, text=f'message {i} @bob',
+                replied_to=previous if i % 3 == 0 else None,
+            )
+            for reactor in (cls.alice, cls.bob)[:i % 3]:
+                Reaction.objects.create(message=previous, user=reactor, emoji='👍')
+
+    def serialize_page(self, size):
+        messages = Message.objects.for_serialization().filter(connection=self.connection)
+        page, _ = history.older(messages, None, size)
+        return MessageSerializer(page, context={'user': self.alice}, many=True).data
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for size in (1, 5, 15, 30):
+            with self.subTest(size=size), self.assertNumQueries(self.QUERIES_PER_PAGE):
+                self.assertEqual(len(self.serialize_page(size)), size)
+
+    def test_fast_serializer_query_count_does_not_grow_with_page_size(self):
+        messages = Message.objects.for_serialization().filter(connection=self.connection)
+        for size in (1, 5, 15, 30):
+            with self.subTest(size=size), self.assertNumQueries(self.QUERIES_PER_PAGE):
+                page, _ = history.older(messages, None, size)
+                context = {}
+                self.assertEqual(len([message_data(message, self.alice, context) for message in page]), size)
+
+    def test_output_matches_unoptimized_queryset(self):
+        plain = Message.objects.filter(connection=self.connection).order_by('-created', '-id')[:15]
+        expected = MessageSerializer(plain, context={'user': self.alice}, many=True).data
+        self.assertEqual(self.serialize_page(15), expected)
+
+
+class FastSerializerTests(TestCase):
+    """The plain-function serializers must encode to exactly the same bytes as the DRF ones."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(
+            username='alice', first_name='alice', last_name='a', thumbnail='uploads/thumbnails/alice.jpg',
+            is_online=True, last_online=timezone.now(),
+        )
+        cls.bob = User.objects.create(
+            username='bob', first_name='bob', last_name='b', user_Bg_thumbnail='uploads/backgrounds/bob.jpg',
+        )
+        cls.alice.following.add(cls.bob)
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        first = Message.objects.create(connection=cls.connection, user=cls.alice, text='hi @bob')
+        Message.objects.create(
+            connection=cls.connection, user=cls.bob, text='', type='image',
+            media_file='uploads/messages/photo.jpg', replied_to=first, disappearing=30,
+        )
+        Message.objects.create(connection=cls.connection, user=cls.alice, text='later', pinned=True)
+        Reaction.objects.create(message=first, user=cls.bob, emoji='👍')
+        receipts.advance(cls.bob, cls.connection.id, message_id=first.id)
+
+    def test_user_payload_is_identical(self):
+        for user in (self.alice, self.bob):
+            self.assertEqual(dumps(user_data(user)), dumps(UserSerializer(user).data))
+
+    def test_message_payloads_are_identical(self):
+        messages = Message.objects.for_serialization().filter(connection=self.connection)
+        for viewer in (None, self.alice, self.bob):
+            for message in messages:
+                with self.subTest(viewer=viewer, message=message.id):
+                    self.assertEqual(
+                        dumps(message_data(message, viewer)),
+                        dumps(MessageSerializer(message, context={'user': viewer}).data),
+                    )
+
+    def test_request_payload_is_identical(self):
+        self.assertEqual(dumps(request_data(self.connection)), dumps(RequestSerializer(self.connection).data))
+
+
+class SerializerPresenceTests(TestCase):
+    """Serializers look up the presence of every user they show at once, not per user."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = (
+            User.objects.create(username=name, first_name=name, last_name='x') for name in ('alice', 'bob', 'carol')
+        )
+        for author, commenter in ((cls.alice, cls.bob), (cls.bob, cls.carol)):
+            post = Post.objects.create(user=author, content='hello')
+            Comment.objects.create(post=post, user=commenter, content='hi')
+            Comment.objects.create(post=post, user=None, content='anonymous')
+        cls.group = Group.objects.create(name='g', creator=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob)
+        cls.group.admins.add(cls.carol)
+
+    def setUp(self):
+        self.lookups = []
+
+        def online_ids(user_ids):
+            self.lookups.append(set(user_ids))
+            return {self.bob.pk} & set(user_ids)
+
+        patcher = mock.patch.object(presence, 'online_ids', online_ids)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def online(self, users):
+        return {user['username']: user['online'] for user in users}
+
+    def test_posts_and_their_comments(self):
+        posts = PostSerializer(
+            Post.objects.order_by('id'), many=True, context={'request': mock.Mock(user=AnonymousUser())}
+        ).data
+        self.assertEqual(self.lookups, [{self.alice.pk, self.bob.pk, self.carol.pk}])
+        self.assertEqual(self.online(post['user'] for post in posts), {'alice': False, 'bob': True})
+        commenters = [comment['user'] for post in posts for comment in post['comments'] if comment['user']]
+        self.assertEqual(self.online(commenters), {'bob': True, 'carol': False})
+
+    def test_group_members_and_admins(self):
+        group = GroupSerializer(self.group).data
+        self.assertEqual(self.lookups, [{self.alice.pk, self.bob.pk, self.carol.pk}])
+        self.assertEqual(self.online(group['members']), {'alice': False, 'bob': True})
+        self.assertEqual(self.online(group['admins']), {'carol': False})
+
+    def test_user_list(self):
+        users = UserSerializer(User.objects.all(), many=True).data
+        self.assertEqual(len(self.lookups), 1)
+        self.assertEqual(self.online(users), {'alice': False, 'bob': True, 'carol': False})
+
+
+@override_settings(CHAT_PRESENCE_REDIS_URL='', CHAT_PRESENCE_OFFLINE_GRACE=0)
+class PresenceTests(TestCase):
+    """Users stay online until their last socket goes, and friends hear about it once."""
+
+    def setUp(self):
+        patcher = mock.patch.object(presence, '_backend', presence.LocalPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @async_to_sync
+    async def session(self, steps):
+        announcements = []
+
+        async def announce_offline():
+            announcements.append('offline')
+
+        for action, channel_name in steps:
+            if action == 'connect':
+                if await presence.connected(1, channel_name):
+                    announcements.append('online')
+            elif action == 'wait':
+                await asyncio.sleep(0.1)
+            else:
+                await presence.disconnected(1, channel_name, announce_offline)
+            # Let pending offline announcements settle before the next step
+            await asyncio.sleep(0.01)
+        return announcements
+
+    def test_online_until_last_device_disconnects(self):
+        self.session([('connect', 'phone'), ('connect', 'laptop'), ('disconnect', 'phone')])
+        self.assertTrue(presence.is_online(1))
+        self.assertEqual(self.session([('disconnect', 'laptop')]), ['offline'])
+        self.assertFalse(presence.is_online(1))
+
+    def test_second_device_is_not_announced(self):
+        self.assertEqual(self.session([('connect', 'phone'), ('connect', 'laptop')]), ['online'])
+
+    def test_reconnect_within_grace_is_not_announced(self):
+        with override_settings(CHAT_PRESENCE_OFFLINE_GRACE=0.05):
+            announcements = self.session([('connect', 'phone'), ('disconnect', 'phone'), ('connect', 'phone'), ('wait', None)])
+        self.assertEqual(announcements, ['online'])
+
+    def test_socket_expires_without_heartbeat(self):
+        self.session([('connect', 'phone')])
+        with mock.patch.object(presence.time, 'time', return_value=presence.time.time() + 3600):
+            self.assertFalse(presence.is_online(1))
+
+
+class ExecutorStatsTests(TestCase):
+    """The instrumented pools count work as it queues, runs and finishes."""
+
+    def test_counters_follow_blocked_work(self):
+        pool = executors.InstrumentedThreadPoolExecutor('test', 1)
+        self.addCleanup(pool.shutdown)
+        started, release = threading.Event(), threading.Event()
+
+        def work():
+            started.set()
+            release.wait(5)
+
+        futures = [pool.submit(work)]
+        self.assertTrue(started.wait(5))
+        futures += [pool.submit(work) for _ in range(2)]
+        self.assertEqual(
+            pool.stats(), {'size': 1, 'queued': 2, 'running': 1, 'completed': 0, 'peak_queued': 2},
+        )
+        release.set()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(
+            pool.stats(), {'size': 1, 'queued': 0, 'running': 0, 'completed': 3, 'peak_queued': 2},
+        )
+
+    def test_pool_stats_reports_every_pool(self):
+        started, release = threading.Event(), threading.Event()
+
+        def work():
+            started.set()
+            release.wait(5)
+
+        before = executors.pool_stats()
+        self.assertEqual(set(before), {'db', 'cpu', 'http'})
+        future = executors.POOLS['http'].submit(work)
+        self.assertTrue(started.wait(5))
+        self.assertEqual(executors.pool_stats()['http']['running'], before['http']['running'] + 1)
+        release.set()
+        future.result(5)
+        after = executors.pool_stats()['http']
+        self.assertEqual(after['running'], before['http']['running'])
+        self.assertEqual(after['completed'], before['http']['completed'] + 1)
+
+
+class LoopClientsTests(TestCase):
+    """redis.asyncio clients are never shared between event loops."""
+
+    def test_one_client_per_loop_closed_with_it(self):
+        clients = LoopClients('redis://localhost:6379/0')
+
+        async def get():
+            return clients.get(), clients.get()
+
+        loop = asyncio.new_event_loop()
+        first, again = loop.run_until_complete(get())
+        self.assertIs(first, again)
+        other_loop = asyncio.new_event_loop()
+        other = other_loop.run_until_complete(get())[0]
+        self.assertIsNot(first, other)
+        loop.close()
+        other_loop.close()
+        self.assertEqual(clients._clients, {})
+
+
+class SocketLimiterTests(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(throttling.time, 'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_refill(self):
+        limiter = throttling.SocketLimiter({'search': (1, 3)})
+        self.assertEqual([limiter.allow('search') for _ in range(4)], [True, True, True, False])
+        self.now += 1
+        self.assertEqual([limiter.allow('search') for _ in range(2)], [True, False])
+
+    def test_sources_have_separate_buckets(self):
+        limiter = throttling.SocketLimiter({'search': (1, 1), 'default': (1, 2)})
+        self.assertTrue(limiter.allow('search'))
+        self.assertFalse(limiter.allow('search'))
+        self.assertTrue(limiter.allow('friend.list'))
+        self.assertTrue(limiter.allow('message.list'))
+
+    @override_settings(CHAT_RATE_LIMIT_STRIKES=2, CHAT_RATE_LIMIT_STRIKE_WINDOW=60)
+    def test_strikes_run_out(self):
+        limiter = throttling.SocketLimiter({})
+        self.assertEqual([limiter.strike() for _ in range(3)], [True, True, False])
+
+
+@skipUnless(encoding.orjson, 'orjson is not installed')
+class JsonEncoderParityTests(TestCase):
+    """orjson and the stdlib fallback encode frames to the same text."""
+
+    def test_same_output(self):
+        moment = datetime.datetime(2026, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc)
+        values = {
+            'aware': moment,
+            'offset': moment.astimezone(datetime.timezone(datetime.timedelta(hours=5, minutes=30))),
+            'naive': moment.replace(tzinfo=None, microsecond=0),
+            'date': moment.date(),
+            'time': moment.time(),
+            'uuid': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'decimal': decimal.Decimal('12.50'),
+            'text': 'héllo 👋 日本語 "quoted" \\ \n\t\u2028',
+            'nested': [{'emoji': '🔥', 'ids': [1, 2.5, None, True]}],
+            7: 'integer key',
+        }
+        for key, value in values.items():
+            with self.subTest(key=key):
+                self.assertEqual(encoding.dumps({key: value}), encoding.stdlib_dumps({key: value}))
+        self.assertEqual(encoding.dumps(values), encoding.stdlib_dumps(values))
+
+
+class MsgpackFrameTests(TestCase):
+    """Binary frames decode to exactly the frame that was encoded, with or without short keys."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def frames(self):
+        original = Message.objects.create(connection=self.connection, user=self.bob, text='hi @alice', seq=1, change_seq=1)
+        reply = Message.objects.create(
+            connection=self.connection, user=self.alice, text='héllo 👋', replied_to=original, seq=2, change_seq=2
+        )
+        Reaction.objects.create(message=reply, user=self.bob, emoji='🔥')
+        message = Message.objects.for_serialization().get(pk=reply.pk)
+        return [
+            {'source': 'message.send', 'data': {
+                'message': message_data(message), 'friend': user_data(self.bob, set()), 'connectionId': str(self.connection.id),
+            }},
+            {'source': 'online.status', 'data': {'username': 'bob', 'online': True}},
+            {'type': 'rider_location', 'data': {'latitude': 1.5, 'longitude': -2.25, 'trip_id': 7}},
+            {'source': 'reaction.add', 'data': {'messageId': reply.pk, 'emoji': '🔥', 'user': 'bob'}},
+        ]
+
+    def test_round_trip(self):
+        for codec in (encoding.MSGPACK, encoding.MSGPACK_SHORT):
+            for frame in self.frames():
+                with self.subTest(codec=codec, source=frame.get('source') or frame.get('type')):
+                    text_data, bytes_data = encoding.encode_frame(frame, codec)
+                    self.assertIsNone(text_data)
+                    self.assertEqual(encoding.decode_frame(None, bytes_data, codec), frame)
+
+    def test_short_keys_only_for_high_volume_events(self):
+        message_send, _, _, reaction = self.frames()
+        packed = encoding.msgpack.unpackb(encoding.encode_frame(message_send, encoding.MSGPACK_SHORT)[1], raw=False)
+        self.assertEqual(set(packed), {'s', 'd'})
+        self.assertEqual(set(packed['d']['m']['rm']), {'i', 'x', 't', 'us', 'ts'})
+        packed = encoding.msgpack.unpackb(encoding.encode_frame(reaction, encoding.MSGPACK_SHORT)[1], raw=False)
+        self.assertEqual(packed, reaction)
+
+    def test_invalid_frame(self):
+        with self.assertRaises(encoding.FrameDecodeError):
+            encoding.decode_frame(None, b'\xc1', encoding.MSGPACK)
+
+    def test_binary_frame_on_a_json_socket(self):
+        frame = {'source': 'message.send', 'data': {'message': 'héllo 👋'}}
+        self.assertEqual(encoding.decode_frame(None, dumps(frame).encode(), encoding.JSON), frame)
+        with self.assertRaises(encoding.FrameDecodeError):
+            encoding.decode_frame(None, b'\xff{}', encoding.JSON)
+
+
+@override_settings(CHAT_OUTBOUND_QUEUE_SIZE=3, CHAT_OUTBOUND_MAX_BACKLOG=5)
+class OutboundQueueTests(TestCase):
+    """Frames queued behind a slow client are collapsed or dropped by policy, never reordered."""
+
+    @async_to_sync
+    async def deliver(self, frames):
+        sent, closed = [], []
+        release = asyncio.Event()
+
+        async def send(text_data=None, bytes_data=None):
+            await release.wait()
+            sent.append(text_data)
+
+        async def close():
+            closed.append(True)
+
+        queue = outbound.OutboundQueue(send, close)
+        queue.put('first')
+        await asyncio.sleep(0)  # the writer takes 'first' and stalls on the slow client
+        for text, policy, key in frames:
+            queue.put(text, None, policy, key)
+        release.set()
+        await asyncio.sleep(0.01)
+        return sent, bool(closed)
+
+    def test_latest_frames_collapse_in_place(self):
+        sent, _ = self.deliver([
+            ('bob online', outbound.LATEST, 'online.status:bob'),
+            ('message', outbound.RELIABLE, None),
+            ('bob offline', outbound.LATEST, 'online.status:bob'),
+        ])
+        self.assertEqual(sent, ['first', 'bob offline', 'message'])
+
+    def test_oldest_droppable_frame_is_evicted_when_full(self):
+        sent, closed = self.deliver([
+            ('post 1', outbound.DROPPABLE, None),
+            ('post 2', outbound.DROPPABLE, None),
+            ('message', outbound.RELIABLE, None),
+            ('post 3', outbound.DROPPABLE, None),
+        ])
+        self.assertEqual(sent, ['first', 'post 2', 'message', 'post 3'])
+        self.assertFalse(closed)
+
+    def test_reliable_backlog_overflow_closes_socket(self):
+        sent, closed = self.deliver([(f'message {i}', outbound.RELIABLE, None) for i in range(6)])
+        # The socket is being closed, so even the frame in flight is abandoned
+        self.assertEqual(sent, [])
+        self.assertTrue(closed)
+
+
+class GroupSendManyTests(TestCase):
+    """One event reaches every channel of many groups, once per channel."""
+
+    def test_fallback_sends_once_per_group(self):
+        class Layer:
+            def __init__(self):
+                self.sent = []
+
+            async def group_send(self, group, message):
+                self.sent.append(group)
+
+        layer = Layer()
+        async_to_sync(group_send_many)(layer, ['alice', 'bob', 'alice'], {'type': 'broadcast_group'})
+        self.assertEqual(sorted(layer.sent), ['alice', 'bob'])
+
+    def test_redis_layer_delivers_to_each_channel_once(self):
+        members = {b'asgi:group:alice': [b'alice.phone', b'shared.tab'], b'asgi:group:bob': [b'shared.tab', b'bob.laptop']}
+        evals = []
+
+        class Pipeline:
+            def __init__(self):
+                self.results = []
+
+            def zremrangebyscore(self, key, min, max):
+                self.results.append(0)
+
+            def zrange(self, key, start, end):
+                self.results.append(members[key])
+
+            async def execute(self):
+                return self.results
+
+        class Connection:
+            def pipeline(self, transaction):
+                return Pipeline()
+
+            async def eval(self, script, numkeys, *keys_and_args):
+                evals.append(keys_and_args[:numkeys])
+                return 0
+
+        layer = RedisChannelLayer(hosts=[('localhost', 6379)])
+        with mock.patch.object(layer, 'connection', return_value=Connection()):
+            async_to_sync(layer.group_send_many)(['alice', 'bob'], {'type': 'broadcast_group'})
+        self.assertEqual(len(evals), 1)
+        self.assertEqual(sorted(evals[0]), ['asgialice.phone', 'asgibob.laptop', 'asgishared.tab'])
+
+
+@override_settings(CHAT_PRESENCE_REDIS_URL='')
+class InboxTests(TestCase):
+    """Summary rows keep previews and unread counts current, and friend.list pages over them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        inbox.open_conversation([cls.alice, cls.bob], connection=cls.connection)
+
+    def setUp(self):
+        patcher = mock.patch.object(presence, '_backend', presence.LocalPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, text, connection=None, author=None, reader=None):
+        connection = connection or self.connection
+        author, reader = author or self.alice, reader or self.bob
+        seq = sync.allocate(connection.id)
+        message = Message.objects.create(connection=connection, user=author, text=text, seq=seq, change_seq=seq)
+        inbox.record_message(message, [author, reader])
+        return message
+
+    def unread(self, user):
+        summary = ConversationSummary.objects.get(user=user, connection=self.connection)
+        return summary.unread_count, inbox.unread_total(user)
+
+    def test_send_counts_unread_for_recipient(self):
+        self.send('one')
+        self.send('two')
+        self.assertEqual(self.unread(self.bob), (2, 2))
+        self.assertEqual(self.unread(self.alice), (0, 0))
+        self.assertEqual(inbox.find_entry(self.bob, connection_id=self.connection.id)['preview'], 'two')
+
+    def test_mark_read_decrements_unread(self):
+        first = self.send('one')
+        self.send('two')
+        self.assertEqual(inbox.mark_read(self.bob, self.connection.id, message_id=first.pk)[2], 1)
+        self.assertEqual(self.unread(self.bob), (1, 1))
+        self.assertEqual(inbox.mark_read(self.bob, self.connection.id)[2], 1)
+        self.assertEqual(self.unread(self.bob), (0, 0))
+        self.assertIsNone(inbox.mark_read(self.bob, self.connection.id))
+
+    def test_deleting_latest_moves_preview_back(self):
+        first = self.send('one')
+        second = self.send('two')
+        Message.objects.filter(pk=second.pk).update(is_deleted=True)
+        self.assertEqual(inbox.record_delete(second), ('one', first.created))
+        Message.objects.filter(pk=first.pk).update(is_deleted=True)
+        self.assertEqual(inbox.record_delete(first)[0], inbox.NEW_CONNECTION_PREVIEW)
+
+    def test_friend_page_cursor(self):
+        friends = [User.objects.create(username=f'f{i}', first_name='f', last_name=str(i)) for i in range(3)]
+        for friend in friends:
+            connection = Connection.objects.create(sender=self.alice, receiver=friend, accepted=True)
+            inbox.open_conversation([self.alice, friend], connection=connection)
+            self.send(f'to {friend.username}', connection, reader=friend)
+        first = inbox.friend_page(self.alice, 2)
+        self.assertEqual([entry['preview'] for entry in first['conversations']], ['to f2', 'to f1'])
+        second = inbox.friend_page(self.alice, 2, first['next'])
+        self.assertEqual([entry['preview'] for entry in second['conversations']], ['to f0', inbox.NEW_CONNECTION_PREVIEW])
+        self.assertIsNone(second['next'])
+        with self.assertRaises(ValueError):
+            inbox.friend_page(self.alice, 2, 'not a cursor')
+
+    def test_backfill_counts_unseen_messages(self):
+        self.send('read')
+        self.send('unread')
+        Message.objects.filter(text='read').update(seen=True)
+        ConversationSummary.objects.all().delete()
+        User.objects.update(unread_total=0)
+        importlib.import_module('chat.migrations.0032_backfill_conversationsummary').backfill(apps, None)
+        self.assertEqual(self.unread(self.bob), (1, 1))
+        self.assertEqual(inbox.find_entry(self.alice, connection_id=self.connection.id)['preview'], 'unread')
+
+
+class ReadCursorTests(TestCase):
+    """Read cursors only move forward, and seen/seen_at are derived from them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.carol = User.objects.create(username='carol', first_name='carol', last_name='c')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        cls.group = Group.objects.create(name='g', creator=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob)
+        cls.messages = [
+            Message.objects.create(connection=cls.connection, user=cls.alice, text=f'm{i}', seq=i + 1, change_seq=i + 1)
+            for i in range(3)
+        ]
+        for message in cls.messages:
+            inbox.record_message(message, [cls.alice, cls.bob])
+
+    def cursor(self, user):
+        return ReadCursor.objects.filter(user=user, connection=self.connection).values_list('last_read_message_id', flat=True).get()
+
+    def test_advance_upserts_one_cursor(self):
+        first, second, newest = self.messages
+        self.assertEqual(receipts.advance(self.bob, self.connection.id, message_id=first.pk)[0], first.pk)
+        self.assertEqual(receipts.advance(self.bob, self.connection.id, message_id=second.pk)[0], second.pk)
+        self.assertEqual(ReadCursor.objects.filter(user=self.bob).count(), 1)
+        # Ids past the newest message stop at it
+        self.assertEqual(receipts.advance(self.bob, self.connection.id, message_id=newest.pk + 100)[0], newest.pk)
+
+    def test_advance_never_moves_back(self):
+        first, second, _ = self.messages
+        receipts.advance(self.bob, self.connection.id, message_id=second.pk)
+        self.assertIsNone(receipts.advance(self.bob, self.connection.id, message_id=first.pk))
+        self.assertIsNone(receipts.advance(self.bob, self.connection.id, message_id=second.pk))
+        self.assertEqual(self.cursor(self.bob), second.pk)
+
+    def test_seen_is_derived_from_other_members_cursors(self):
+        first, second, _ = self.messages
+        receipts.advance(self.alice, self.connection.id)
+        self.assertFalse(MessageSerializer(first).data['seen'])
+        _, read_at = receipts.advance(self.bob, self.connection.id, message_id=first.pk)
+        data = [MessageSerializer(message).data for message in (first, second)]
+        self.assertEqual([(d['seen'], d['seen_at'] is not None) for d in data], [(True, True), (False, False)])
+        self.assertEqual(receipts.ReadState.load(self.connection.id).seen_at(first), read_at)
+
+    def test_migration_starts_cursors_at_seen_flags(self):
+        first, second, _ = self.messages
+        Message.objects.filter(pk__in=[first.pk, second.pk]).update(seen=True, seen_at=timezone.now())
+        importlib.import_module('chat.migrations.0034_seen_flags_to_readcursor').seen_flags_to_cursors(apps, None)
+        self.assertEqual(self.cursor(self.bob), second.pk)
+        self.assertFalse(ReadCursor.objects.filter(user=self.alice).exists())
+
+    def mark_seen(self, user, url, **body):
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch('chat.views.send_or_hold', new=mock.AsyncMock()), \
+                mock.patch('chat.views.group_send_many', new=mock.AsyncMock()) as fanout:
+            response = client.post(url, body, format='json')
+        return response, fanout
+
+    def test_mark_seen_view(self):
+        first = self.messages[0]
+        response, fanout = self.mark_seen(self.bob, reverse('mark-seen', args=[self.connection.id]), message_id=first.pk)
+        self.assertEqual(response.data, {'marked_count': 1, 'last_read_message_id': first.pk})
+        (_, targets, receipt), _ = fanout.call_args
+        self.assertEqual((targets, receipt['type'], receipt['lastReadMessageId']), (['alice'], 'read_receipt', first.pk))
+        response, _ = self.mark_seen(self.carol, reverse('mark-seen', args=[self.connection.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_mark_seen_group_route(self):
+        message = Message.objects.create(group=self.group, user=self.alice, text='hi', seq=1, change_seq=1)
+        response, fanout = self.mark_seen(self.bob, reverse('mark-group-seen', args=[self.group.id]))
+        self.assertEqual(response.data['last_read_message_id'], message.pk)
+        self.assertEqual(fanout.call_args[0][1], [chat_group_name(self.group.id)])
+        response, _ = self.mark_seen(self.carol, reverse('mark-group-seen', args=[self.group.id]))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(CHAT_READ_RECEIPT_DELAY=0.01)
+    def test_receipts_are_coalesced(self):
+        consumer = ChatConsumer()
+        consumer.username = 'alice'
+        consumer.pending_receipts = {}
+        consumer.receipt_flush = None
+        sent = []
+
+        async def send_frame(frame, policy=None, key=None):
+            sent.append(frame['data'])
+
+        consumer.send_frame = send_frame
+
+        async def burst():
+            for username, last_read in (('bob', 5), ('bob', 3), ('bob', 7), ('carol', 2), ('alice', 9)):
+                await consumer.read_receipt({
+                    'type': 'read_receipt', 'connectionId': '1', 'username': username, 'lastReadMessageId': last_read,
+                })
+            await consumer.receipt_flush
+
+        async_to_sync(burst)()
+        self.assertEqual([(r['username'], r['lastReadMessageId']) for r in sent], [('bob', 7), ('carol', 2)])
+        self.assertIsNone(consumer.receipt_flush)
+
+
+class SyncTests(TestCase):
+    """A reconnecting client gets exactly the messages created or changed since its last seq."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.carol = User.objects.create(username='carol', first_name='carol', last_name='c')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        cls.group = Group.objects.create(name='g', creator=cls.alice)
+        cls.group.members.add(cls.alice, cls.carol)
+
+    def send(self, text, connection=None, group=None):
+        seq = sync.allocate(connection.id if connection else None, group.id if group else None)
+        return Message.objects.create(
+            connection=connection, group=group, user=self.alice, text=text, seq=seq, change_seq=seq
+        )
+
+    def test_conversations_number_independently(self):
+        first = self.send('one', connection=self.connection)
+        in_group = self.send('group', group=self.group)
+        second = self.send('two', connection=self.connection)
+        self.assertEqual((first.seq, second.seq, in_group.seq), (1, 2, 1))
+
+    def test_changes_since_last_seq(self):
+        first = self.send('one', connection=self.connection)
+        self.send('two', connection=self.connection)
+        first.text = 'edited'
+        first.save()
+        sync.touch(first)
+        [entry] = sync.changes(self.bob, {str(self.connection.id): 2})
+        self.assertEqual([m['text'] for m in entry['messages']], ['edited'])
+        self.assertEqual((entry['seq'], entry['hasMore']), (3, False))
+        self.assertEqual(sync.changes(self.bob, {str(self.connection.id): 3}), [])
+
+    def test_pages_when_more_than_limit(self):
+        for i in range(5):
+            self.send(f'm{i}', group=self.group)
+        [entry] = sync.changes(self.carol, {f'group_{self.group.id}': 0}, limit=3)
+        self.assertEqual((len(entry['messages']), entry['seq'], entry['hasMore']), (3, 3, True))
+        [entry] = sync.changes(self.carol, {f'group_{self.group.id}': entry['seq']}, limit=3)
+        self.assertEqual((len(entry['messages']), entry['seq'], entry['hasMore']), (2, 5, False))
+
+    def test_saving_a_stale_instance_keeps_the_counter(self):
+        connection = Connection.objects.get(pk=self.connection.pk)
+        group = Group.objects.get(pk=self.group.pk)
+        self.send('one', connection=self.connection)
+        self.send('two', group=self.group)
+        connection.accepted = True
+        connection.save()
+        group.name = 'renamed'
+        group.save()
+        self.assertEqual(Connection.objects.values_list('last_seq', flat=True).get(pk=connection.pk), 1)
+        self.assertEqual(Group.objects.values_list('name', 'last_seq').get(pk=group.pk), ('renamed', 1))
+        self.assertEqual(self.send('three', connection=self.connection).seq, 2)
+
+    def test_other_peoples_conversations_are_ignored(self):
+        self.send('private', connection=self.connection)
+        self.assertEqual(sync.changes(self.carol, {str(self.connection.id): 0}), [])
+        with self.assertRaises(ValueError):
+            sync.changes(self.carol, {'group_x': 0})
+
+
+class ClientMessageIdTests(TestCase):
+    """A retried message.send with the same clientMessageId returns the original message."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': self.alice}
+
+    def insert(self, client_message_id, text='hi'):
+        return self.consumer.insert_message(
+            {'connection_id': self.connection.id}, client_message_id, connection=self.connection, text=text
+        )
+
+    def test_retry_returns_the_original_message(self):
+        first, created = self.insert('c1')
+        self.assertTrue(created)
+        again, created = self.insert('c1', text='hi again')
+        self.assertFalse(created)
+        self.assertEqual((again.pk, again.text), (first.pk, 'hi'))
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_ids_are_scoped_to_the_sender(self):
+        self.insert('c1')
+        self.consumer.scope = {'user': self.bob}
+        _, created = self.insert('c1')
+        self.assertTrue(created)
+
+    def test_concurrent_retry_loses_the_insert_race(self):
+        first, _ = self.insert('c1')
+        real_get = Message.objects.get
+        with mock.patch.object(Message.objects, 'get', side_effect=[Message.DoesNotExist, real_get(pk=first.pk)]):
+            again, created = self.insert('c1')
+        self.assertFalse(created)
+        self.assertEqual(again.pk, first.pk)
+        # The losing insert rolled back its sequence number along with the row
+        self.assertEqual(Connection.objects.get(pk=self.connection.pk).last_seq, 1)
+
+
+class ForwardTests(TestCase):
+    """message.forward copies a message into many conversations with one insert."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.carol = User.objects.create(username='carol', first_name='carol', last_name='c')
+        cls.with_bob = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        cls.with_carol = Connection.objects.create(sender=cls.carol, receiver=cls.alice, accepted=True)
+        cls.not_alices = Connection.objects.create(sender=cls.bob, receiver=cls.carol, accepted=True)
+        cls.group = Group.objects.create(name='g', creator=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob, cls.carol)
+        cls.original = Message.objects.create(
+            connection=cls.with_bob, user=cls.bob, text='look', type=Message.IMAGE,
+            media_file='uploads/messages/look.jpg'
+        )
+
+    def forward(self, connection_ids, message=None):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.alice}
+        # The undecorated method, so the queries run inside this test's transaction
+        return vars(ChatConsumer)['forward_message'].func(consumer, (message or self.original).id, connection_ids)
+
+    def test_copies_share_the_media_file(self):
+        targets = [str(self.with_carol.id), f'group_{self.group.id}']
+        with CaptureQueriesContext(connections['default']) as queries:
+            result = self.forward(targets)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "chat_message"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([entry['connectionId'] for entry in result['forwarded']], targets)
+        copies = Message.objects.exclude(pk=self.original.pk)
+        self.assertEqual(
+            sorted(copies.values_list('media_file', 'seq', 'user')),
+            [('uploads/messages/look.jpg', 1, self.alice.pk)] * 2,
+        )
+
+    def test_conversations_the_user_is_not_in_are_skipped(self):
+        result = self.forward([self.not_alices.id, 'group_999'])
+        self.assertEqual((result['forwarded'], result['skipped']), ([], [str(self.not_alices.id), 'group_999']))
+
+    def test_message_must_be_visible(self):
+        hidden = Message.objects.create(connection=self.not_alices, user=self.bob, text='private')
+        self.assertIsNone(self.forward([self.with_carol.id], message=hidden))
+        with self.assertRaises(ValueError):
+            self.forward(['x'])
+
+
+class IncognitoTests(TestCase):
+    """Incognito messages are never stored and are buffered briefly for offline recipients."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def setUp(self):
+        for target, value in ((ephemeral, ephemeral.LocalBuffer()), (presence, presence.LocalPresence())):
+            patcher = mock.patch.object(target, '_backend', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_incognito_message_is_not_stored(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.alice}
+        result = vars(ChatConsumer)['create_message'].func(
+            consumer, self.connection.id, 'psst', 'text', None, False, True, None
+        )
+        self.assertFalse(Message.objects.exists())
+        self.assertTrue(result['message']['incognito'])
+        self.assertTrue(result['message']['id'].startswith('incognito-'))
+        self.assertEqual(result['recipients'], {self.bob.pk: 'bob'})
+
+    def test_only_offline_recipients_get_a_copy_once(self):
+        async_to_sync(presence.connected)(self.alice.pk, 'alice-phone')
+        async_to_sync(ephemeral.hold)({self.alice.pk: 'alice', self.bob.pk: 'bob'}, 'frame')
+        self.assertEqual(async_to_sync(ephemeral.take)('alice'), [])
+        self.assertEqual(async_to_sync(ephemeral.take)('bob'), ['frame'])
+        self.assertEqual(async_to_sync(ephemeral.take)('bob'), [])
+
+    @override_settings(CHAT_INCOGNITO_TTL=0)
+    def test_copies_expire(self):
+        async_to_sync(ephemeral.hold)({self.bob.pk: 'bob'}, 'frame')
+        self.assertEqual(async_to_sync(ephemeral.take)('bob'), [])
+
+
+class ExpiryTests(TestCase):
+    """Disappearing messages are tombstoned in batches once they expire."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def send(self, text, expires_in=None):
+        now = timezone.now()
+        seq = sync.allocate(self.connection.id)
+        message = Message.objects.create(
+            connection=self.connection, user=self.alice, text=text, seq=seq, change_seq=seq,
+            disappearing=expires_in, expires_at=expiry.expires_at(expires_in, now) if expires_in else None,
+        )
+        inbox.record_message(message, [self.alice, self.bob])
+        return message
+
+    def test_expired_messages_are_tombstoned(self):
+        kept = self.send('kept')
+        soon = self.send('soon', expires_in=60)
+        later = self.send('later', expires_in=3600)
+        [(targets, key, deleted, preview, _)] = expiry.tombstone_due(timezone.now() + datetime.timedelta(minutes=5))
+        self.assertEqual((sorted(targets), key, deleted), (['alice', 'bob'], str(self.connection.id), [(soon.pk, 4)]))
+        soon.refresh_from_db()
+        self.assertEqual((soon.is_deleted, soon.text), (True, ''))
+        self.assertFalse(Message.objects.get(pk=later.pk).is_deleted)
+        # The preview still shows the latest message, which has not expired
+        self.assertEqual(preview, 'later')
+        self.assertEqual(expiry.tombstone_due(timezone.now() + datetime.timedelta(minutes=5)), [])
+        expiry.tombstone_due(timezone.now() + datetime.timedelta(hours=2))
+        self.assertEqual(inbox.find_entry(self.bob, connection_id=self.connection.id)['preview'], kept.text)
+
+    def test_batches_are_limited(self):
+        for i in range(3):
+            self.send(f'm{i}', expires_in=1)
+        [(_, _, deleted, _, _)] = expiry.tombstone_due(timezone.now() + datetime.timedelta(minutes=1), limit=2)
+        self.assertEqual(len(deleted), 2)
+        self.assertEqual(Message.objects.filter(is_deleted=False).count(), 1)
+
+    def test_one_delete_frame_per_conversation(self):
+        changes = [(['alice', 'bob'], '1', [(5, 9), (6, 10)], 'kept', None), (['chatgroup_2'], 'group_2', [(7, 3)], None, None)]
+        with mock.patch('chat.expiry.get_channel_layer'), mock.patch('chat.expiry.group_send_many') as send:
+            async_to_sync(expiry.announce)(changes)
+        deletes = [call.args[1:] for call in send.call_args_list if call.args[2]['source'] == 'message.delete.many']
+        self.assertEqual(deletes, [
+            (['alice', 'bob'], envelope('message.delete.many', {'connectionId': '1', 'messages': [
+                {'messageId': 5, 'changeSeq': 9}, {'messageId': 6, 'changeSeq': 10},
+            ]})),
+            (['chatgroup_2'], envelope('message.delete.many', {'connectionId': 'group_2', 'messages': [
+                {'messageId': 7, 'changeSeq': 3},
+            ]})),
+        ])
+        self.assertEqual(send.call_count, 4)
+
+
+class HistoryTests(TestCase):
+    """Keyset pages around an anchor, and message.list/message.context for members only."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.carol = User.objects.create(username='carol', first_name='carol', last_name='c')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        cls.group = Group.objects.create(name='g', creator=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob)
+        base = timezone.now()
+        cls.ids = []
+        for i in range(7):
+            message = Message.objects.create(connection=cls.connection, user=cls.alice, text=f'm{i}', seq=i + 1, change_seq=i + 1)
+            # m3 and m4 share a timestamp, so their order falls back to the id
+            Message.objects.filter(pk=message.pk).update(created=base + datetime.timedelta(seconds=min(i, 3) + max(i - 4, 0)))
+            cls.ids.append(message.pk)
+
+    def setUp(self):
+        self.messages = Message.objects.filter(connection=self.connection)
+
+    def ids_of(self, messages):
+        return [self.ids.index(message.pk) for message in messages]
+
+    def anchor(self, i):
+        return history.anchor(self.messages, self.ids[i])
+
+    def test_older(self):
+        page, more = history.older(self.messages, size=3)
+        self.assertEqual((self.ids_of(page), more), ([6, 5, 4], True))
+        page, more = history.older(self.messages, self.anchor(4), 3)
+        self.assertEqual((self.ids_of(page), more), ([3, 2, 1], True))
+        page, more = history.older(self.messages, self.anchor(4), 4)
+        self.assertEqual((self.ids_of(page), more), ([3, 2, 1, 0], False))
+
+    def test_newer(self):
+        page, more = history.newer(self.messages, self.anchor(3), 2)
+        self.assertEqual((self.ids_of(page), more), ([5, 4], True))
+        page, more = history.newer(self.messages, self.anchor(4), 2)
+        self.assertEqual((self.ids_of(page), more), ([6, 5], False))
+
+    def test_window_boundaries(self):
+        page, more_older, more_newer = history.window(self.messages, self.anchor(3), 4)
+        self.assertEqual((self.ids_of(page), more_older, more_newer), ([5, 4, 3, 2, 1], True, True))
+        page, more_older, more_newer = history.window(self.messages, self.anchor(0), 4)
+        self.assertEqual((self.ids_of(page), more_older, more_newer), ([2, 1, 0], False, True))
+        page, more_older, more_newer = history.window(self.messages, self.anchor(6), 4)
+        self.assertEqual((self.ids_of(page), more_older, more_newer), ([6, 5, 4], True, False))
+
+    def consumer(self, user):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': user}
+        return consumer
+
+    def message_list(self, user, connection_id, **anchors):
+        return vars(ChatConsumer)['get_message_list'].func(self.consumer(user), connection_id, 0, size=2, **anchors)
+
+    def test_message_list_anchors(self):
+        page = self.message_list(self.bob, self.connection.id, before=self.ids[2])
+        self.assertEqual(
+            ([m['id'] for m in page['messages']], page['before'], page['after']), (self.ids[1::-1], None, self.ids[1])
+        )
+        page = self.message_list(self.bob, self.connection.id, after=self.ids[4])
+        self.assertEqual(
+            ([m['id'] for m in page['messages']], page['before'], page['after']), (self.ids[:4:-1], self.ids[5], None)
+        )
+
+    def test_message_context(self):
+        context = vars(ChatConsumer)['get_message_context'].func(self.consumer(self.alice), self.connection.id, self.ids[0], 4)
+        self.assertEqual(
+            ([m['id'] for m in context['messages']], context['before'], context['after']),
+            (self.ids[2::-1], None, self.ids[2]),
+        )
+
+    def test_outsiders_cannot_read(self):
+        carol = self.consumer(self.carol)
+        self.assertEqual(self.message_list(self.carol, self.connection.id, before=self.ids[2]), 'Connection not found')
+        self.assertEqual(
+            vars(ChatConsumer)['get_message_context'].func(carol, self.connection.id, self.ids[3]), 'Connection not found'
+        )
+        self.assertEqual(self.message_list(self.carol, f'group_{self.group.id}'), 'Group not found')
+
+
+class RecentMessagesTests(TestCase):
+    """Page 0 of message.list is served from the hot-conversation cache while it is current."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def setUp(self):
+        patcher = mock.patch.object(recent, '_backend', recent.LocalRecent())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': self.bob}
+
+    def send(self, text):
+        seq = sync.allocate(self.connection.id)
+        message = Message.objects.create(
+            connection=self.connection, user=self.alice, text=text, seq=seq, change_seq=seq
+        )
+        recent.added(message, serialize_message(Message.objects.for_serialization().get(pk=message.pk)))
+        return message
+
+    def first_page(self, size=2):
+        return vars(ChatConsumer)['get_message_list'].func(self.consumer, self.connection.id, 0, size=size)
+
+    def test_hit_matches_database_page(self):
+        for i in range(3):
+            self.send(f'm{i}')
+        from_database = self.first_page()
+        with mock.patch('chat.consumers.serialize_messages') as serialize:
+            from_cache = self.first_page()
+        serialize.assert_not_called()
+        self.assertEqual(from_cache, from_database)
+        self.assertEqual(([m['text'] for m in from_cache['messages']], from_cache['next']), (['m2', 'm1'], 1))
+
+    def test_writes_keep_the_page_current(self):
+        self.send('old')
+        self.first_page()
+        message = self.send('new')
+        message.text = 'edited'
+        message.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            sync.touch(message)
+        with mock.patch('chat.consumers.serialize_messages') as serialize:
+            page = self.first_page()
+        serialize.assert_not_called()
+        self.assertEqual([m['text'] for m in page['messages']], ['edited', 'old'])
+
+    def test_send_committed_during_a_fill_is_not_cached_twice(self):
+        self.send('old')
+        stale = Connection.objects.get(pk=self.connection.pk)
+        # The page is read after the send below commits, but versioned with the last_seq read before it
+        seq = sync.allocate(self.connection.id)
+        message = Message.objects.create(connection=self.connection, user=self.alice, text='new', seq=seq, change_seq=seq)
+        self.consumer.newest_page(Message.objects.for_serialization().filter(connection=self.connection), {}, stale, 2)
+        recent.added(message, serialize_message(Message.objects.for_serialization().get(pk=message.pk)))
+        version, entries = recent._backend.read(recent.conversation_key(self.connection.id))
+        self.assertEqual((version, [entry[0] for entry in entries]), (seq, [message.pk, message.pk - 1]))
+
+    def test_out_of_order_write_drops_the_page(self):
+        backend = recent._backend
+        backend.fill('c1', 3, [(3, 1, {'id': 3})])
+        backend.apply('c1', 4, 5, (3, 1, {'id': 3, 'text': 'late'}), add=False)
+        self.assertEqual(backend.read('c1'), (None, []))
+
+
+class BlocksTests(TestCase):
+    """Block checks are answered from the cached block list until a block is added or removed."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        cls.connection = Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def setUp(self):
+        for name, value in (('_backend', blocks.LocalBlocks()), ('_local', collections.OrderedDict())):
+            patcher = mock.patch.object(blocks, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_repeated_checks_do_not_query(self):
+        BlockedUser.objects.create(user=self.alice, blocked_user=self.bob)
+        self.assertTrue(blocks.is_blocked(self.alice.pk, self.bob.pk))
+        with self.assertNumQueries(0):
+            self.assertTrue(blocks.is_blocked(self.alice.pk, self.bob.pk))
+            self.assertEqual(blocks.blocked_ids(self.alice.pk), frozenset({self.bob.pk}))
+
+    def test_invalidate_picks_up_changes(self):
+        self.assertFalse(blocks.is_blocked(self.alice.pk, self.bob.pk))
+        BlockedUser.objects.create(user=self.alice, blocked_user=self.bob)
+        blocks.invalidate(self.alice.pk)
+        self.assertTrue(blocks.is_blocked(self.alice.pk, self.bob.pk))
+        BlockedUser.objects.filter(user=self.alice).delete()
+        blocks.invalidate(self.alice.pk)
+        self.assertFalse(blocks.is_blocked(self.alice.pk, self.bob.pk))
+
+    @override_settings(CHAT_BLOCKS_LOCAL_MAX=2)
+    def test_process_cache_keeps_the_most_recently_used(self):
+        for user in (self.alice, self.bob, self.alice):
+            blocks.blocked_ids(user.pk)
+        carol = User.objects.create(username='carol', first_name='carol', last_name='c')
+        blocks.blocked_ids(carol.pk)
+        self.assertEqual(list(blocks._local), [self.alice.pk, carol.pk])
+
+    def test_conversation_header(self):
+        BlockedUser.objects.create(user=self.bob, blocked_user=self.alice)
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.alice}
+        _, header, _ = consumer.load_conversation(self.connection.id)
+        self.assertEqual((header['is_blocked'], header['i_blocked_friend']), (True, False))
+
+
+@override_settings(CHAT_TYPING_THROTTLE=0.1, CHAT_TYPING_TIMEOUT=0.25)
+class TypingTests(TestCase):
+    """Keystrokes become at most one message.type per throttle window and a single typing.stop."""
+
+    def setUp(self):
+        self.sent = []
+        self.consumer = ChatConsumer()
+        self.consumer.username = 'alice'
+        self.consumer.typing = {}
+        self.consumer.chat_groups = {chat_group_name(5)}
+
+        async def send_group(group, source, data, skip=None, collapse=None):
+            self.sent.append((group, source, skip))
+
+        self.consumer.send_group = send_group
+
+    def run_steps(self, steps):
+        """Run ``steps``, each a keystroke frame or a number of seconds to wait, then let pending stops fire."""
+        async def run():
+            for step in steps:
+                if isinstance(step, dict):
+                    await self.consumer.receive_message_type(step)
+                else:
+                    await asyncio.sleep(step)
+
+        async_to_sync(run)()
+        return [(group, source) for group, source, _ in self.sent]
+
+    def test_throttles_and_stops_once_after_timeout(self):
+        key = {'username': 'bob'}
+        sent = self.run_steps([key, key, key, 0.15, key, key, 0.4])
+        self.assertEqual(sent, [('bob', 'message.type'), ('bob', 'message.type'), ('bob', 'typing.stop')])
+        self.assertEqual(self.consumer.typing, {})
+
+    def test_keystrokes_postpone_the_stop(self):
+        key = {'username': 'bob'}
+        # Typing for longer than the timeout, but never pausing that long
+        sent = self.run_steps([key, 0.06, key, 0.06, key, 0.06, key, 0.06, key, 0.06, key, 0.4])
+        self.assertEqual(sent, [('bob', 'message.type')] * 3 + [('bob', 'typing.stop')])
+
+    def test_group_is_one_send_without_the_typist(self):
+        self.run_steps([{'connectionId': 'group_5'}, {'connectionId': 'group_5'}, 0.4])
+        self.assertEqual(self.sent, [('chatgroup_5', 'message.type', 'alice'), ('chatgroup_5', 'typing.stop', 'alice')])
+        with mock.patch.object(self.consumer, 'send_error', new=mock.AsyncMock()) as send_error:
+            self.run_steps([{'connectionId': 'group_6'}])
+        send_error.assert_awaited_once_with('Group not found')
+
+    def test_disconnect_stops_immediately(self):
+        async def run():
+            await self.consumer.receive_message_type({'username': 'bob'})
+            await self.consumer.receive_message_type({'connectionId': 'group_5'})
+            await self.consumer.stop_typing()
+            await asyncio.sleep(0.4)
+
+        async_to_sync(run)()
+        self.assertEqual([(g, s) for g, s, _ in self.sent if s == 'typing.stop'], [('bob', 'typing.stop'), ('chatgroup_5', 'typing.stop')])
+
+    def test_sending_a_message_stops_typing_in_that_conversation(self):
+        self.consumer.scope = {'user': User(username='alice')}
+        self.consumer.channel_layer = mock.Mock()
+        result = {
+            'created': True, 'message_id': 1, 'group_name': None, 'targets': ['bob', 'alice'], 'recipients': {},
+            'friend_data': {}, 'sender_data': {}, 'message': {'id': 1, 'is_me': False}, 'pushes': [],
+        }
+
+        async def run():
+            await self.consumer.receive_message_type({'username': 'bob'})
+            await self.consumer.receive_message_type({'connectionId': 'group_5'})
+            with mock.patch.object(self.consumer, 'create_message', new=mock.AsyncMock(return_value=result)), \
+                    mock.patch('chat.consumers.group_send_many', new=mock.AsyncMock()):
+                await self.consumer.receive_message_send({'connectionId': '1', 'message': 'hi'})
+            stopped_by_send = [group for group, source, _ in self.sent if source == 'typing.stop']
+            await asyncio.sleep(0.4)
+            return stopped_by_send
+
+        # bob's indicator ends with the send; the group one times out on its own later
+        self.assertEqual(async_to_sync(run)(), ['bob'])
+        self.assertEqual([group for group, source, _ in self.sent if source == 'typing.stop'], ['bob', 'chatgroup_5'])
+
+
+@override_settings(CHAT_MAILBOX_REDIS_URL='', CHAT_MAILBOX_MAXLEN=3)
+class MailboxTests(TestCase):
+    """Frames for users without a socket are held, replayed in order and trimmed on ack."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        cls.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+
+    def setUp(self):
+        users = {self.alice.pk: 'alice', self.bob.pk: 'bob'}
+
+        async def user_ids(usernames):
+            # The real lookup runs on the db executor, outside this test's transaction
+            return {pk: username for pk, username in users.items() if username in usernames}
+
+        for target, name, value in (
+            (mailbox, '_backend', mailbox.LocalMailbox()),
+            (mailbox, '_user_ids', user_ids),
+            (mailbox, '_user_id_cache', collections.OrderedDict()),
+            (presence, '_backend', presence.LocalPresence()),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        async_to_sync(presence.connected)(self.alice.pk, 'alice-phone')
+
+    def hold(self, source, data, **extra):
+        async_to_sync(mailbox.hold)(['alice', 'bob'], {**envelope(source, data), **extra})
+
+    def held(self, username):
+        entries, more = async_to_sync(mailbox.read)(username)
+        return [text for _, text in entries], more
+
+    def test_only_offline_users_get_a_copy(self):
+        self.hold('block.status', {'blocked': True})
+        self.assertEqual(self.held('alice'), ([], False))
+        self.assertEqual(self.held('bob'), ([dumps({'source': 'block.status', 'data': {'blocked': True}})], False))
+
+    def test_collapsible_durable_and_call_frames_are_not_held(self):
+        self.hold('online.status', {'online': True}, collapse='online.status:alice')
+        self.hold('message.send', {'message': {}})
+        self.hold('call.request', {'roomId': 'r'})
+        self.hold('voicecall.cancel', {'roomId': 'r'})
+        self.assertEqual(self.held('bob'), ([], False))
+
+    def test_send_does_not_wait_for_the_hold(self):
+        sent = asyncio.Event()
+
+        class Layer:
+            async def group_send(self, group, event):
+                sent.set()
+
+        async def user_ids(usernames):
+            # Only returns once the frame went out, so a send queued behind the lookup would time out
+            await sent.wait()
+            return {self.bob.pk: 'bob'}
+
+        async def send():
+            with mock.patch.object(mailbox, '_user_ids', user_ids):
+                await asyncio.wait_for(
+                    mailbox.send_or_hold(Layer(), ['bob'], envelope('reaction.add', {'n': 1})), timeout=1
+                )
+
+        async_to_sync(send)()
+        self.assertEqual(self.held('bob'), ([dumps({'source': 'reaction.add', 'data': {'n': 1}})], False))
+
+    def test_a_failed_hold_does_not_fail_the_send(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, event):
+                sent.append(group)
+
+        async def user_ids(usernames):
+            raise ConnectionError('database is gone')
+
+        with mock.patch.object(mailbox, '_user_ids', user_ids), self.assertLogs('chat.mailbox', 'ERROR'):
+            async_to_sync(mailbox.send_or_hold)(Layer(), ['bob'], envelope('reaction.add', {'n': 1}))
+        self.assertEqual(sent, ['bob'])
+        self.assertEqual(self.held('bob'), ([], False))
+
+    def test_user_ids_are_looked_up_once(self):
+        looked_up = []
+
+        async def user_ids(usernames):
+            looked_up.append(sorted(usernames))
+            return {self.alice.pk: 'alice', self.bob.pk: 'bob'}
+
+        with mock.patch.object(mailbox, '_user_ids', user_ids):
+            self.hold('reaction.add', {'n': 1})
+            self.hold('reaction.add', {'n': 2})
+        self.assertEqual(looked_up, [['alice', 'bob']])
+        self.assertEqual(len(self.held('bob')[0]), 2)
+
+    def test_ack_trims_through_the_acked_entry(self):
+        for i in range(4):
+            self.hold('reaction.add', {'n': i})
+        # Capped at CHAT_MAILBOX_MAXLEN, oldest dropped first
+        entries, _ = async_to_sync(mailbox.read)('bob')
+        self.assertEqual([dumps({'source': 'reaction.add', 'data': {'n': i}}) for i in (1, 2, 3)], [t for _, t in entries])
+        async_to_sync(mailbox.ack)('bob', entries[1][0])
+        self.assertEqual(self.held('bob'), ([entries[2][1]], False))
+        with self.assertRaises(ValueError):
+            async_to_sync(mailbox.ack)('bob', 'latest')
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_PRESENCE_OFFLINE_GRACE=0,
+)
+class SocketTestCase(TransactionTestCase):
+    """
+    Consumers driven through ``WebsocketCommunicator``. Transactional, because the consumer
+    reads the database on its own threads and must see committed rows.
+    """
+
+    def setUp(self):
+        for module, backend in (
+            (presence, presence.LocalPresence()), (mailbox, mailbox.LocalMailbox()), (ephemeral, ephemeral.LocalBuffer()),
+            (recent, recent.LocalRecent()), (blocks, blocks.LocalBlocks()),
+        ):
+            patcher = mock.patch.object(module, '_backend', backend)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Rows are recreated for every test, so ids cached by an earlier one would be stale
+        patcher = mock.patch.object(mailbox, '_user_id_cache', collections.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def frames(self, communicator, timeout=0.2):
+        """Every frame the socket sends until it has been quiet for ``timeout`` seconds."""
+        frames = []
+        while not await communicator.receive_nothing(timeout):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+
+class MembershipTests(SocketTestCase):
+    """Sockets join and leave chatgroup_<id> as Group.members changes."""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        self.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        self.group = Group.objects.create(name='g', creator=self.alice)
+        self.group.members.add(self.alice, self.bob)
+
+    async def broadcast(self):
+        await get_channel_layer().group_send(chat_group_name(self.group.id), envelope('group.ping', {}))
+
+    async def test_connect_joins_member_groups(self):
+        alice = await self.connect(self.alice)
+        await self.frames(alice)
+        await self.broadcast()
+        self.assertEqual([frame['source'] for frame in await self.frames(alice)], ['group.ping'])
+        await alice.disconnect()
+
+    async def test_added_member_joins(self):
+        carol = await sync_to_async(User.objects.create)(username='carol', first_name='carol', last_name='c')
+        socket = await self.connect(carol)
+        await self.frames(socket)
+        await sync_to_async(self.group.members.add)(carol)
+        await self.frames(socket)
+        await self.broadcast()
+        self.assertEqual([frame['source'] for frame in await self.frames(socket)], ['group.ping'])
+        self.assertTrue(await sync_to_async(ConversationSummary.objects.filter(user=carol, group=self.group).exists)())
+        await socket.disconnect()
+
+    async def test_removed_member_leaves(self):
+        bob = await self.connect(self.bob)
+        await self.frames(bob)
+        await sync_to_async(ConversationSummary.objects.filter(user=self.bob, group=self.group).update)(unread_count=2)
+        await sync_to_async(User.objects.filter(pk=self.bob.pk).update)(unread_total=3)
+        await sync_to_async(self.bob.chat_groups.remove)(self.group)
+        await self.frames(bob)
+        await self.broadcast()
+        self.assertEqual(await self.frames(bob), [])
+        self.assertFalse(await sync_to_async(ConversationSummary.objects.filter(user=self.bob, group=self.group).exists)())
+        self.assertEqual(await sync_to_async(inbox.unread_total)(self.bob), 1)
+        await bob.disconnect()
+
+    async def test_clear_removes_everyone(self):
+        alice = await self.connect(self.alice)
+        await self.frames(alice)
+        await sync_to_async(self.group.members.clear)()
+        await self.frames(alice)
+        await self.broadcast()
+        self.assertEqual(await self.frames(alice), [])
+        await alice.disconnect()
+
+
+class EnvelopeVariantTests(SocketTestCase):
+    """One message.send envelope reaches the author's sockets and the recipient's with their own view."""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        self.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    async def test_author_and_recipient_variants(self):
+        phone, laptop, bob = await self.connect(self.alice), await self.connect(self.alice), await self.connect(self.bob)
+        for socket in (phone, laptop, bob):
+            await self.frames(socket)
+        await phone.send_json_to({'source': 'message.send', 'connectionId': self.connection.id, 'message': 'hi'})
+
+        def sent(frames):
+            [frame] = [frame for frame in frames if frame['source'] == 'message.send']
+            return frame['data']
+
+        author_views = [sent(await self.frames(socket)) for socket in (phone, laptop)]
+        recipient_view = sent(await self.frames(bob))
+        for view in author_views:
+            self.assertEqual(view['friend']['username'], 'bob')
+            self.assertTrue(view['message']['is_me'])
+        self.assertEqual(recipient_view['friend']['username'], 'alice')
+        self.assertFalse(recipient_view['message']['is_me'])
+        self.assertEqual({view['message']['id'] for view in author_views}, {recipient_view['message']['id']})
+        for socket in (phone, laptop, bob):
+            await socket.disconnect()
+
+
+class PresenceSnapshotTests(SocketTestCase):
+    """A connecting socket gets one presence.snapshot covering exactly the user's friends."""
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol, self.dave, self.erin = (
+            User.objects.create(username=name, first_name=name, last_name='x')
+            for name in ('alice', 'bob', 'carol', 'dave', 'erin')
+        )
+        Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        Connection.objects.create(sender=self.carol, receiver=self.alice, accepted=True)
+        Connection.objects.create(sender=self.alice, receiver=self.dave, accepted=False)
+
+    async def test_snapshot_on_connect(self):
+        bob, erin = await self.connect(self.bob), await self.connect(self.erin)
+        alice = await self.connect(self.alice)
+        snapshots = [frame['data'] for frame in await self.frames(alice) if frame['source'] == 'presence.snapshot']
+        self.assertEqual(snapshots, [{'friends': {'bob': True, 'carol': False}}])
+        for socket in (alice, bob, erin):
+            await socket.disconnect()
+
+
+class ConsumerLifecycleTests(SocketTestCase):
+    """A socket connects, sends and disconnects, leaving nothing behind."""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username='alice', first_name='alice', last_name='a')
+        self.bob = User.objects.create(username='bob', first_name='bob', last_name='b')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        self.group = Group.objects.create(name='g', creator=self.alice)
+        self.group.members.add(self.alice, self.bob)
+
+    async def test_connect_send_disconnect(self):
+        alice = await self.connect(self.alice)
+        await self.frames(alice)
+        self.assertTrue(presence.is_online(self.alice.pk))
+        await alice.send_json_to({'source': 'message.send', 'connectionId': self.connection.id, 'message': 'hi'})
+        [sent] = [frame for frame in await self.frames(alice) if frame['source'] == 'message.send']
+        self.assertEqual(sent['data']['message']['text'], 'hi')
+        await alice.disconnect()
+        await asyncio.sleep(0.01)
+        self.assertFalse(presence.is_online(self.alice.pk))
+        groups = get_channel_layer().groups
+        self.assertFalse(groups.get('alice'))
+        self.assertFalse(groups.get(chat_group_name(self.group.id)))
+
+    async def test_disconnect_after_a_failed_connect(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'type': 'websocket', 'user': self.alice, 'subprotocols': []}
+        consumer.channel_layer = get_channel_layer()
+        consumer.channel_name = await consumer.channel_layer.new_channel()
+        failing = mock.AsyncMock(side_effect=ConnectionError('database is gone'))
+        with mock.patch.object(consumer, 'get_chat_group_names', failing), self.assertRaises(ConnectionError):
+            await consumer.connect()
+        with mock.patch.object(presence, 'disconnected') as disconnected:
+            await consumer.disconnect(1006)
+        # Presence was never registered, so there is nothing to take back
+        disconnected.assert_not_called()
+        self.assertFalse(get_channel_layer().groups.get('alice'))
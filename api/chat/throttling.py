@@ -0,0 +1,67 @@
+"""
+Per-socket rate limiting for websocket consumers.
+
+Each socket gets a ``SocketLimiter`` holding one token bucket per ``source``,
+configured by the CHAT_RATE_LIMITS setting as ``{source: (rate, burst)}``:
+``rate`` tokens are added per second up to ``burst``, and every frame costs
+one. Sources without an entry use the ``'default'`` one. Buckets live in the
+consumer instance, so checking a frame is a few float operations with no I/O.
+
+Rejections are themselves counted in a bucket of CHAT_RATE_LIMIT_STRIKES
+tokens refilled over CHAT_RATE_LIMIT_STRIKE_WINDOW seconds; a socket that
+keeps hitting its limits after that runs out should be closed.
+"""
+import time
+
+from django.conf import settings
+
+DEFAULT_LIMIT = (20, 40)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Spend one token. Returns False, spending nothing, when the bucket is empty."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until the next token is available."""
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate else None
+
+
+class SocketLimiter:
+    def __init__(self, limits=None):
+        self.limits = getattr(settings, 'CHAT_RATE_LIMITS', {}) if limits is None else limits
+        self.buckets = {}
+        strikes = getattr(settings, 'CHAT_RATE_LIMIT_STRIKES', 20)
+        window = getattr(settings, 'CHAT_RATE_LIMIT_STRIKE_WINDOW', 60)
+        self.strikes = TokenBucket(strikes / window, strikes)
+
+    def bucket(self, source):
+        bucket = self.buckets.get(source)
+        if bucket is None:
+            limit = self.limits.get(source) or self.limits.get('default', DEFAULT_LIMIT)
+            bucket = self.buckets[source] = TokenBucket(*limit)
+        return bucket
+
+    def allow(self, source):
+        """
+        Spend a token of ``source``'s bucket. Callers pass None for sources they do not
+        handle, so unknown names share one bucket instead of each getting their own.
+        """
+        return self.bucket(source).take()
+
+    def strike(self):
+        """Record a rejected frame. Returns False once the socket has used up its strikes."""
+        return self.strikes.take()
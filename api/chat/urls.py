@@ -4,7 +4,8 @@ from .views import (
     DeleteMessageView, EditMessageView, PinMessageView, AddReactionView,
     CreateGroupView, GroupSettingsView, BlockUserView, ReportUserView,
     PostListCreateView, PostInteractView, CommentCreateView, MarkMessagesSeenView,
-    VideoUploadView, DocumentUploadView, UserProfileUpdateView, UpdateFCMTokenView,UnblockUserView
+    VideoUploadView, DocumentUploadView, UserProfileUpdateView, UpdateFCMTokenView,UnblockUserView,
+    RuntimeMetricsView
 )
 
 urlpatterns = [
@@ -27,6 +28,8 @@ urlpatterns = [
     path('posts/', PostListCreateView.as_view(), name='post-list'),
     path('posts/<int:pk>/<str:action>/', PostInteractView.as_view(), name='post-interact'),
     path('messages/mark-seen/<int:connection_id>/', MarkMessagesSeenView.as_view(), name='mark-seen'),
+    path('messages/mark-seen/group/<int:group_id>/', MarkMessagesSeenView.as_view(), name='mark-group-seen'),
     path('profile/update/', UserProfileUpdateView.as_view(), name='profile-update'),
     path('update-fcm-token/', UpdateFCMTokenView.as_view(), name='update-fcm-token'),
+    path('metrics/', RuntimeMetricsView.as_view(), name='runtime-metrics'),
 ]
\ No newline at end of file
@@ -3,7 +3,7 @@ from django.shortcuts import render, get_object_or_404
 from rest_framework import generics, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.core.files.storage import default_storage
@@ -26,6 +26,14 @@ from .serializers import (
     PostSerializer, CreatePostSerializer, CommentSerializer
 )
 
+from . import blocks, inbox, sync
+from .mailbox import send_or_hold
+from .executors import pool_stats
+from .outbound import outbound_stats
+from .layers import group_send_many, chat_group_name
+from .envelopes import envelope, message_variants
+from .fast_serializers import serialize_message
+
 logger = logging.getLogger(__name__)
 
 # chat/views.py
@@ -243,30 +251,22 @@ class DeleteMessageView(APIView):
                 if message.connection:
                     connection_id = str(message.connection.id)
                     recipient = message.connection.sender if message.connection.sender != request.user else message.connection.receiver
-                    recipients = [request.user, recipient]
+                    recipients = [request.user.username, recipient.username]
                 elif message.group:
                     connection_id = f"group_{message.group.id}"
-                    recipients = message.group.members.all()
+                    recipients = [chat_group_name(message.group.id)]
                 else:
                     recipients = []
+                sync.touch(message)
+                inbox.record_delete(message)
 
                 # Broadcast the deletion via WebSocket
-                channel_layer = get_channel_layer()
-                for recipient in recipients:
-                    logger.info(f"Broadcasting message.delete to {recipient.username} for message {pk}")
-                    async_to_sync(channel_layer.group_send)(
-                        recipient.username,
-                        {
-                            "type": "broadcast_group",
-                            "message": {
-                                "source": "message.delete",
-                                "data": {
-                                    "messageId": pk,
-                                    "connectionId": connection_id
-                                }
-                            }
-                        }
-                    )
+                logger.info(f"Broadcasting message.delete to {len(recipients)} recipients for message {pk}")
+                async_to_sync(send_or_hold)(
+                    get_channel_layer(),
+                    recipients,
+                    envelope("message.delete", {"messageId": pk, "connectionId": connection_id, "changeSeq": message.change_seq})
+                )
                 return Response({"success": "Message deleted successfully"}, status=status.HTTP_200_OK)
             logger.error(f"Error deleting message {pk}: {serializer.errors}")
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -287,34 +287,34 @@ class EditMessageView(APIView):
         serializer = MessageSerializer(message, data=request.data, partial=True, context={'request': request})
         if serializer.is_valid():
             serializer.save()
+            sync.touch(message)
+            inbox.record_edit(message)
             logger.info(f"Message {pk} edited by {request.user.username}")
 
-            # Broadcast the edited message via WebSocket
-            channel_layer = get_channel_layer()
-            serialized_message = MessageSerializer(message, context={'request': request}).data
-            
+            # Broadcast the edited message via WebSocket, serialized once for all viewers
+            serialized_message, author_message = message_variants(
+                serialize_message(Message.objects.for_serialization().get(pk=message.pk))
+            )
+
             # Determine recipients
             if message.connection:
                 recipient = message.connection.sender if message.connection.sender != request.user else message.connection.receiver
-                recipients = [request.user, recipient]
+                recipients = [request.user.username, recipient.username]
             elif message.group:
-                recipients = message.group.members.all()
+                recipients = [chat_group_name(message.group.id)]
             else:
                 recipients = []
 
             # Broadcast to all recipients
-            for recipient in recipients:
-                async_to_sync(channel_layer.group_send)(
-                    recipient.username,
-                    {
-                        "type": "broadcast_group",
-                        "message": {
-                            "source": "message.update",
-                            "data": {"message": serialized_message}
-                        }
-                    }
+            async_to_sync(send_or_hold)(
+                get_channel_layer(),
+                recipients,
+                envelope(
+                    "message.update", {"message": serialized_message},
+                    author=request.user.username, author_data={"message": author_message}
                 )
-            return Response(serializer.data)
+            )
+            return Response(author_message)
         logger.error(f"Error editing message {pk}: {serializer.errors}")
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)  
 
@@ -325,6 +325,7 @@ class PinMessageView(APIView):
         message = get_object_or_404(Message, pk=pk)
         message.pinned = not message.pinned
         message.save()
+        sync.touch(message)
         action = "pinned" if message.pinned else "unpinned"
         logger.info(f"Message {pk} {action} by {request.user.username}")
         return Response({"success": f"Message {action}"}, status=status.HTTP_200_OK)
@@ -348,36 +349,27 @@ class AddReactionView(APIView):
         
         reaction, created = Reaction.objects.get_or_create(message=message, user=request.user, emoji=emoji)
         if created:
+            sync.touch(message)
             # Serialize the reaction
             reaction_data = ReactionSerializer(reaction).data
             
             # Determine recipients based on message context
-            channel_layer = get_channel_layer()
             if message.connection:
                 # One-to-one chat
-                recipients = [message.connection.sender, message.connection.receiver]
+                recipients = [message.connection.sender.username, message.connection.receiver.username]
             elif message.group:
-                # Group chat
-                recipients = message.group.members.all()
+                # Group chat: every member's sockets are in the group's channel-layer group
+                recipients = [chat_group_name(message.group.id)]
             else:
                 recipients = []
-            
+
             # Broadcast the reaction to all recipients
-            for recipient in recipients:
-                async_to_sync(channel_layer.group_send)(
-                    recipient.username,
-                    {
-                        "type": "broadcast_group",
-                        "message": {
-                            "source": "reaction.add",
-                            "data": {
-                                "message_id": message.id,
-                                "reaction": reaction_data
-                            }
-                        }
-                    }
-                )
-            
+            async_to_sync(send_or_hold)(
+                get_channel_layer(),
+                recipients,
+                envelope("reaction.add", {"message_id": message.id, "reaction": reaction_data, "change_seq": message.change_seq})
+            )
+
             logger.info(f"Reaction added to message {message_id} by {request.user.username}: {emoji}")
             return Response({"success": "Reaction added"}, status=status.HTTP_201_CREATED)
         return Response({"error": "Reaction already exists"}, status=status.HTTP_400_BAD_REQUEST)
@@ -394,11 +386,11 @@ class CreateGroupView(APIView):
         if serializer.is_valid():
             group = serializer.save(creator=request.user)
             group.admins.add(request.user)
+            # Opens the inbox row and joins the creator's sockets, see chat.membership
             group.members.add(request.user)
-            group.save()
             channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                request.user.username,
+            async_to_sync(send_or_hold)(
+                channel_layer, [request.user.username],
                 {"type": "broadcast_group", "message": {"source": "group.created", "data": serializer.data}}
             )
             logger.info(f"Group {group.name} created by {request.user.username}")
@@ -429,10 +421,11 @@ class BlockUserView(APIView):
         target_user = get_object_or_404(User, username=username)
         blocked, created = BlockedUser.objects.get_or_create(user=request.user, blocked_user=target_user)
         if created:
+            blocks.invalidate(request.user.pk)
             logger.info(f"User {request.user.username} blocked {username}")
             channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                target_user.username,
+            async_to_sync(send_or_hold)(
+                channel_layer, [target_user.username],
                 {
                     "type": "broadcast_group",
                     "message": {
@@ -452,10 +445,11 @@ class UnblockUserView(APIView):
         try:
             blocked = BlockedUser.objects.get(user=request.user, blocked_user=target_user)
             blocked.delete()
+            blocks.invalidate(request.user.pk)
             logger.info(f"User {request.user.username} unblocked {username}")
             channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                target_user.username,
+            async_to_sync(send_or_hold)(
+                channel_layer, [target_user.username],
                 {
                     "type": "broadcast_group",
                     "message": {
@@ -551,28 +545,52 @@ class CommentCreateView(generics.CreateAPIView):
 from django.db.models import Q
 
 class MarkMessagesSeenView(APIView):
+    """
+    Advance the caller's read cursor for a 1:1 connection or group, up to the
+    optional ``message_id`` in the body or else to the newest message.
+    """
     permission_classes = [IsAuthenticated]
 
-    def post(self, request, connection_id):
-        messages = Message.objects.filter(
-            ~Q(user=request.user),
-            connection_id=connection_id,
-            seen=False
-        )
-        count = messages.update(seen=True, seen_at=timezone.now())
-        logger.info(f"{count} messages marked as seen for connection {connection_id} by {request.user.username}")
+    def post(self, request, connection_id=None, group_id=None):
+        user = request.user
+        if connection_id is not None:
+            connection = get_object_or_404(Connection, Q(sender=user) | Q(receiver=user), id=connection_id)
+            conversation_id = connection_id
+            others = [connection.receiver.username if connection.sender_id == user.id else connection.sender.username]
+        else:
+            get_object_or_404(Group, id=group_id, members=user)
+            conversation_id = f"group_{group_id}"
+            others = [chat_group_name(group_id)]
+
+        message_id = request.data.get('message_id')
+        try:
+            message_id = int(message_id) if message_id is not None else None
+        except (TypeError, ValueError):
+            return Response({"error": "message_id must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        moved = inbox.mark_read(user, connection_id, group_id, message_id)
+        if moved is None:
+            return Response({"marked_count": 0}, status=status.HTTP_200_OK)
+        last_read_message_id, read_at, count = moved
+        logger.info(f"{user.username} read {conversation_id} up to message {last_read_message_id}")
+
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            request.user.username,
-            {
-                "type": "broadcast_group",
-                "message": {
-                    "source": "message.seen",
-                    "data": {"connection_id": connection_id, "count": count}
-                }
-            }
+        # The reader's own devices, then a receipt for everyone else in the conversation
+        async_to_sync(send_or_hold)(
+            channel_layer, [user.username],
+            envelope("message.seen", {"connection_id": conversation_id, "count": count})
+        )
+        async_to_sync(group_send_many)(channel_layer, others, {
+            "type": "read_receipt",
+            "connectionId": conversation_id,
+            "username": user.username,
+            "lastReadMessageId": last_read_message_id,
+            "readAt": read_at.isoformat(),
+        })
+        return Response(
+            {"marked_count": count, "last_read_message_id": last_read_message_id},
+            status=status.HTTP_200_OK
         )
-        return Response({"marked_count": count}, status=status.HTTP_200_OK)
      
 
 class UserProfileUpdateView(APIView):
@@ -587,4 +605,12 @@ class UserProfileUpdateView(APIView):
             logger.info(f"User profile updated for {user.username}")
             return Response(serializer.data, status=status.HTTP_200_OK)
         logger.error(f"Error updating user profile: {serializer.errors}")
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class RuntimeMetricsView(APIView):
+    """Staff-only snapshot of this process's consumer runtime counters."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({'executors': pool_stats(), 'outbound': outbound_stats()}, status=status.HTTP_200_OK)
@@ -99,7 +99,7 @@ if os.environ.get('REDIS_URL'):
     # Update Channel Layers for Redis
     CHANNEL_LAYERS = {
         'default': {
-            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'BACKEND': 'chat.layers.RedisChannelLayer',
             'CONFIG': {
                 'hosts': [os.environ.get('REDIS_URL', 'redis://localhost:6379')]
             }
@@ -72,13 +72,97 @@ ASGI_APPLICATION = 'core.asgi.application'
 # Channels configuration
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.RedisChannelLayer',
         'CONFIG': {
             'hosts': [('127.0.0.1', 6379)]
         }
     }
 }
 
+# Thread pools used by websocket consumers for blocking work (see chat/executors.py)
+CHAT_DB_POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', '8'))
+CHAT_CPU_POOL_SIZE = int(os.environ.get('CHAT_CPU_POOL_SIZE', '4'))
+CHAT_HTTP_POOL_SIZE = int(os.environ.get('CHAT_HTTP_POOL_SIZE', '16'))
+
+# Build hot websocket payloads with chat/fast_serializers.py instead of the DRF serializers
+CHAT_FAST_SERIALIZERS = os.environ.get('CHAT_FAST_SERIALIZERS', 'True').lower() == 'true'
+
+# Read receipts arriving within this many seconds are merged into one frame per reader
+CHAT_READ_RECEIPT_DELAY = float(os.environ.get('CHAT_READ_RECEIPT_DELAY', '0.5'))
+
+# Presence (see chat/presence.py): Redis when a URL is configured, otherwise per-process memory
+CHAT_PRESENCE_REDIS_URL = os.environ.get('CHAT_PRESENCE_REDIS_URL', os.environ.get('REDIS_URL', ''))
+# Seconds a socket counts as connected without a heartbeat
+CHAT_PRESENCE_TTL = int(os.environ.get('CHAT_PRESENCE_TTL', '60'))
+# Seconds a user must stay disconnected before friends are told they went offline
+CHAT_PRESENCE_OFFLINE_GRACE = float(os.environ.get('CHAT_PRESENCE_OFFLINE_GRACE', '10'))
+# Seconds between bulk writes of buffered disconnect times to User.last_online
+CHAT_PRESENCE_FLUSH_INTERVAL = float(os.environ.get('CHAT_PRESENCE_FLUSH_INTERVAL', '30'))
+
+# Typing indicators are forwarded at most once per CHAT_TYPING_THROTTLE seconds per conversation,
+# and typing.stop is sent after CHAT_TYPING_TIMEOUT seconds without one
+CHAT_TYPING_THROTTLE = float(os.environ.get('CHAT_TYPING_THROTTLE', '2'))
+CHAT_TYPING_TIMEOUT = float(os.environ.get('CHAT_TYPING_TIMEOUT', '5'))
+
+# Per-socket token buckets for ChatConsumer frames, {source: (tokens per second, burst)}; see chat/throttling.py
+CHAT_RATE_LIMITS = {
+    'default': (20, 40),
+    'message.send': (5, 20),
+    'message.forward': (0.5, 5),
+    'message.type': (10, 20),
+    'message.list': (5, 10),
+    'message.context': (2, 5),
+    'sync': (0.5, 5),
+    'friend.list': (1, 5),
+    'search': (1, 5),
+    'request.connect': (1, 5),
+    'groups.create': (0.2, 3),
+    'thumbnail': (0.2, 2),
+    'image': (0.5, 3),
+}
+# Sockets are closed after this many rejected frames within the window (in seconds)
+CHAT_RATE_LIMIT_STRIKES = int(os.environ.get('CHAT_RATE_LIMIT_STRIKES', '20'))
+CHAT_RATE_LIMIT_STRIKE_WINDOW = float(os.environ.get('CHAT_RATE_LIMIT_STRIKE_WINDOW', '60'))
+
+# A message.forward frame may copy a message into at most this many conversations
+CHAT_FORWARD_MAX_TARGETS = int(os.environ.get('CHAT_FORWARD_MAX_TARGETS', '50'))
+
+# Per-socket outbound queues (see chat/outbound.py): droppable frames are evicted beyond
+# CHAT_OUTBOUND_QUEUE_SIZE, and sockets are closed as slow consumers beyond CHAT_OUTBOUND_MAX_BACKLOG
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.environ.get('CHAT_OUTBOUND_QUEUE_SIZE', '256'))
+CHAT_OUTBOUND_MAX_BACKLOG = int(os.environ.get('CHAT_OUTBOUND_MAX_BACKLOG', '2048'))
+
+# Mailboxes of frames held for offline users (see chat/mailbox.py): Redis streams when a URL is
+# configured, otherwise per-process memory; CHAT_MAILBOX_TTL is in seconds
+CHAT_MAILBOX_REDIS_URL = os.environ.get('CHAT_MAILBOX_REDIS_URL', os.environ.get('REDIS_URL', ''))
+CHAT_MAILBOX_TTL = int(os.environ.get('CHAT_MAILBOX_TTL', str(7 * 24 * 3600)))
+CHAT_MAILBOX_MAXLEN = int(os.environ.get('CHAT_MAILBOX_MAXLEN', '500'))
+CHAT_MAILBOX_REPLAY_BATCH = int(os.environ.get('CHAT_MAILBOX_REPLAY_BATCH', '100'))
+
+# Incognito messages are never stored (see chat/ephemeral.py); frames for offline recipients are
+# buffered for CHAT_INCOGNITO_TTL seconds, in Redis when a URL is configured
+CHAT_INCOGNITO_REDIS_URL = os.environ.get('CHAT_INCOGNITO_REDIS_URL', os.environ.get('REDIS_URL', ''))
+CHAT_INCOGNITO_TTL = float(os.environ.get('CHAT_INCOGNITO_TTL', '120'))
+CHAT_INCOGNITO_MAXLEN = int(os.environ.get('CHAT_INCOGNITO_MAXLEN', '200'))
+
+# Disappearing messages are tombstoned by `manage.py expire_messages` (see chat/expiry.py) in
+# batches of CHAT_EXPIRY_BATCH_SIZE, polling every CHAT_EXPIRY_INTERVAL seconds once caught up
+CHAT_EXPIRY_BATCH_SIZE = int(os.environ.get('CHAT_EXPIRY_BATCH_SIZE', '500'))
+CHAT_EXPIRY_INTERVAL = float(os.environ.get('CHAT_EXPIRY_INTERVAL', '5'))
+
+# Hot-conversation cache (see chat/recent.py): the newest CHAT_RECENT_MESSAGES serialized messages
+# per conversation, in Redis when a URL is configured, dropped CHAT_RECENT_TTL seconds after their last write
+CHAT_RECENT_REDIS_URL = os.environ.get('CHAT_RECENT_REDIS_URL', os.environ.get('REDIS_URL', ''))
+CHAT_RECENT_MESSAGES = int(os.environ.get('CHAT_RECENT_MESSAGES', '50'))
+CHAT_RECENT_TTL = int(os.environ.get('CHAT_RECENT_TTL', '3600'))
+
+# Block lists (see chat/blocks.py): up to CHAT_BLOCKS_LOCAL_MAX kept in each process for CHAT_BLOCKS_LOCAL_TTL
+# seconds and shared in Redis, when a URL is configured, for CHAT_BLOCKS_TTL seconds
+CHAT_BLOCKS_REDIS_URL = os.environ.get('CHAT_BLOCKS_REDIS_URL', os.environ.get('REDIS_URL', ''))
+CHAT_BLOCKS_TTL = int(os.environ.get('CHAT_BLOCKS_TTL', '3600'))
+CHAT_BLOCKS_LOCAL_TTL = float(os.environ.get('CHAT_BLOCKS_LOCAL_TTL', '5'))
+CHAT_BLOCKS_LOCAL_MAX = int(os.environ.get('CHAT_BLOCKS_LOCAL_MAX', '10000'))
+
 # Application definition
 INSTALLED_APPS = [
     'daphne',
@@ -1,17 +1,32 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+from chat.executors import db_sync_to_async
+from chat.encoding import negotiate, encode_frame, decode_frame, JSON
+from chat.outbound import OutboundQueue, slow_consumer_close, RELIABLE, LATEST
 from .models import RiderLocation, Trip
 
 class RideConsumer(AsyncJsonWebsocketConsumer):
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        await self.receive_json(decode_frame(text_data, bytes_data, self.codec), **kwargs)
+
+    async def send_json(self, content, close=False, policy=RELIABLE, key=None):
+        text_data, bytes_data = encode_frame(content, self.codec)
+        if close:
+            await self.send(text_data=text_data, bytes_data=bytes_data, close=close)
+        else:
+            self.outbound.put(text_data, bytes_data, policy, key)
+
     async def connect(self):
         self.user = self.scope['user']
+        self.codec = negotiate(self.scope)
+        self.outbound = OutboundQueue(self.send, slow_consumer_close(self))
         if self.user.is_authenticated:
             await self.channel_layer.group_add(f"user_{self.user.id}", self.channel_name)
-            await self.accept()
+            await self.accept(None if self.codec == JSON else self.codec)
         else:
             await self.close(code=1006, reason="User not authenticated")
 
     async def disconnect(self, close_code):
+        self.outbound.discard()
         if self.user.is_authenticated:
             await self.channel_layer.group_discard(f"user_{self.user.id}", self.channel_name)
 
@@ -19,22 +34,26 @@ class RideConsumer(AsyncJsonWebsocketConsumer):
         if content['type'] == 'location_update':
             latitude = float(content['latitude'])
             longitude = float(content['longitude'])
-            await self.update_location(latitude, longitude)
+            trip = await self.update_location(latitude, longitude)
+            if trip:
+                passenger_id, trip_id = trip
+                await self.channel_layer.group_send(
+                    f"user_{passenger_id}",
+                    {"type": "rider_location", "latitude": latitude, "longitude": longitude, "trip_id": trip_id}
+                )
 
-    @database_sync_to_async
+    @db_sync_to_async
     def update_location(self, latitude, longitude):
+        """Store the rider's position and return (passenger_id, trip_id) for their active trip, if any."""
         RiderLocation.objects.update_or_create(
             rider=self.user,
             defaults={'latitude': latitude, 'longitude': longitude}
         )
         try:
             trip = Trip.objects.get(rider=self.user, status__in=['accepted', 'ongoing'])
-            async_to_sync(self.channel_layer.group_send)(
-                f"user_{trip.passenger.id}",
-                {"type": "rider_location", "latitude": latitude, "longitude": longitude, "trip_id": trip.id}
-            )
         except Trip.DoesNotExist:
-            pass
+            return None
+        return trip.passenger_id, trip.id
 
     async def trip_request(self, event):
         await self.send_json({'type': 'trip_request', 'trip_id': event['trip_id'], 'pickup_lat': event['pickup_lat'], 'pickup_lon': event['pickup_lon']})
@@ -52,4 +71,8 @@ class RideConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json({'type': 'trip_cancelled', 'trip_id': event['trip_id']})
 
     async def rider_location(self, event):
-        await self.send_json({'type': 'rider_location', 'latitude': event['latitude'], 'longitude': event['longitude'], 'trip_id': event['trip_id']})
\ No newline at end of file
+        # Only the newest position matters; a queued older one is replaced
+        await self.send_json(
+            {'type': 'rider_location', 'latitude': event['latitude'], 'longitude': event['longitude'], 'trip_id': event['trip_id']},
+            policy=LATEST, key=f"rider_location:{event['trip_id']}",
+        )
\ No newline at end of file